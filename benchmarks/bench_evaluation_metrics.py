@@ -0,0 +1,151 @@
+"""
+Benchmark the evaluation metrics: the sklearn calls the evaluators made, one pass over the
+predictions per metric, against evaluation_metrics.py, which sorts the scores once:
+
+    python benchmarks/bench_evaluation_metrics.py
+    python benchmarks/bench_evaluation_metrics.py --rows 10k 1M 100M --sklearn-max-rows 10M --repeat 3
+
+The predictions are synthetic float32 probabilities, as XGBoost returns them, for a churn
+rate of about 15%. --distinct limits the number of distinct scores, the probabilities of a
+small booster take few values. Every run checks that both give the same accuracy,
+confusion matrix and ROC curve. Above --sklearn-max-rows only the single sort is timed.
+The bootstrap column times the confidence intervals of summary.json, --resamples each, and
+the last one the segments.json of the rows sliced by four keys of --segments combinations.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from sklearn.metrics import accuracy_score, confusion_matrix, precision_score, recall_score, roc_curve
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "stepfunctions-data-science-sdk", "cfn", "code"))
+import evaluation_metrics  # noqa: E402
+import synthetic_churn  # noqa: E402
+
+CHURN_RATE = 0.15
+
+
+def predictions(rows, distinct=None, seed=42):
+    rng = np.random.default_rng(seed)
+    y_true = (rng.random(rows) < CHURN_RATE).astype(np.int8)
+    y_score = rng.beta(2, 5, rows).astype(np.float32)
+    y_score[y_true == 1] = 1 - y_score[y_true == 1]
+    if distinct:
+        y_score = (np.round(y_score * distinct) / distinct).astype(np.float32)
+    return y_true, y_score
+
+
+def sklearn_report(y_true, y_score):
+    """What evaluation.py computed before evaluation_metrics.py."""
+    predictions = np.round(y_score)
+    precision = precision_score(y_true, predictions)
+    recall = recall_score(y_true, predictions)
+    accuracy = accuracy_score(y_true, predictions)
+    conf_matrix = confusion_matrix(y_true, predictions)
+    fpr, tpr, _ = roc_curve(y_true, y_score)
+    return accuracy, precision, recall, conf_matrix, fpr, tpr
+
+
+def single_sort_report(y_true, y_score):
+    counts = evaluation_metrics.curve_counts(y_true, y_score)
+    sweep = evaluation_metrics.threshold_sweep(counts, [evaluation_metrics.DEFAULT_THRESHOLD])
+    fpr, tpr, _ = evaluation_metrics.roc_curve(counts)
+    return (sweep["accuracy"][0], sweep["precision"][0], sweep["recall"][0],
+            evaluation_metrics.confusion_matrix(counts), fpr, tpr)
+
+
+def extras(y_true, y_score):
+    """The metrics sklearn would need one more pass each for, from the same sort."""
+    counts = evaluation_metrics.curve_counts(y_true, y_score)
+    evaluation_metrics.roc_auc(counts)
+    evaluation_metrics.precision_recall_curve(counts)
+    evaluation_metrics.average_precision(counts)
+    evaluation_metrics.lift_gain(counts)
+    evaluation_metrics.threshold_sweep(counts, np.linspace(0, 1, 101))
+
+
+def bootstrap(y_true, y_score, resamples):
+    counts = evaluation_metrics.curve_counts(y_true, y_score)
+    above = int(np.searchsorted(-counts[0].astype(np.float64), -evaluation_metrics.DEFAULT_THRESHOLD))
+    return evaluation_metrics.bootstrap(counts, above, resamples)
+
+
+def segment_keys(rows, combinations, seed=42):
+    """
+    Values of State, Area_Code, Int_l_Plan and Account_Length of about combinations combinations,
+    as the Python strings of the frames the evaluators read.
+    """
+    rng = np.random.default_rng(seed)
+    states = max(1, combinations // 30)
+    return np.stack([
+        rng.integers(0, states, rows).astype(str),
+        rng.choice(["408", "415", "510"], rows),
+        rng.choice(["yes", "no"], rows),
+        rng.choice(["0", "50", "100", "150", "200"], rows),
+    ], axis=1).astype(object)
+
+
+def segments(y_true, y_score, keys):
+    state = evaluation_metrics.segment_state(["State", "Area_Code", "Int_l_Plan", "Account_Length"])
+    evaluation_metrics.update_segment_state(state, y_true, y_score, keys)
+    return evaluation_metrics.segment_report(state)
+
+
+def timed(function, *args, repeat=1):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def same_report(a, b):
+    return a[0] == b[0] and np.array_equal(a[3], b[3]) and np.array_equal(a[4], b[4]) and np.array_equal(a[5], b[5])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=synthetic_churn.parse_rows, nargs="+",
+                        default=[10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--distinct", type=int, help="distinct score values, default all")
+    parser.add_argument("--sklearn-max-rows", type=synthetic_churn.parse_rows, default=10_000_000)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per setting, the fastest is reported")
+    parser.add_argument("--resamples", type=int, default=evaluation_metrics.BOOTSTRAP_RESAMPLES)
+    parser.add_argument("--segments", type=int, default=3000, help="combinations of the segment keys")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'rows':>12} {'sklearn s':>10} {'single sort s':>14} {'speedup':>8} {'+ auc/pr/lift/sweep s':>22} "
+          f"{'bootstrap s':>12} {'segments s':>11}")
+    for rows in args.rows:
+        y_true, y_score = predictions(rows, args.distinct)
+        fast_seconds, fast = timed(single_sort_report, y_true, y_score, repeat=args.repeat)
+        extra_seconds, _ = timed(extras, y_true, y_score, repeat=args.repeat)
+        bootstrap_seconds, _ = timed(bootstrap, y_true, y_score, args.resamples, repeat=args.repeat)
+        segment_seconds, _ = timed(segments, y_true, y_score, segment_keys(rows, args.segments), repeat=args.repeat)
+        result = {"rows": rows, "single_sort_seconds": fast_seconds, "all_metrics_seconds": extra_seconds,
+                  "bootstrap_seconds": bootstrap_seconds, "segments_seconds": segment_seconds}
+        if rows <= args.sklearn_max_rows:
+            result["sklearn_seconds"], expected = timed(sklearn_report, y_true, y_score, repeat=args.repeat)
+            if not same_report(expected, fast):
+                raise AssertionError(f"the reports of {rows} rows differ")
+        results.append(result)
+        sklearn_seconds = result.get("sklearn_seconds")
+        print(f"{rows:>12} {sklearn_seconds if sklearn_seconds is not None else float('nan'):>10.3f} "
+              f"{fast_seconds:>14.3f} "
+              f"{(sklearn_seconds / fast_seconds) if sklearn_seconds else float('nan'):>7.1f}x "
+              f"{extra_seconds:>22.3f} {bootstrap_seconds:>12.3f} {segment_seconds:>11.3f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
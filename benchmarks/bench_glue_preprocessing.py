@@ -0,0 +1,169 @@
+"""
+Benchmark the glue_preprocessing.py variants on local PySpark across data scales.
+
+Every run is a fresh local_glue.py process on synthetic data from synthetic_churn.py, so
+the peak memory of one run does not leak into the next. For each script, scale and split
+mode it reports the wall time, the peak memory of the Python driver and of the JVM, and
+the time spent in Spark stages:
+
+    python benchmarks/bench_glue_preprocessing.py --rows 100k 1M --split-modes driver spark
+    python benchmarks/bench_glue_preprocessing.py --variants glue-workflow --rows 10M --stages --json results.json
+    python benchmarks/bench_glue_preprocessing.py --rows 1M --split-modes driver --event-logs /tmp/events
+    python benchmarks/bench_glue_preprocessing.py --rows 1M 10M --sentiment-calls 50 --stages --SENTIMENT_BROADCAST_MB 0
+
+With --stages it also prints the stage records of the script (read, collect, split, profile,
+write_*), and --event-logs keeps the Spark event log of every run for spark_event_log.py.
+--sentiment-calls also generates that many sentiment events per customer on average and
+counts the sentiment features from them (SENTIMENT_DIR); --SENTIMENT_BROADCAST_MB 0 compares
+the shuffle join with the broadcast join.
+
+Other --NAME value arguments are passed on to the scripts, e.g. --SPLIT_STRATEGY random.
+
+Measure here before paying for Glue DPU hours; absolute numbers depend on the machine, the
+comparison between variants and settings carries over.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import synthetic_churn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_GLUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_glue.py")
+
+
+def processed_dir_args(output, fmt):
+    return ["--PROCESSED_DIR", output]
+
+
+def processed_prefix_args(output, fmt):
+    # this copy joins PROCESSED_DIR and the split names without a separator
+    return ["--PROCESSED_DIR", output + "/"]
+
+
+def split_dir_args(output, fmt):
+    return ["--TRAIN_DIR", f"{output}/train", "--VAL_DIR", f"{output}/validation", "--TEST_DIR", f"{output}/test"]
+
+
+def split_uri_args(output, fmt):
+    return [
+        "--TRAIN_URI", f"{output}/train/train.{fmt}",
+        "--VALIDATION_URI", f"{output}/validation/validation.{fmt}",
+        "--TEST_URI", f"{output}/test/test.{fmt}",
+    ]
+
+
+# script of each sample and the output arguments it takes
+VARIANTS = {
+    "glue-workflow": ("glue-workflow/code/glue_preprocessing.py", processed_dir_args),
+    "sagemaker-pipeline": ("sagemaker-pipeline/cfn/code/glue_preprocessing.py", split_uri_args),
+    "stepfunctions-sdk": ("stepfunctions-data-science-sdk/code/glue_preprocessing.py", processed_prefix_args),
+    "stepfunctions-cfn": ("stepfunctions-data-science-sdk/cfn/code/glue_preprocessing.py", split_dir_args),
+}
+
+
+def run_once(variant, input_dir, output, split_mode, output_format, master, driver_memory, extra_args,
+             event_log_dir=None):
+    script, output_args = VARIANTS[variant]
+    # the driver mode writes single files with pandas, which does not create directories
+    for split in ("train", "validation", "test"):
+        os.makedirs(os.path.join(output, split), exist_ok=True)
+    report = os.path.join(output, "report.json")
+    command = [
+        sys.executable, LOCAL_GLUE, os.path.join(ROOT, script),
+        "--master", master, "--driver-memory", driver_memory,
+        "--bookmark-dir", os.path.join(output, "bookmarks"), "--report", report,
+        "--JOB_NAME", f"bench-{variant}", "--INPUT_DIR", input_dir,
+        "--SPLIT_MODE", split_mode, "--OUTPUT_FORMAT", output_format, "--METRICS_NAMESPACE", "none",
+    ] + output_args(output, output_format) + extra_args
+    if event_log_dir:
+        command[2:2] = ["--event-log-dir", event_log_dir]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(report) as f:
+        return json.load(f)
+
+
+def summarize(result):
+    stages = result["stages"]
+    return {
+        "stage_seconds": sum(s["seconds"] for s in stages),
+        "slowest_stage": max(stages, key=lambda s: s["seconds"]) if stages else None,
+    }
+
+
+def print_stages(result):
+    for stage in result.get("job_stages", []):
+        rows = stage["rows"] if stage["rows"] is not None else "-"
+        size = f"{stage['bytes'] / 1024 ** 2:.1f} MB" if stage["bytes"] is not None else "-"
+        print(f"{'':>8}job   {stage['stage']:<16} {stage['seconds']:>8.2f}s {rows:>10} rows {size:>12}")
+    for stage in result["stages"]:
+        print(f"{'':>8}stage {stage['stage_id']:>3} {stage['seconds']:>8.2f}s {stage['tasks']:>5} tasks  {stage['name']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     allow_abbrev=False)
+    parser.add_argument("--variants", nargs="+", choices=sorted(VARIANTS), default=["glue-workflow"])
+    parser.add_argument("--rows", type=synthetic_churn.parse_rows, nargs="+", default=[5000, 100000, 1000000])
+    parser.add_argument("--split-modes", nargs="+", choices=["driver", "spark"], default=["driver", "spark"])
+    parser.add_argument("--format", dest="output_format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--shards", type=int, default=8, help="input files per data set")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per setting, the fastest is reported")
+    parser.add_argument("--master", default="local[*]")
+    parser.add_argument("--driver-memory", default="4g")
+    parser.add_argument("--stages", action="store_true", help="also print the time of every job and Spark stage")
+    parser.add_argument("--event-logs", help="keep the Spark event log of every run in this directory")
+    parser.add_argument("--sentiment-calls", type=float, help="join sentiment events, this many per customer on average")
+    parser.add_argument("--json", help="write every run with its stages to this file")
+    parser.add_argument("--workdir", help="keep the generated data and outputs here instead of a temporary directory")
+    args, extra_args = parser.parse_known_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-glue-preprocessing-")
+    results = []
+    try:
+        print(f"{'variant':<20} {'rows':>10} {'mode':>7} {'wall s':>8} {'stages s':>9} {'py MB':>8} {'jvm MB':>8}  slowest stage")
+        for rows in args.rows:
+            input_dir = os.path.join(workdir, f"input-{rows}")
+            if not os.path.isdir(input_dir):
+                synthetic_churn.generate(input_dir, rows, shards=min(args.shards, max(1, rows // 5000)))
+            run_args = extra_args
+            if args.sentiment_calls:
+                sentiment_dir = os.path.join(workdir, f"sentiment-{rows}-{args.sentiment_calls:g}")
+                if not os.path.isdir(sentiment_dir):
+                    synthetic_churn.generate_sentiment(sentiment_dir, rows, args.sentiment_calls, shards=args.shards)
+                run_args = ["--SENTIMENT_DIR", sentiment_dir] + extra_args
+            for variant in args.variants:
+                for split_mode in args.split_modes:
+                    runs = []
+                    for attempt in range(args.repeat):
+                        output = os.path.join(workdir, f"output-{variant}-{rows}-{split_mode}-{attempt}")
+                        runs.append(run_once(variant, input_dir, output, split_mode, args.output_format,
+                                             args.master, args.driver_memory, run_args, args.event_logs))
+                        shutil.rmtree(output, ignore_errors=True)
+                    best = min(runs, key=lambda r: r["wall_seconds"])
+                    best.update(variant=variant, rows=rows, split_mode=split_mode, runs=[r["wall_seconds"] for r in runs])
+                    results.append(best)
+
+                    summary = summarize(best)
+                    slowest = summary["slowest_stage"]
+                    slowest = f"{slowest['seconds']:.2f}s {slowest['name']}" if slowest else "-"
+                    jvm_mb = f"{best['jvm_peak_mb']:.0f}" if best["jvm_peak_mb"] is not None else "n/a"
+                    print(f"{variant:<20} {rows:>10} {split_mode:>7} {best['wall_seconds']:>8.2f} "
+                          f"{summary['stage_seconds']:>9.2f} {best['python_peak_mb']:>8.0f} {jvm_mb:>8}  {slowest}")
+                    if args.stages:
+                        print_stages(best)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare the original string read + withColumn cast ladder of glue_preprocessing.py with the
+typed, column-pruned read and fused select that replaced it.
+
+Runs on plain PySpark (no Glue needed) against synthetic data sets `scale` times the size of
+data/churn_processed.csv, made by synthetic_churn.py:
+
+    python benchmarks/bench_schema_read.py --scales 1 10 100 --repeat 3
+"""
+import argparse
+import ast
+import os
+import shutil
+import tempfile
+import time
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, StringType, FloatType, DoubleType, LongType, BooleanType
+
+import synthetic_churn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GLUE_SCRIPT = os.path.join(ROOT, "glue-workflow", "code", "glue_preprocessing.py")
+SAMPLE_ROWS = 5000
+
+
+def load_typed_transform():
+    """Pull CHURN_SCHEMA and encode_features out of the Glue script without running the job."""
+    with open(GLUE_SCRIPT) as f:
+        tree = ast.parse(f.read())
+    wanted = [
+        node for node in tree.body
+        if (isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) == "CHURN_SCHEMA")
+        or (isinstance(node, ast.FunctionDef) and node.name == "encode_features")
+    ]
+    namespace = {
+        "F": F, "StructType": StructType, "StructField": StructField, "StringType": StringType,
+        "FloatType": FloatType, "DoubleType": DoubleType, "LongType": LongType, "BooleanType": BooleanType,
+    }
+    exec(compile(ast.Module(body=wanted, type_ignores=[]), GLUE_SCRIPT, "exec"), namespace)
+    return namespace["CHURN_SCHEMA"], namespace["encode_features"]
+
+
+def legacy_transform(spark, path):
+    """The original read: every column as a string, a drop and one withColumn per cast."""
+    data = spark.read.csv(path, header=True, sep=",", quote='"')
+    data = data.drop("Day_Charge", "Eve_Charge", "Night_Charge", "Intl_Charg", "Area_Code", "State", "sentiment")
+    casts = [
+        ("Account_Length", LongType()), ("customerID", LongType()), ("Int_l_Plan", StringType()),
+        ("VMail_Plan", StringType()), ("VMail_Message", StringType()), ("Day_Mins", FloatType()),
+        ("Day_Calls", LongType()), ("Eve_Mins", FloatType()), ("Eve_Calls", LongType()),
+        ("Night_Mins", FloatType()), ("Night_Calls", LongType()), ("Intl_Mins", FloatType()),
+        ("Intl_Calls", LongType()), ("CustServ_Calls", LongType()), ("Churn", BooleanType()),
+        ("pastSenti_nut", LongType()), ("pastSenti_pos", LongType()), ("pastSenti_neg", LongType()),
+        ("mth_remain", LongType()),
+    ]
+    for name, dtype in casts:
+        data = data.withColumn(name, data[name].cast(dtype))
+    data = data.withColumn('Churn', F.when(data.Churn == 'false', 0).otherwise(1))
+    data = data.withColumn('Int_l_Plan', F.when(data.Int_l_Plan == 'no', 0).otherwise(1))
+    data = data.withColumn('VMail_Plan', F.when(data.VMail_Plan == 'no', 0).otherwise(1))
+    return data.select(
+        "churn", 'Account_Length', 'customerID', 'Int_l_Plan', 'VMail_Plan', 'VMail_Message', 'Day_Mins',
+        'Day_Calls', 'Eve_Mins', 'Eve_Calls', 'Night_Mins', 'Night_Calls', 'Intl_Mins', 'Intl_Calls',
+        'Intl_Charge', 'CustServ_Calls', 'pastSenti_nut', 'pastSenti_pos', 'pastSenti_neg', 'mth_remain')
+
+
+def typed_transform(spark, path, schema, encode_features):
+    raw = spark.read.csv(path, schema=schema, header=True, sep=",", quote='"', enforceSchema=False)
+    return encode_features(raw)
+
+
+def write_scaled_csv(scale, directory):
+    """Generate `scale` times as many synthetic rows as the sample CSV, return path and row count."""
+    path = os.path.join(directory, f"churn_x{scale}")
+    rows = scale * SAMPLE_ROWS
+    synthetic_churn.generate(path, rows, shards=max(1, scale // 20), seed=scale)
+    return path, rows
+
+
+def time_action(df):
+    """Force every output column to be computed without collecting rows to the driver."""
+    start = time.perf_counter()
+    df.select(F.sum(F.hash(*df.columns))).collect()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.master("local[*]").appName("bench-schema-read").getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    schema, encode_features = load_typed_transform()
+
+    workdir = tempfile.mkdtemp(prefix="bench-schema-read-")
+    try:
+        print(f"{'scale':>6} {'rows':>10} {'legacy s':>10} {'typed s':>10} {'speedup':>8}")
+        for scale in args.scales:
+            path, rows = write_scaled_csv(scale, workdir)
+            legacy = min(time_action(legacy_transform(spark, path)) for _ in range(args.repeat))
+            typed = min(time_action(typed_transform(spark, path, schema, encode_features)) for _ in range(args.repeat))
+            print(f"{scale:>6} {rows:>10} {legacy:>10.2f} {typed:>10.2f} {legacy / typed:>7.2f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        spark.stop()
+
+
+if __name__ == "__main__":
+    main()
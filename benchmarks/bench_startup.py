@@ -0,0 +1,151 @@
+"""
+Benchmark the startup cost of the job dependencies: what a run paid to install its Python
+modules from PyPI, against a prebuilt wheelhouse installed without an index and against an
+image or runtime that already has them.
+
+Each run creates a fresh virtual environment with the --python interpreter, so nothing is
+cached between runs but pip's own download cache (disabled with --no-cache-dir):
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --python python3.7 --jobs glue --modes pypi wheelhouse --repeat 3
+    python benchmarks/bench_startup.py --python /opt/conda/bin/python --jobs evaluation --modes preinstalled
+
+Modes:
+  pypi          pip install of the modules the jobs used to install when they started
+  wheelhouse    pip install --no-index of the wheels the jobs are given now, downloaded
+                beforehand (not timed), as Glue installs --additional-python-modules wheels
+                with --python-modules-installer-option --no-index
+  preinstalled  only the imports, in the --python interpreter itself: run it with the Python of
+                the SageMaker XGBoost image or of the Glue analytics library set
+
+Jobs:
+  glue          the Spark preprocessing job: pyarrow, awswrangler and fsspec before; now only the
+                pyarrow wheel, and only for OUTPUT_FORMAT=parquet with SPLIT_MODE=driver
+  evaluation    evaluation.py: xgboost and pyarrow before; now nothing, the XGBoost image has them
+
+pyarrow 2.0.0 has wheels up to Python 3.9 (Glue 2.0 runs 3.7); pass --python accordingly.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+JOBS = {
+    "glue": {
+        "pypi": ["pyarrow==2", "awswrangler==2.9.0", "fsspec==0.7.4"],
+        "wheelhouse": ["pyarrow==2.0.0"],
+        "imports": ["pyarrow.parquet"],
+    },
+    "evaluation": {
+        "pypi": ["xgboost", "pyarrow"],
+        "wheelhouse": [],
+        "imports": ["xgboost", "sklearn.metrics", "joblib", "pyarrow.parquet"],
+    },
+}
+MODES = ("pypi", "wheelhouse", "preinstalled")
+
+
+def venv_python(venv):
+    return os.path.join(venv, "Scripts" if os.name == "nt" else "bin", "python")
+
+
+def create_venv(python, path):
+    subprocess.run([python, "-m", "venv", path], check=True, stdout=subprocess.DEVNULL)
+    return venv_python(path)
+
+
+def download_wheels(python, requirements, wheelhouse):
+    """The wheels of requirements and their dependencies for the --python interpreter."""
+    subprocess.run(
+        [python, "-m", "pip", "download", "--only-binary=:all:", "--dest", wheelhouse, *requirements],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+
+
+def timed(command):
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        error = (result.stderr.strip().splitlines() or ["no output"])[-1]
+        raise RuntimeError(f"{' '.join(command)} failed: {error}")
+    return seconds
+
+
+def import_command(python, modules):
+    return [python, "-c", "; ".join(f"import {module}" for module in modules)]
+
+
+def run_once(python, job, mode, work_dir, wheelhouse):
+    """Seconds to install (if anything) and import the modules of job in a fresh environment."""
+    spec = JOBS[job]
+    if mode == "preinstalled":
+        return {"install_seconds": 0.0, "import_seconds": timed(import_command(python, spec["imports"]))}
+    venv = tempfile.mkdtemp(prefix=f"{job}-{mode}-", dir=work_dir)
+    try:
+        env_python = create_venv(python, venv)
+        pip = [env_python, "-m", "pip", "install", "--no-cache-dir", "--disable-pip-version-check", "--quiet"]
+        if mode == "pypi":
+            install = timed(pip + spec["pypi"])
+        elif spec["wheelhouse"]:
+            install = timed(pip + ["--no-index", "--find-links", wheelhouse] + spec["wheelhouse"])
+        else:
+            install = 0.0
+        # the import check of a mode that installs nothing runs in the job runtime, not in the venv
+        imports = spec["imports"] if mode == "pypi" or spec["wheelhouse"] else []
+        return {"install_seconds": install, "import_seconds": timed(import_command(env_python, imports)) if imports else 0.0}
+    finally:
+        shutil.rmtree(venv, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--python", default=sys.executable, help="interpreter of the environments")
+    parser.add_argument("--jobs", nargs="+", choices=sorted(JOBS), default=sorted(JOBS))
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-startup-")
+    results = []
+    try:
+        wheelhouse = os.path.join(work_dir, "wheelhouse")
+        os.makedirs(wheelhouse)
+        if "wheelhouse" in args.modes:
+            requirements = sorted({r for job in args.jobs for r in JOBS[job]["wheelhouse"]})
+            if requirements:
+                download_wheels(args.python, requirements, wheelhouse)
+        print(f"{'job':<12} {'mode':<13} {'install s':>10} {'import s':>9} {'total s':>8}")
+        for job in args.jobs:
+            for mode in args.modes:
+                try:
+                    runs = [run_once(args.python, job, mode, work_dir, wheelhouse) for _ in range(args.repeat)]
+                except RuntimeError as e:
+                    print(f"{job:<12} {mode:<13} {e}")
+                    results.append({"job": job, "mode": mode, "error": str(e)})
+                    continue
+                result = {
+                    "job": job,
+                    "mode": mode,
+                    "install_seconds": statistics.median(r["install_seconds"] for r in runs),
+                    "import_seconds": statistics.median(r["import_seconds"] for r in runs),
+                }
+                result["total_seconds"] = result["install_seconds"] + result["import_seconds"]
+                results.append(result)
+                print(f"{job:<12} {mode:<13} {result['install_seconds']:>10.2f} {result['import_seconds']:>9.2f} "
+                      f"{result['total_seconds']:>8.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
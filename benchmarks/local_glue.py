@@ -0,0 +1,331 @@
+"""
+Run the glue_preprocessing.py scripts on plain PySpark, outside of AWS Glue.
+
+Stand-ins for the parts of awsglue the scripts use (GlueContext, DynamicFrame,
+getResolvedOptions and Job) are registered as the awsglue modules before the script runs.
+The modules next to the script, such as preprocessing_output.py, are importable as they are
+with --extra-py-files. The job arguments are passed after the script path, exactly as Glue
+would pass them:
+
+    python benchmarks/local_glue.py glue-workflow/code/glue_preprocessing.py \\
+        --JOB_NAME local --INPUT_DIR data --PROCESSED_DIR /tmp/processed --SPLIT_MODE spark
+
+Paths are local (or any file system the local Spark can reach). --report writes the wall
+time, the peak memory of the driver (the Python process and the JVM), the time of every
+Spark stage and the stage records of the script (its stage_metrics) to a JSON file, which is
+what bench_glue_preprocessing.py collects. --event-log-dir keeps the Spark event log of the
+run for spark_event_log.py. Pass --METRICS_NAMESPACE none to keep the script from
+publishing its stage metrics to CloudWatch.
+
+Job bookmarks are emulated for create_dynamic_frame_from_options when the job runs with
+--job-bookmark-option job-bookmark-enable: the files read by each transformation_ctx are
+remembered in --bookmark-dir (default .local_glue_bookmarks) when the job commits.
+"""
+import argparse
+import inspect
+import json
+import logging
+import os
+import resource
+import runpy
+import sys
+import time
+import types
+from datetime import datetime
+from urllib.request import urlopen
+
+DEFAULT_BOOKMARK_DIR = ".local_glue_bookmarks"
+
+
+def getResolvedOptions(args, options):
+    """Like awsglue.utils.getResolvedOptions: every option is required and given as --NAME value."""
+    resolved = {}
+    for name in options:
+        flag = f"--{name}"
+        if flag not in args:
+            raise RuntimeError(f"argument {flag} is required")
+        index = len(args) - 1 - args[::-1].index(flag)
+        if index + 1 >= len(args):
+            raise RuntimeError(f"argument {flag}: expected one argument")
+        resolved[name] = args[index + 1]
+    return resolved
+
+
+class DynamicFrame:
+    """Thin wrapper around a DataFrame, only the conversions the scripts use."""
+
+    def __init__(self, df, glue_ctx, name=""):
+        self._df = df
+        self.glue_ctx = glue_ctx
+        self.name = name
+
+    def toDF(self):
+        return self._df
+
+    def count(self):
+        return self._df.count()
+
+    @staticmethod
+    def fromDF(dataframe, glue_ctx, name):
+        return DynamicFrame(dataframe, glue_ctx, name)
+
+
+def list_files(paths):
+    """Data files under the given files or directories, skipping hidden and _SUCCESS style files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if not name.startswith(('.', '_')))
+        else:
+            files.append(path)
+    return sorted(os.path.abspath(f) for f in files)
+
+
+class Bookmarks:
+    """Files already read per transformation_ctx, persisted when the job commits."""
+
+    def __init__(self, directory, job_name):
+        self.path = os.path.join(directory, f"{job_name}.json")
+        self.enabled = False
+        self.pending = {}
+        self.seen = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.seen = json.load(f)
+
+    def new_files(self, ctx, paths):
+        files = [f for f in list_files(paths) if f not in set(self.seen.get(ctx, []))]
+        self.pending[ctx] = files
+        return files
+
+    def commit(self):
+        if not self.enabled or not self.pending:
+            return
+        for ctx, files in self.pending.items():
+            self.seen[ctx] = sorted(set(self.seen.get(ctx, [])) | set(files))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.seen, f, indent=2)
+        self.pending = {}
+
+
+class GlueContext:
+    """The SparkSession of a SparkContext, plus the DynamicFrame reader and the logger."""
+
+    bookmark_dir = DEFAULT_BOOKMARK_DIR
+
+    def __init__(self, sc):
+        from pyspark.sql import SparkSession
+
+        self._sc = sc
+        self.spark_session = SparkSession(sc)
+        self.bookmarks = None
+
+    def get_logger(self):
+        return logging.getLogger("local_glue")
+
+    def create_dynamic_frame_from_options(self, connection_type, connection_options=None, format=None,
+                                          format_options=None, transformation_ctx="", **kwargs):
+        from pyspark.sql.types import StructType
+
+        if format != "csv":
+            raise NotImplementedError(f"local_glue only reads csv, not {format}")
+        format_options = format_options or {}
+        paths = (connection_options or {}).get("paths", [])
+        if self.bookmarks and self.bookmarks.enabled and transformation_ctx:
+            files = self.bookmarks.new_files(transformation_ctx, paths)
+        else:
+            files = paths
+        if not files:
+            return DynamicFrame(self.spark_session.createDataFrame([], StructType([])), self, transformation_ctx)
+        # DynamicFrames read every CSV column as a string
+        df = self.spark_session.read.csv(
+            files,
+            header=format_options.get("withHeader", False),
+            sep=format_options.get("separator", ","),
+            quote=format_options.get("quoteChar", '"'),
+        )
+        return DynamicFrame(df, self, transformation_ctx)
+
+
+class Job:
+
+    def __init__(self, glue_context):
+        self.glue_context = glue_context
+
+    def init(self, job_name, args=None):
+        bookmarks = Bookmarks(GlueContext.bookmark_dir, job_name)
+        option = getResolvedOptions(sys.argv, ["job-bookmark-option"])["job-bookmark-option"] \
+            if "--job-bookmark-option" in sys.argv else "job-bookmark-disable"
+        bookmarks.enabled = option == "job-bookmark-enable"
+        self.glue_context.bookmarks = bookmarks
+
+    def commit(self):
+        if self.glue_context.bookmarks:
+            self.glue_context.bookmarks.commit()
+
+
+def patch_pandas():
+    """
+    The Glue 2.0 pandas takes to_csv(line_terminator=...), which pandas 1.5 renamed to
+    lineterminator and pandas 2 dropped. An empty line_terminator meant os.linesep.
+    """
+    import pandas as pd
+
+    original = pd.DataFrame.to_csv
+    if "line_terminator" in inspect.signature(original).parameters:
+        return
+
+    def to_csv(self, *args, line_terminator=None, **kwargs):
+        if line_terminator:
+            kwargs.setdefault("lineterminator", line_terminator)
+        return original(self, *args, **kwargs)
+
+    pd.DataFrame.to_csv = to_csv
+
+
+def install():
+    """Register the stand-ins as the awsglue package."""
+    modules = {
+        "awsglue": {},
+        "awsglue.context": {"GlueContext": GlueContext},
+        "awsglue.dynamicframe": {"DynamicFrame": DynamicFrame},
+        "awsglue.job": {"Job": Job},
+        "awsglue.transforms": {},
+        "awsglue.utils": {"getResolvedOptions": getResolvedOptions},
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        if name == "awsglue.transforms":
+            module.__all__ = []
+        sys.modules[name] = module
+    patch_pandas()
+
+
+def spark_submit_args(master, driver_memory, event_log_dir=None):
+    # Glue creates the SparkContext without arguments, so the local settings go through spark-submit
+    event_log = [
+        "--conf spark.eventLog.enabled=true",
+        f"--conf spark.eventLog.dir={os.path.abspath(event_log_dir)}",
+    ] if event_log_dir else []
+    return " ".join([
+        f"--master {master}",
+        f"--driver-memory {driver_memory}",
+        "--conf spark.ui.enabled=true",
+    ] + event_log + ["pyspark-shell"])
+
+
+def get_json(url):
+    with urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+def parse_spark_time(value):
+    return datetime.strptime(value.replace("GMT", ""), "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def stage_metrics(sc):
+    """Completed stages of the application from the Spark UI REST API, in submission order."""
+    base = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}"
+    stages = []
+    for stage in get_json(f"{base}/stages?status=complete"):
+        stages.append({
+            "stage_id": stage["stageId"],
+            "name": stage["name"],
+            "tasks": stage["numTasks"],
+            "seconds": (parse_spark_time(stage["completionTime"]) - parse_spark_time(stage["submissionTime"])).total_seconds(),
+            "executor_run_seconds": stage["executorRunTime"] / 1000,
+            "input_bytes": stage["inputBytes"],
+            "output_bytes": stage["outputBytes"],
+            "shuffle_write_bytes": stage["shuffleWriteBytes"],
+            "submitted": stage["submissionTime"],
+        })
+    return sorted(stages, key=lambda s: (s["submitted"], s["stage_id"]))
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident memory of a process in MB, read from /proc on Linux for other processes."""
+    if pid is None:
+        return None
+    if pid == os.getpid():
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def jvm_pid(sc):
+    try:
+        return sc._jvm.java.lang.ProcessHandle.current().pid()
+    except Exception:
+        # ProcessHandle needs Java 9 or later
+        return None
+
+
+def run_script(script, script_args, bookmark_dir=DEFAULT_BOOKMARK_DIR):
+    """
+    Run a Glue script as __main__, returns (wall seconds, the SparkContext it used, the stage
+    records of the script, empty when it exited early).
+    """
+    from pyspark import SparkContext
+
+    install()
+    GlueContext.bookmark_dir = bookmark_dir
+    # the modules next to the script, which the Glue jobs get with --extra-py-files
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    sys.argv = [script] + list(script_args)
+    start = time.perf_counter()
+    script_globals = {}
+    try:
+        script_globals = runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        # the incremental mode exits early when there is no new input
+        if e.code not in (None, 0):
+            raise
+    return time.perf_counter() - start, SparkContext._active_spark_context, script_globals.get("stage_metrics", [])
+
+
+def main():
+    # no abbreviations, so that script arguments are never taken for ours
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     allow_abbrev=False)
+    parser.add_argument("script")
+    parser.add_argument("--master", default="local[*]")
+    parser.add_argument("--driver-memory", default="4g")
+    parser.add_argument("--bookmark-dir", default=DEFAULT_BOOKMARK_DIR)
+    parser.add_argument("--report", help="write wall time, peak driver memory and Spark stage times to this JSON file")
+    parser.add_argument("--event-log-dir", help="write the Spark event log of the run to this directory")
+    args, script_args = parser.parse_known_args()
+
+    if args.event_log_dir:
+        os.makedirs(args.event_log_dir, exist_ok=True)
+    os.environ["PYSPARK_SUBMIT_ARGS"] = spark_submit_args(args.master, args.driver_memory, args.event_log_dir)
+    wall_seconds, sc, job_stages = run_script(args.script, script_args, args.bookmark_dir)
+
+    report = {
+        "script": args.script,
+        "arguments": script_args,
+        "wall_seconds": wall_seconds,
+        "python_peak_mb": peak_rss_mb(os.getpid()),
+        "jvm_peak_mb": peak_rss_mb(jvm_pid(sc)) if sc else None,
+        "stages": stage_metrics(sc) if sc else [],
+        "job_stages": job_stages,
+    }
+    if sc:
+        sc.stop()
+    print(f"{args.script} finished in {wall_seconds:.2f}s")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
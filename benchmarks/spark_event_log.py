@@ -0,0 +1,263 @@
+"""
+Analyze the Spark event log of a preprocessing run: per stage the task time skew, the
+spill, the shuffle volume and the bytes sent back to the driver.
+
+Glue writes the event log of a run when the job has --enable-spark-ui true, under
+--spark-event-logs-path; local_glue.py writes it with --event-log-dir:
+
+    python benchmarks/spark_event_log.py s3://bucket/prefix/spark-event-logs/
+    python benchmarks/spark_event_log.py /tmp/events/local-1655608182578 --json analysis.json
+
+A path is an event log file, a rolling event log directory (eventlog_v2_*), or a
+directory or S3 prefix holding them, in which case the most recent run is analyzed.
+Uncompressed and gzip logs are read; set spark.eventLog.compress=false for other codecs.
+
+Skew is the slowest task of a stage over its median task. Spill is data the executors
+wrote to disk because it did not fit in memory. The driver collect size is the result
+bytes of the tasks that return data to the driver, what toPandas and collect transfer.
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import statistics
+
+# stages whose slowest task takes SKEW_RATIO times the median and at least SKEW_MIN_SECONDS
+SKEW_RATIO = 3.0
+SKEW_MIN_SECONDS = 1.0
+# spark.driver.maxResultSize defaults to 1g
+COLLECT_WARNING_BYTES = 512 * 1024 ** 2
+
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def is_rolling_dir(name):
+    return os.path.basename(name.rstrip("/")).startswith("eventlog_v2_")
+
+
+def rolling_index(name):
+    # events_<index>_<app id>
+    return int(os.path.basename(name).split("_")[1])
+
+
+def find_local_log(path):
+    """The files of the event log at or under a local path, in reading order."""
+    if os.path.isfile(path):
+        return [path]
+    if is_rolling_dir(path):
+        return sorted((os.path.join(path, n) for n in os.listdir(path) if n.startswith("events_")), key=rolling_index)
+    entries = [os.path.join(path, n) for n in os.listdir(path) if not n.startswith((".", "_"))]
+    if not entries:
+        raise FileNotFoundError(f"no event log under {path}")
+    return find_local_log(max(entries, key=os.path.getmtime))
+
+
+def find_s3_log(uri):
+    """The keys of the most recent event log at or under an S3 prefix, in reading order."""
+    import boto3
+
+    s3 = boto3.client("s3")
+    bucket, prefix = split_s3_uri(uri)
+    objects = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get("Contents", []))
+    if not objects:
+        raise FileNotFoundError(f"no event log under {uri}")
+    # a rolling log is the set of files of its directory, any other object is a log of its own
+    logs = {}
+    for item in objects:
+        parent = os.path.dirname(item["Key"])
+        logs.setdefault(parent if is_rolling_dir(parent) else item["Key"], []).append(item)
+    latest = max(logs.values(), key=lambda items: max(i["LastModified"] for i in items))
+    keys = [i["Key"] for i in latest if os.path.basename(i["Key"]).startswith("events_")] or [latest[0]["Key"]]
+    if len(keys) > 1:
+        keys.sort(key=rolling_index)
+    return s3, bucket, keys
+
+
+def open_log(name, raw):
+    if name.endswith(".gz"):
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding="utf-8")
+    if name.rsplit(".", 1)[-1] in ("lz4", "lzf", "snappy", "zstd"):
+        raise ValueError(f"{name} is compressed with a codec this tool does not read, set spark.eventLog.compress=false")
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+def read_events(path):
+    """Events of the most recent event log at or under path, one dict per line."""
+    if path.startswith("s3://"):
+        s3, bucket, keys = find_s3_log(path)
+        sources = [(key, io.BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read())) for key in keys]
+    else:
+        sources = [(name, open(name, "rb")) for name in find_local_log(path)]
+    for name, raw in sources:
+        with open_log(name, raw) as lines:
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def new_stage(info):
+    return {
+        "stage_id": info["Stage ID"],
+        "attempt": info.get("Stage Attempt ID", 0),
+        "name": info.get("Stage Name", ""),
+        "submitted": info.get("Submission Time"),
+        "completed": info.get("Completion Time"),
+        "failure": info.get("Failure Reason"),
+        "tasks": [],
+    }
+
+
+def task_record(event):
+    info = event["Task Info"]
+    metrics = event.get("Task Metrics") or {}
+    shuffle_read = metrics.get("Shuffle Read Metrics", {})
+    shuffle_write = metrics.get("Shuffle Write Metrics", {})
+    return {
+        "seconds": (info["Finish Time"] - info["Launch Time"]) / 1000,
+        "executor": info.get("Executor ID"),
+        "host": info.get("Host"),
+        "failed": info.get("Failed", False) or info.get("Killed", False),
+        "result_task": event.get("Task Type") == "ResultTask",
+        "gc_seconds": metrics.get("JVM GC Time", 0) / 1000,
+        "result_bytes": metrics.get("Result Size", 0),
+        "memory_spill_bytes": metrics.get("Memory Bytes Spilled", 0),
+        "disk_spill_bytes": metrics.get("Disk Bytes Spilled", 0),
+        "input_bytes": metrics.get("Input Metrics", {}).get("Bytes Read", 0),
+        "output_bytes": metrics.get("Output Metrics", {}).get("Bytes Written", 0),
+        "shuffle_read_bytes": shuffle_read.get("Remote Bytes Read", 0) + shuffle_read.get("Local Bytes Read", 0),
+        "shuffle_write_bytes": shuffle_write.get("Shuffle Bytes Written", 0),
+        "shuffle_write_records": shuffle_write.get("Shuffle Records Written", 0),
+    }
+
+
+def collect_stages(events):
+    """Application info and the stage attempts of an event log with their task records."""
+    application = {}
+    stages = {}
+    for event in events:
+        kind = event.get("Event")
+        if kind == "SparkListenerApplicationStart":
+            application = {"name": event.get("App Name"), "id": event.get("App ID"), "started": event.get("Timestamp")}
+        elif kind == "SparkListenerApplicationEnd":
+            application["ended"] = event.get("Timestamp")
+        elif kind in ("SparkListenerStageSubmitted", "SparkListenerStageCompleted"):
+            info = event["Stage Info"]
+            key = (info["Stage ID"], info.get("Stage Attempt ID", 0))
+            stage = stages.setdefault(key, new_stage(info))
+            stage.update({k: v for k, v in new_stage(info).items() if v is not None and k != "tasks"})
+        elif kind == "SparkListenerTaskEnd":
+            key = (event["Stage ID"], event.get("Stage Attempt ID", 0))
+            stages.setdefault(key, new_stage({"Stage ID": key[0], "Stage Attempt ID": key[1]}))
+            stages[key]["tasks"].append(task_record(event))
+    return application, [stages[key] for key in sorted(stages, key=lambda k: (stages[k]["submitted"] or 0, k))]
+
+
+def stage_summary(stage):
+    tasks = [t for t in stage["tasks"] if not t["failed"]]
+    seconds = [t["seconds"] for t in tasks]
+    median = statistics.median(seconds) if seconds else 0
+    slowest = max(tasks, key=lambda t: t["seconds"]) if tasks else None
+    summary = {
+        "stage_id": stage["stage_id"],
+        "attempt": stage["attempt"],
+        "name": stage["name"],
+        "seconds": (stage["completed"] - stage["submitted"]) / 1000 if stage["completed"] and stage["submitted"] else None,
+        "tasks": len(tasks),
+        "failed_tasks": len(stage["tasks"]) - len(tasks),
+        "median_task_seconds": median,
+        "max_task_seconds": slowest["seconds"] if slowest else 0,
+        "skew": slowest["seconds"] / median if slowest and median > 0 else None,
+        "slowest_task_executor": slowest["executor"] if slowest else None,
+        "failure": stage["failure"],
+    }
+    for metric in ("gc_seconds", "input_bytes", "output_bytes", "shuffle_read_bytes", "shuffle_write_bytes",
+                   "shuffle_write_records", "memory_spill_bytes", "disk_spill_bytes"):
+        summary[metric] = sum(t[metric] for t in tasks)
+    summary["driver_result_bytes"] = sum(t["result_bytes"] for t in tasks if t["result_task"])
+    return summary
+
+
+def findings(summaries, skew_ratio=SKEW_RATIO, skew_min_seconds=SKEW_MIN_SECONDS):
+    """Plain-language notes on the stages worth tuning."""
+    notes = []
+    for s in summaries:
+        label = f"stage {s['stage_id']} ({s['name']})"
+        if s["skew"] and s["skew"] >= skew_ratio and s["max_task_seconds"] >= skew_min_seconds:
+            notes.append(f"{label}: slowest task {s['max_task_seconds']:.1f}s is {s['skew']:.1f}x the median, "
+                         f"on executor {s['slowest_task_executor']}")
+        if s["disk_spill_bytes"]:
+            notes.append(f"{label}: spilled {format_bytes(s['memory_spill_bytes'])} from memory, "
+                         f"{format_bytes(s['disk_spill_bytes'])} on disk")
+        if s["driver_result_bytes"] >= COLLECT_WARNING_BYTES:
+            notes.append(f"{label}: sent {format_bytes(s['driver_result_bytes'])} to the driver")
+        if s["failure"]:
+            notes.append(f"{label}: failed, {s['failure'].splitlines()[0]}")
+    return notes
+
+
+def analyze(events, skew_ratio=SKEW_RATIO):
+    application, stages = collect_stages(events)
+    summaries = [stage_summary(stage) for stage in stages]
+    totals = {
+        metric: sum(s[metric] for s in summaries)
+        for metric in ("input_bytes", "output_bytes", "shuffle_read_bytes", "shuffle_write_bytes",
+                       "memory_spill_bytes", "disk_spill_bytes", "gc_seconds")
+    }
+    totals["driver_collect_bytes"] = sum(s["driver_result_bytes"] for s in summaries)
+    if application.get("started") and application.get("ended"):
+        totals["application_seconds"] = (application["ended"] - application["started"]) / 1000
+    return {
+        "application": application,
+        "stages": summaries,
+        "totals": totals,
+        "findings": findings(summaries, skew_ratio),
+    }
+
+
+def format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def print_report(report):
+    application = report["application"]
+    print(f"{application.get('name')} {application.get('id')}")
+    print(f"{'stage':>6} {'s':>8} {'tasks':>6} {'skew':>6} {'input':>10} {'shuffle w':>10} {'shuffle r':>10} "
+          f"{'spill':>10} {'to driver':>10}  name")
+    for s in report["stages"]:
+        seconds = f"{s['seconds']:.2f}" if s["seconds"] is not None else "-"
+        skew = f"{s['skew']:.1f}" if s["skew"] else "-"
+        print(f"{s['stage_id']:>6} {seconds:>8} {s['tasks']:>6} {skew:>6} {format_bytes(s['input_bytes']):>10} "
+              f"{format_bytes(s['shuffle_write_bytes']):>10} {format_bytes(s['shuffle_read_bytes']):>10} "
+              f"{format_bytes(s['disk_spill_bytes']):>10} {format_bytes(s['driver_result_bytes']):>10}  {s['name']}")
+    totals = report["totals"]
+    print(f"input {format_bytes(totals['input_bytes'])}, shuffle {format_bytes(totals['shuffle_write_bytes'])}, "
+          f"spill {format_bytes(totals['disk_spill_bytes'])}, driver collect {format_bytes(totals['driver_collect_bytes'])}")
+    for note in report["findings"]:
+        print(f"- {note}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="event log file or directory, local or s3://")
+    parser.add_argument("--skew-ratio", type=float, default=SKEW_RATIO)
+    parser.add_argument("--json", help="also write the analysis to this file")
+    args = parser.parse_args()
+
+    report = analyze(read_events(args.path), args.skew_ratio)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Generate synthetic churn data shaped like data/churn_processed.csv at any scale.
+
+A Gaussian copula is fitted for each Churn class: the empirical distribution of every
+column plus the rank correlation between columns, so churners keep the feature mix and
+the correlations of the sample. Rows are drawn in vectorized chunks and streamed to
+shard files, so memory stays bounded by --chunk-rows whatever the row count:
+
+    python benchmarks/synthetic_churn.py --rows 1M --shards 8 --output /tmp/churn_1m
+    python benchmarks/synthetic_churn.py --rows 100M --shards 64 --format parquet --workers 8 --output /tmp/churn_100m
+
+Shard s holds rows [s * rows / shards, (s + 1) * rows / shards) and depends only on
+--seed, --rows, --shards and s, so shards can be generated in parallel or regenerated
+one at a time. customerID is unique across all shards.
+
+With --sentiment-output it also writes raw per-call sentiment events for the same customers,
+the input of SENTIMENT_DIR in glue_preprocessing.py, on average --sentiment-calls per customer:
+
+    python benchmarks/synthetic_churn.py --rows 1M --shards 8 --output /tmp/churn_1m \
+        --sentiment-output /tmp/sentiment_1m --sentiment-calls 50
+"""
+import argparse
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr, ndtri
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_CSV = os.path.join(ROOT, "data", "churn_processed.csv")
+
+LABEL = "Churn"
+ID_COLUMN = "customerID"
+# sampled from their per-class frequencies, outside the copula
+CATEGORICAL_COLUMNS = ["State"]
+YES_NO_COLUMNS = ["Int_l_Plan", "VMail_Plan"]
+# numeric columns with at most this many distinct values keep exactly the sample's values
+MAX_DISCRETE_VALUES = 64
+
+# customerIDs are 7 digits in the sample; larger data sets continue past 9999999
+ID_OFFSET = 1000000
+ID_SPACE = 9000000
+ID_MULTIPLIER = 2654435761
+
+SUFFIXES = {"k": 10 ** 3, "m": 10 ** 6, "b": 10 ** 9}
+
+SENTIMENTS = np.array(["neutral", "positive", "negative"], dtype=object)
+# share of each sentiment among the calls of customers who stay and of churners
+SENTIMENT_SHARES = {False: [0.6, 0.3, 0.1], True: [0.4, 0.2, 0.4]}
+# call_time of the events is spread over this many seconds before SENTIMENT_END
+SENTIMENT_SPAN_SECONDS = 365 * 24 * 3600
+SENTIMENT_END = np.datetime64("2022-06-01T00:00:00")
+
+
+class ChurnModel:
+    """Per-class Gaussian copula over the sample columns."""
+
+    def __init__(self, sample):
+        self.columns = list(sample.columns)
+        self.dtypes = sample.dtypes
+        self.copula_columns = [c for c in self.columns if c not in [LABEL, ID_COLUMN] + CATEGORICAL_COLUMNS]
+        self.discrete = {
+            c for c in self.copula_columns
+            if c in YES_NO_COLUMNS or sample[c].dtype.kind != "f" or sample[c].nunique() <= MAX_DISCRETE_VALUES
+        }
+        self.churn_rate = sample[LABEL].mean()
+        self.classes = {label: self._fit_class(group) for label, group in sample.groupby(LABEL)}
+
+    def _fit_class(self, group):
+        values = np.column_stack([self._encode(group[c]) for c in self.copula_columns])
+        # normal scores of the ranks, whose correlation defines the copula
+        ranks = pd.DataFrame(values).rank(method="average").to_numpy()
+        scores = ndtri(ranks / (len(group) + 1))
+        correlation = np.corrcoef(scores, rowvar=False)
+        correlation += np.eye(len(self.copula_columns)) * 1e-6
+        categories = {
+            c: group[c].value_counts(normalize=True).sort_index() for c in CATEGORICAL_COLUMNS
+        }
+        return {
+            "sorted": np.sort(values, axis=0),
+            "cholesky": np.linalg.cholesky(correlation),
+            "categories": categories,
+        }
+
+    @staticmethod
+    def _encode(column):
+        if column.name in YES_NO_COLUMNS:
+            return (column == "yes").to_numpy(dtype=np.float64)
+        return column.to_numpy(dtype=np.float64)
+
+    def _inverse_cdf(self, sorted_values, u, discrete):
+        n = len(sorted_values)
+        if discrete:
+            return sorted_values[np.minimum((u * n).astype(np.int64), n - 1)]
+        return np.interp(u * (n - 1), np.arange(n), sorted_values)
+
+    def _sample_class(self, params, n, rng):
+        z = rng.standard_normal((n, len(self.copula_columns))) @ params["cholesky"].T
+        u = ndtr(z)
+        columns = {}
+        for i, name in enumerate(self.copula_columns):
+            values = self._inverse_cdf(params["sorted"][:, i], u[:, i], name in self.discrete)
+            if name in YES_NO_COLUMNS:
+                columns[name] = np.where(values > 0.5, "yes", "no")
+            else:
+                columns[name] = values.astype(self.dtypes[name])
+        for name, frequencies in params["categories"].items():
+            columns[name] = rng.choice(frequencies.index.to_numpy(dtype=object), size=n, p=frequencies.to_numpy())
+        return columns
+
+    def sample(self, first_row, n, rng, total_rows=None):
+        """n rows whose customerIDs are those of global rows [first_row, first_row + n)."""
+        is_churn = rng.random(n) < self.churn_rate
+        columns = {}
+        for label in (False, True):
+            rows = np.flatnonzero(is_churn == label)
+            for name, values in self._sample_class(self.classes[label], len(rows), rng).items():
+                if name not in columns:
+                    columns[name] = np.empty(n, dtype=values.dtype)
+                columns[name][rows] = values
+        columns[LABEL] = is_churn
+        columns[ID_COLUMN] = customer_ids(first_row, n, total_rows)
+        return pd.DataFrame(columns)[self.columns]
+
+
+def customer_ids(first_row, n, total_rows=None):
+    """
+    Unique customerIDs for global rows [first_row, first_row + n): row i gets
+    ID_OFFSET + (ID_MULTIPLIER * i) mod space, a bijection on [0, space) that scatters
+    consecutive rows over the whole range.
+    """
+    space = max(ID_SPACE, first_row + n if total_rows is None else total_rows)
+    multiplier = ID_MULTIPLIER
+    while math.gcd(multiplier, space) != 1:
+        multiplier += 2
+    rows = np.arange(first_row, first_row + n, dtype=np.int64)
+    return ID_OFFSET + (rows * multiplier) % space
+
+
+def parse_rows(value):
+    """Row counts like 5000, 1M or 2.5k."""
+    value = value.strip().lower()
+    if value[-1:] in SUFFIXES:
+        return int(float(value[:-1]) * SUFFIXES[value[-1]])
+    return int(value)
+
+
+def shard_bounds(rows, shards, shard):
+    return rows * shard // shards, rows * (shard + 1) // shards
+
+
+def write_shard(model, path, output_format, first_row, n, chunk_rows, rng, total_rows):
+    writer = None
+    try:
+        for start in range(0, n, chunk_rows):
+            frame = model.sample(first_row + start, min(chunk_rows, n - start), rng, total_rows)
+            if output_format == "parquet":
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            else:
+                frame.to_csv(path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def generate_shard(sample_csv, output, output_format, rows, shards, shard, chunk_rows, seed):
+    model = ChurnModel(pd.read_csv(sample_csv))
+    first_row, end_row = shard_bounds(rows, shards, shard)
+    path = os.path.join(output, f"part-{shard:05d}.{output_format}")
+    rng = np.random.default_rng([seed, shard])
+    write_shard(model, path, output_format, first_row, end_row - first_row, chunk_rows, rng, rows)
+    return path, end_row - first_row
+
+
+def write_sentiment_shard(path, first_row, n, total_rows, calls, chunk_rows, rng, churn_rate):
+    """Events of the customers of global rows [first_row, first_row + n), a Poisson number of calls each."""
+    events = 0
+    for start in range(0, n, chunk_rows):
+        ids = customer_ids(first_row + start, min(chunk_rows, n - start), total_rows)
+        per_customer = rng.poisson(calls, len(ids))
+        customer = np.repeat(ids, per_customer)
+        churner = np.repeat(rng.random(len(ids)) < churn_rate, per_customer)
+        sentiment = np.where(
+            churner,
+            rng.choice(SENTIMENTS, size=len(customer), p=SENTIMENT_SHARES[True]),
+            rng.choice(SENTIMENTS, size=len(customer), p=SENTIMENT_SHARES[False]),
+        )
+        seconds = rng.integers(0, SENTIMENT_SPAN_SECONDS, len(customer))
+        frame = pd.DataFrame({
+            ID_COLUMN: customer,
+            "call_time": (SENTIMENT_END - seconds.astype("timedelta64[s]")).astype(str),
+            "sentiment": sentiment,
+        })
+        frame.to_csv(path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+        events += len(frame)
+    return path, events
+
+
+def generate_sentiment_shard(output, rows, shards, shard, calls, chunk_rows, seed, churn_rate):
+    first_row, end_row = shard_bounds(rows, shards, shard)
+    path = os.path.join(output, f"events-{shard:05d}.csv")
+    rng = np.random.default_rng([seed, shard, 1])
+    return write_sentiment_shard(path, first_row, end_row - first_row, rows, calls, chunk_rows, rng, churn_rate)
+
+
+def generate_sentiment(output, rows, calls, shards=1, chunk_rows=500000, seed=0, workers=1, sample_csv=SAMPLE_CSV):
+    """
+    Write sentiment events for the customers of a `rows` data set as `shards` CSV files under
+    `output`, returns [(path, events)]. Whether a customer churns is drawn
+    independently of the churn data, only the customerIDs match.
+    """
+    os.makedirs(output, exist_ok=True)
+    churn_rate = pd.read_csv(sample_csv, usecols=[LABEL])[LABEL].mean()
+    jobs = [(output, rows, shards, shard, calls, chunk_rows, seed, churn_rate) for shard in range(shards)]
+    if workers <= 1:
+        return [generate_sentiment_shard(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(generate_sentiment_shard, *zip(*jobs)))
+
+
+def generate(output, rows, shards=1, output_format="csv", chunk_rows=500000, seed=0, workers=1,
+             sample_csv=SAMPLE_CSV):
+    """Write `rows` synthetic rows as `shards` files under `output`, returns [(path, rows)]."""
+    os.makedirs(output, exist_ok=True)
+    jobs = [(sample_csv, output, output_format, rows, shards, shard, chunk_rows, seed) for shard in range(shards)]
+    if workers <= 1:
+        return [generate_shard(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(generate_shard, *zip(*jobs)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=parse_rows, required=True, help="e.g. 5000, 1M, 10M, 100M")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--format", dest="output_format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--chunk-rows", type=int, default=500000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--sample", default=SAMPLE_CSV)
+    parser.add_argument("--sentiment-output", help="also write per-call sentiment events here")
+    parser.add_argument("--sentiment-calls", type=float, default=20, help="average calls per customer")
+    args = parser.parse_args()
+
+    written = generate(args.output, args.rows, args.shards, args.output_format, args.chunk_rows, args.seed,
+                       args.workers, args.sample)
+    print(f"Wrote {sum(n for _, n in written)} rows to {len(written)} files under {args.output}")
+    if args.sentiment_output:
+        written = generate_sentiment(args.sentiment_output, args.rows, args.sentiment_calls, args.shards,
+                                     args.chunk_rows, args.seed, args.workers, args.sample)
+        print(f"Wrote {sum(n for _, n in written)} sentiment events to {len(written)} files under {args.sentiment_output}")
+
+
+if __name__ == "__main__":
+    main()
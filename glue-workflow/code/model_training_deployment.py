@@ -1,26 +1,35 @@
 import boto3
+import io
+import os
 import sys
+import tarfile
+import tempfile
 from datetime import datetime
 import json
 
 import pandas as pd
 import numpy as np
 
-from sklearn.metrics import (
-    accuracy_score,
-    precision_score,
-    recall_score,
-    confusion_matrix,
-    roc_curve,
-)
+# installed from the wheel passed with --additional-python-modules, the version of the
+# training image, so that the job scores the test set with the booster the endpoint would serve
+import xgboost
+import joblib
+
+# passed to the job with --extra-py-files
+import evaluation_metrics
 
 from awsglue.utils import getResolvedOptions
 
 s3_client = boto3.client('s3')
 sagemaker_client = boto3.client('sagemaker')    
-sagemaker_runtime_client = boto3.Session().client('sagemaker-runtime')
 glue_client = boto3.client("glue")
 
+# training channel content type for each OUTPUT_FORMAT of the preprocessing job
+CONTENT_TYPES = {'csv': 'text/csv', 'parquet': 'application/x-parquet'}
+# the segment keys the preprocessing job appends to the test split after the features, see
+# SEGMENT_COLUMNS in glue_preprocessing.py: segments.json slices the metrics by them
+SEGMENT_KEYS = ['State', 'Area_Code', 'Int_l_Plan', 'Account_Length']
+
 
 class ModelRun:
 
@@ -33,9 +42,26 @@ class ModelRun:
         self.role_arn = args['role_arn']
         timestamp_suffix = str(current_time.month) + "-" + str(current_time.day) + "-" + str(current_time.hour) + "-" + str(current_time.minute)
         self.training_job_name = 'gw-xgb-churn-pred' + timestamp_suffix
+        self.model_data_url = f"{self.model_output_path}/{self.training_job_name}/output/model.tar.gz"
+
+        # optional, must match the OUTPUT_FORMAT the preprocessing job wrote the splits in
+        self.output_format = getResolvedOptions(sys.argv, ['output_format'])['output_format'] if '--output_format' in sys.argv else 'csv'
+        self.content_type = CONTENT_TYPES[self.output_format]
+        # optional, must match the COMPRESSION of the preprocessing job, gzip CSV splits are named *.csv.gz
+        self.compression = getResolvedOptions(sys.argv, ['compression'])['compression'] if '--compression' in sys.argv else 'none'
+        gzip_csv = self.compression == 'gzip' and self.output_format == 'csv'
+        self.compression_type = 'Gzip' if gzip_csv else 'None'
+        # optional, must match the SHARDS of the preprocessing job. Sharded splits are read through the
+        # manifest files it writes, and with more than one training instance every instance only
+        # downloads its share of the train part files (ShardedByS3Key)
+        self.shards = int(getResolvedOptions(sys.argv, ['shards'])['shards']) if '--shards' in sys.argv else 1
+        self.instance_count = int(getResolvedOptions(sys.argv, ['instance_count'])['instance_count']) if '--instance_count' in sys.argv else 1
+        # optional, must match the WINDOW_DAYS of the preprocessing job. Above 0 the splits are
+        # partitioned by snapshot date and every channel reads the manifest of the partitions in the window
+        self.window_days = int(getResolvedOptions(sys.argv, ['window_days'])['window_days']) if '--window_days' in sys.argv else 0
         
         # by default, a test data set is used to evaluate the model performance
-        self.evaluation_data_set_s3_uri = f"{self.train_input_path}/test/test.csv"
+        self.evaluation_data_set_s3_uri = f"{self.train_input_path}/test/test.{self.output_format}" + ('.gz' if gzip_csv else '')
         
         # get run properties of the workflow
         workflow_name = args['WORKFLOW_NAME']
@@ -45,7 +71,35 @@ class ModelRun:
 
         self.endpoint = workflow_params['endpoint_name']
         self.evaluation_threshold = 0.95 if 'evaluation_threshold' not in workflow_params else float(workflow_params['evaluation_threshold'])
+        # the summary metric compared with the threshold, 'accuracy_lower' for the lower bound of its
+        # bootstrap confidence interval
+        self.gate_metric = workflow_params.get('gate_metric', 'accuracy')
         
+    def manifest_uri(self, name):
+        return f"{self.train_input_path}/manifests/{name}.manifest"
+
+    def channel(self, name):
+        if self.shards > 1 or self.window_days:
+            s3_data_source = {
+                'S3DataType': 'ManifestFile',
+                'S3Uri': self.manifest_uri(name),
+                'S3DataDistributionType': 'ShardedByS3Key' if name == 'train' and self.instance_count > 1 else 'FullyReplicated'
+            }
+        else:
+            s3_data_source = {
+                'S3DataType': 'S3Prefix',
+                'S3Uri': f"{self.train_input_path}/{name}",
+                'S3DataDistributionType': 'FullyReplicated'
+            }
+        return {
+            'ChannelName': name,
+            'DataSource': {
+                'S3DataSource': s3_data_source
+            },
+            'ContentType': self.content_type,
+            'CompressionType': self.compression_type
+        }
+
     def create_training_job(self):
         print("===Create Training Job===")
         
@@ -68,38 +122,13 @@ class ModelRun:
                     'TrainingInputMode': 'File'
                 },
                 RoleArn=self.role_arn,
-                InputDataConfig=[
-                    {
-                        'ChannelName': 'train',
-                        'DataSource': {
-                            'S3DataSource': {
-                                'S3DataType': 'S3Prefix',
-                                'S3Uri': self.train_input_path + '/train',
-                                'S3DataDistributionType': 'FullyReplicated'
-                            }
-                        },
-                        'ContentType': 'text/csv',
-                        'CompressionType': 'None'
-                    },
-                    {
-                        'ChannelName': 'validation',
-                        'DataSource': {
-                            'S3DataSource': {
-                                'S3DataType': 'S3Prefix',
-                                'S3Uri': self.train_input_path + '/validation',
-                                'S3DataDistributionType': 'FullyReplicated'
-                            }
-                        },
-                        'ContentType': 'text/csv',
-                        'CompressionType': 'None'
-                    }
-                ],
+                InputDataConfig=[self.channel('train'), self.channel('validation')],
                 OutputDataConfig={
                     'S3OutputPath': self.model_output_path
                 },
                 ResourceConfig={
                     'InstanceType': 'ml.m5.xlarge',
-                    'InstanceCount': 1,
+                    'InstanceCount': self.instance_count,
                     'VolumeSizeInGB': 20
                 },
                 StoppingCondition={
@@ -139,7 +168,7 @@ class ModelRun:
             PrimaryContainer=
             {
                 'Image': self.algorithm_image,
-                'ModelDataUrl': f"{self.model_output_path}/{self.training_job_name}/output/model.tar.gz"
+                'ModelDataUrl': self.model_data_url
             },
             ExecutionRoleArn=self.role_arn
         )
@@ -209,71 +238,110 @@ class ModelRun:
         print("Created Transform job with name: ", batch_job_name)
         
     
-    def evaluate_model(self):
-        # download the data
+    def evaluation_objects(self):
+        """(bucket, key) of the non-empty objects of the test set."""
+        if self.window_days:
+            # only the partitions of the window, as listed by the manifest of the preprocessing job
+            bucket_name, _, key = self.manifest_uri('test')[len('s3://'):].partition('/')
+            entries = json.loads(s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+            prefix = entries[0]['prefix'][len('s3://'):]
+            bucket_name, _, key_prefix = prefix.partition('/')
+            return [(bucket_name, key_prefix + path) for path in entries[1:]]
         uri_components = self.evaluation_data_set_s3_uri.split('/')
         bucket_name = uri_components[2]
         key = '/'.join(uri_components[3:])
-        
-        obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-        df = pd.read_csv(obj['Body'], header=None)
-
-        
-        # df = pd.read_csv(self.evaluation_data_set_s3_uri, header=None)
 
-        payload = df[df.columns[1:]].to_csv(header=False, index=False).encode("utf-8")
+        # with SPLIT_MODE=spark the test set is a prefix of part files rather than a single object
+        objects = []
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=key):
+            objects.extend((bucket_name, item['Key']) for item in page.get('Contents', []) if item['Size'] > 0)
+        return objects
+
+    def load_model(self):
+        """Download the model.tar.gz of the training job and load its booster in the job."""
+        print("===Load Model===")
+        bucket_name, _, key = self.model_data_url[len('s3://'):].partition('/')
+        with tempfile.TemporaryDirectory() as model_dir:
+            model_path = os.path.join(model_dir, 'model.tar.gz')
+            s3_client.download_file(bucket_name, key, model_path)
+            with tarfile.open(model_path) as tar:
+                tar.extractall(path=model_dir)
+            self.model = joblib.load(os.path.join(model_dir, 'xgboost-model'))
 
-        response = sagemaker_runtime_client.invoke_endpoint(
-            EndpointName=self.endpoint, 
-            ContentType='text/csv', 
-            Body=payload)
-
-        result = response['Body'].read().decode()
+    def evaluate_model(self):
+        """
+        Score the test set with the booster of load_model, offline: no endpoint is needed to
+        decide whether the model is deployed.
+        """
+        # download the data
+        frames = []
+        for bucket_name, key in self.evaluation_objects():
+            if key.endswith('.parquet'):
+                obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+                frame = pd.read_parquet(io.BytesIO(obj['Body'].read()))
+                frame.columns = range(frame.shape[1])
+                frames.append(frame)
+            elif key.endswith(('.csv', '.csv.gz')):
+                obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+                compression = 'gzip' if key.endswith('.gz') else None
+                frames.append(pd.read_csv(obj['Body'], header=None, compression=compression))
+        df = pd.concat(frames, ignore_index=True)
 
-        prediction_probabilities = np.asarray(result.split(','), dtype=float)
-        predictions = np.round(prediction_probabilities)
+        
+        # df = pd.read_csv(self.evaluation_data_set_s3_uri, header=None)
 
+        # the segment keys are not features, the first of them is text
+        segmented = df.shape[1] > len(SEGMENT_KEYS) + 1 and \
+            not pd.api.types.is_numeric_dtype(df.dtypes.iloc[-len(SEGMENT_KEYS)])
+        features = df.shape[1] - len(SEGMENT_KEYS) if segmented else df.shape[1]
+        prediction_probabilities = self.model.predict(
+            xgboost.DMatrix(df[df.columns[1:features]].to_numpy(dtype=np.float32)))
         y_test = df[0]
 
-        precision = precision_score(y_test, predictions)
-        recall = recall_score(y_test, predictions)
-        accuracy = accuracy_score(y_test, predictions)
-        conf_matrix = confusion_matrix(y_test, predictions)
-        fpr, tpr, _ = roc_curve(y_test, prediction_probabilities)
-
         # prettify the evaluation result printing
-        report_dict = {
-            "binary_classification_metrics": {
-                "accuracy": {"value": accuracy, "standard_deviation": "NaN"},
-                "precision": {"value": precision, "standard_deviation": "NaN"},
-                "recall": {"value": recall, "standard_deviation": "NaN"},
-                "confusion_matrix": {
-                    "0": {"0": int(conf_matrix[0][0]), "1": int(conf_matrix[0][1])},
-                    "1": {"0": int(conf_matrix[1][0]), "1": int(conf_matrix[1][1])},
-                },
-                "receiver_operating_characteristic_curve": {
-                    "false_positive_rates": list(fpr),
-                    "true_positive_rates": list(tpr),
-                },
-            },
-        }
+        report_dict, summary, _ = evaluation_metrics.evaluation_outputs(y_test, prediction_probabilities)
+        metrics = report_dict["binary_classification_metrics"]
+        # None when the metric is not defined on this test set, see evaluation_metrics.bootstrap
+        accuracy = summary.get(self.gate_metric)
+        precision = metrics["precision"]["value"]
+        recall = metrics["recall"]["value"]
+        conf_matrix = np.array([[metrics["confusion_matrix"][i][j] for j in "01"] for i in "01"])
         print("===Evaluation Result===")
-        print(json.dumps(report_dict))
+        print(json.dumps(summary))
+
+        segments = evaluation_metrics.segment_state(SEGMENT_KEYS)
+        if segmented:
+            evaluation_metrics.update_segment_state(segments, y_test, prediction_probabilities,
+                                                    df.iloc[:, features:].astype(str).to_numpy())
+        self.upload_segment_report(segments)
         
         return accuracy, precision, recall, conf_matrix
+
+    def upload_segment_report(self, segments):
+        """Write the segments.json of the test set next to the model artifacts of the training job."""
+        uri = f"{self.model_output_path}/{self.training_job_name}/evaluation/segments.json"
+        bucket_name, _, key = uri[len('s3://'):].partition('/')
+        s3_client.put_object(Bucket=bucket_name, Key=key,
+                             Body=json.dumps(evaluation_metrics.segment_report(segments)).encode("utf-8"))
+        print("===Segment Report===")
+        print(uri)
     
     def review_evaluation_result(self, accuracy):
         """
-        May delete the endpoint & related configuration if accuracy metric is less than evaluation threshold.
+        Whether the model is deployed: only if the gate metric reaches the evaluation threshold.
+        A missing or undefined gate metric fails the gate.
         """
+        if accuracy is None:
+            print("===Not Deploying the Model===")
+            print(f"{self.gate_metric} metric is missing from the evaluation summary or undefined on the test set, hence, no model, endpoint configuration or endpoint is created.")
+            return False
         if accuracy < self.evaluation_threshold:
-            print("===Deleting the Endpoint & Endpoint Configuration===")
-            sagemaker_client.delete_endpoint_config(EndpointConfigName=self.endpoint)
-            sagemaker_client.delete_endpoint(EndpointName=self.endpoint)
-            print("Done")
-        else:
-            print("===Not Delete Endpoint===")
-            print(f"accuracy metric {accuracy} is larger or equal than threshold {self.evaluation_threshold}, hence, not delete the endpoint.")
+            print("===Not Deploying the Model===")
+            print(f"{self.gate_metric} metric {accuracy} is less than threshold {self.evaluation_threshold}, hence, no model, endpoint configuration or endpoint is created.")
+            return False
+        print("===Deploying the Model===")
+        print(f"{self.gate_metric} metric {accuracy} is larger or equal than threshold {self.evaluation_threshold}, hence, deploy the model.")
+        return True
         
         
     
@@ -288,17 +356,17 @@ if __name__ == '__main__':
     # Describe training job
     status = obj.describe_training_job()
 
-    # Create endpoint conf
-    resp = obj.create_endpoint_config()
-
-    # Create endpoint for model
-    obj.create_endpoint()
+    # Evaluate model offline, in this job
+    obj.load_model()
+    accuracy, _, _, _ = obj.evaluate_model()
 
-    # Describe endpoint
-    status = obj.describe_endpoint()
+    # Review evluation result, only a model that passes the gate gets an endpoint
+    if obj.review_evaluation_result(accuracy):
+        # Create endpoint conf
+        resp = obj.create_endpoint_config()
 
-    # Evaluate model
-    accuracy, _, _, _ = obj.evaluate_model()
+        # Create endpoint for model
+        obj.create_endpoint()
 
-    # Review evluation result
-    obj.review_evaluation_result(accuracy)    
\ No newline at end of file
+        # Describe endpoint
+        status = obj.describe_endpoint()    
\ No newline at end of file
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import math
+import os
+import statistics
+from datetime import datetime
+
+import boto3
+
+s3 = boto3.client('s3')
+
+# inputs up to this many bytes are preprocessed with the pandas engine (churn_preprocessing.py),
+# larger ones with the Spark job (glue_preprocessing.py)
+MAX_PYTHON_ENGINE_BYTES = int(os.environ.get('MAX_PYTHON_ENGINE_BYTES', 256 * 1024 * 1024))
+
+# Cost model of the capacity planner, each value can be overridden by an environment variable of the
+# same name. SPARK_BYTES_PER_WORKER_SECOND is recalibrated from the recorded runs, see calibrate.
+CAPACITY_MODEL = {
+    # input CSV bytes one G.1X worker (1 DPU) preprocesses per second, read, cast, split and write included
+    'SPARK_BYTES_PER_WORKER_SECOND': 4 * 1024 * 1024,
+    # startup of a Glue 2.0 job, paid once per run whatever the number of workers
+    'SPARK_STARTUP_SECONDS': 60,
+    # runtime the Spark job is sized for
+    'TARGET_SECONDS': 600,
+    'MIN_WORKERS': 2,
+    'MAX_WORKERS': 100,
+    # in-memory size of the data relative to its CSV size, and the share of the worker memory it may
+    # take before the planner moves to workers with twice the memory
+    'MEMORY_EXPANSION': 4,
+    'MEMORY_FRACTION': 0.5,
+    'PYTHON_BYTES_PER_SECOND': 8 * 1024 * 1024,
+    'PYTHON_STARTUP_SECONDS': 15,
+}
+CAPACITY_MODEL = {name: float(os.environ.get(name, value)) for name, value in CAPACITY_MODEL.items()}
+
+WORKER_TYPES = {
+    'G.1X': {'dpu': 1, 'memory_bytes': 16 * 1024 ** 3},
+    'G.2X': {'dpu': 2, 'memory_bytes': 32 * 1024 ** 3},
+}
+# Glue bills at least a minute per run
+MIN_BILLED_SECONDS = 60
+# recorded runs used for calibration, the most recent ones
+CALIBRATION_RUNS = 20
+CALIBRATION_MIN_RUNS = 3
+# bytes read from the start of an input object to estimate the average row size
+ROW_SAMPLE_BYTES = 1024 * 1024
+
+
+def list_input_objects(input_dir):
+    """(key, size, ETag) of every object under an s3:// prefix."""
+    bucket, _, prefix = input_dir[len('s3://'):].partition('/')
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects.append((item['Key'], item['Size'], item['ETag']))
+    return objects
+
+
+def input_size(input_dir):
+    """Total size and number of the objects under an s3:// prefix."""
+    objects = list_input_objects(input_dir)
+    return sum(size for _, size, _ in objects), len(objects)
+
+
+def choose_engine(input_bytes, max_bytes=MAX_PYTHON_ENGINE_BYTES):
+    return 'python' if input_bytes <= max_bytes else 'spark'
+
+
+def estimate_rows(objects, input_dir):
+    """Row count estimated from the average line length at the start of the largest input object."""
+    if not objects:
+        return 0
+    bucket, _, _ = input_dir[len('s3://'):].partition('/')
+    key, size, _ = max(objects, key=lambda o: o[1])
+    sample = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{ROW_SAMPLE_BYTES - 1}")['Body'].read()
+    lines = sample.count(b'\n')
+    if size <= ROW_SAMPLE_BYTES:
+        # the whole object was read, minus its header line
+        return max(lines - 1, 0) * len(objects)
+    bytes_per_row = len(sample) / max(lines, 1)
+    return int(sum(size for _, size, _ in objects) / bytes_per_row)
+
+
+def plan_capacity(input_bytes, model=CAPACITY_MODEL, max_python_bytes=MAX_PYTHON_ENGINE_BYTES):
+    """
+    Engine, worker type and number of workers for an input of input_bytes CSV bytes, with the
+    estimated runtime and DPU hours. The Spark job gets as many workers as it takes to finish in
+    TARGET_SECONDS, and twice the memory per worker when its share of the data would not fit.
+    """
+    if input_bytes <= max_python_bytes:
+        seconds = model['PYTHON_STARTUP_SECONDS'] + input_bytes / model['PYTHON_BYTES_PER_SECOND']
+        return {
+            'engine': 'python',
+            'workerType': None,
+            'numberOfWorkers': None,
+            'estimatedSeconds': round(seconds),
+            'estimatedDpuHours': round(max(seconds, MIN_BILLED_SECONDS) / 3600, 4),
+        }
+    work_seconds = max(model['TARGET_SECONDS'] - model['SPARK_STARTUP_SECONDS'], 1)
+    workers = math.ceil(input_bytes / (model['SPARK_BYTES_PER_WORKER_SECOND'] * work_seconds))
+    workers = int(min(max(workers, model['MIN_WORKERS']), model['MAX_WORKERS']))
+    worker_type = 'G.1X'
+    if input_bytes * model['MEMORY_EXPANSION'] / workers > model['MEMORY_FRACTION'] * WORKER_TYPES['G.1X']['memory_bytes']:
+        worker_type = 'G.2X'
+    dpu = WORKER_TYPES[worker_type]['dpu'] * workers
+    seconds = model['SPARK_STARTUP_SECONDS'] + input_bytes / (model['SPARK_BYTES_PER_WORKER_SECOND'] * dpu)
+    return {
+        'engine': 'spark',
+        'workerType': worker_type,
+        'numberOfWorkers': workers,
+        'estimatedSeconds': round(seconds),
+        'estimatedDpuHours': round(dpu * max(seconds, MIN_BILLED_SECONDS) / 3600, 4),
+    }
+
+
+def calibrate(runs, model=CAPACITY_MODEL):
+    """
+    Model with SPARK_BYTES_PER_WORKER_SECOND set to the median throughput per DPU of the
+    recorded Spark runs, once there are CALIBRATION_MIN_RUNS of them.
+    """
+    throughputs = []
+    for run in runs:
+        if run.get('engine') != 'spark' or not run.get('executionSeconds') or not run.get('numberOfWorkers'):
+            continue
+        dpu = WORKER_TYPES[run['workerType']]['dpu'] * run['numberOfWorkers']
+        seconds = max(run['executionSeconds'] - model['SPARK_STARTUP_SECONDS'], 1)
+        throughputs.append(run['inputBytes'] / (dpu * seconds))
+    if len(throughputs) < CALIBRATION_MIN_RUNS:
+        return model
+    return dict(model, SPARK_BYTES_PER_WORKER_SECOND=statistics.median(throughputs))
+
+
+def load_runs(history_uri, limit=CALIBRATION_RUNS):
+    """The most recent run records under an s3:// prefix, see record_run."""
+    bucket, prefix = _split_uri(history_uri)
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return [json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read()) for key in sorted(keys)[-limit:]]
+
+
+def record_run(history_uri, run):
+    """Store the plan and the actual runtime of a run, named by time so the newest sort last."""
+    bucket, prefix = _split_uri(history_uri)
+    key = f"{prefix.rstrip('/')}/{datetime.utcnow():%Y%m%dT%H%M%S%f}.json"
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(run, sort_keys=True).encode('utf-8'),
+                  ContentType='application/json')
+
+
+def fingerprint(objects, parameters):
+    """
+    Hash of the input object keys and ETags plus the parameters that shape the output (script
+    version, split settings, output locations). Equal fingerprints give the same processed data.
+
+    Window runs write the partition of their snapshotDate, which may be a timestamp such as
+    $$.Execution.StartTime: like the preprocessing jobs, only its day is kept.
+    """
+    if parameters.get('snapshotDate'):
+        parameters = dict(parameters, snapshotDate=parameters['snapshotDate'][:10])
+    content = {
+        'inputs': sorted([key, etag] for key, _, etag in objects),
+        'parameters': parameters,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _split_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def lookup_cache(cache_uri, input_fingerprint):
+    """
+    Outputs recorded for this fingerprint, or None. The processed data lives at fixed locations,
+    so the record is only kept while it describes them: on a miss it is deleted before the
+    preprocessing job starts overwriting the outputs.
+    """
+    bucket, key = _split_uri(cache_uri)
+    try:
+        record = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+    if input_fingerprint is not None and record.get('fingerprint') == input_fingerprint:
+        return record['outputs']
+    s3.delete_object(Bucket=bucket, Key=key)
+    return None
+
+
+def record_cache(cache_uri, input_fingerprint, outputs):
+    bucket, key = _split_uri(cache_uri)
+    body = json.dumps({'fingerprint': input_fingerprint, 'outputs': outputs}, sort_keys=True)
+    s3.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json')
+
+
+def lambda_handler(event, context):
+    objects = list_input_objects(event['inputDir'])
+    input_bytes, input_objects = sum(size for _, size, _ in objects), len(objects)
+    model = calibrate(load_runs(event['historyUri'])) if event.get('historyUri') else CAPACITY_MODEL
+    # the incremental mode relies on the job bookmark of the Spark job
+    incremental = event.get('incremental') == 'true'
+    plan = plan_capacity(input_bytes, model, max_python_bytes=-1 if incremental else MAX_PYTHON_ENGINE_BYTES)
+    result = dict(
+        plan,
+        inputBytes=input_bytes,
+        inputObjects=input_objects,
+        estimatedRows=estimate_rows(objects, event['inputDir']),
+    )
+    if event.get('cacheUri'):
+        # incremental runs append to the outputs, so they are never served from the cache
+        input_fingerprint = None if incremental else fingerprint(objects, event.get('parameters', {}))
+        outputs = lookup_cache(event['cacheUri'], input_fingerprint)
+        result['fingerprint'] = input_fingerprint
+        if outputs is not None:
+            result.update(engine='cached', outputs=outputs)
+    print(f"{input_objects} input objects, {input_bytes} bytes, about {result['estimatedRows']} rows: "
+          f"using the {result['engine']} engine {result['workerType'] or ''} {result['numberOfWorkers'] or ''}")
+    return result
+
+
+def record_handler(event, context):
+    """
+    Record the outputs of a successful preprocessing run under the fingerprint of its inputs, and
+    its plan and actual runtime for the calibration of the capacity planner.
+    """
+    if event.get('fingerprint'):
+        record_cache(event['cacheUri'], event['fingerprint'], event['outputs'])
+    run = event.get('run') or {}
+    if event.get('historyUri') and run.get('engine') in ('python', 'spark'):
+        record_run(event['historyUri'], run)
+    return {'recorded': bool(event.get('fingerprint'))}
@@ -12,11 +12,22 @@ from aws_cdk import (
 
 from constructs import Construct
 
+import hashlib
+
 import boto3 
 my_region = boto3.session.Session().region_name
 my_acc_id = boto3.client('sts').get_caller_identity().get('Account')
 
 
+def script_version(*paths):
+    """Hash of the preprocessing scripts, part of the preprocessing cache fingerprint."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
 class CfnStack(cdk.Stack):
 
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -46,6 +57,14 @@ class CfnStack(cdk.Stack):
                 resources = ['arn:aws:s3:::*',]
             )
         )
+
+        # the preprocessing scripts publish the time, rows and bytes of their stages
+        glue_role.add_to_policy(
+            aws_iam.PolicyStatement(
+                actions = ['cloudwatch:PutMetricData'],
+                resources = ['*',]
+            )
+        )
         
         # Create a glue job for preprocessing
         glue_job = glue.Job(
@@ -57,37 +76,189 @@ class CfnStack(cdk.Stack):
                 glue_version=glue.GlueVersion.V2_0,
                 python_version=glue.PythonVersion.THREE,
                 script=glue.Code.from_asset(path="./code/glue_preprocessing.py"),
+                # the split writers, manifests and profile shared with the python shell job
+                extra_python_files=[glue.Code.from_asset(path="./code/preprocessing_output.py")],
             ),
             description="Prepare data for SageMaker training",
             default_arguments={
                 "--job-bookmark-option": "job-bookmark-enable",
                 "--enable-metrics": "",
-                "--additional-python-modules": "pyarrow==2,awswrangler==2.9.0,fsspec==0.7.4"
+                # split and write train/validation/test from the executors instead of the driver
+                "--SPLIT_MODE": "spark"
             },
-            worker_count=10,
-            worker_type=glue.WorkerType.STANDARD,
+            # the defaults for runs started without a plan, every run of the state machine
+            # gets the worker type and count picked by the capacity planner
+            worker_count=2,
+            worker_type=glue.WorkerType.G_1X,
+            max_concurrent_runs=1,
+            timeout=cdk.Duration.minutes(60),
+        )
+
+        # Create a python shell job running the same preprocessing with pandas, for inputs that fit in memory
+        python_job = glue.Job(
+            self,
+            "sagemaker-pipeline-PythonShellJob",
+            job_name="sagemaker-pipeline-PythonShellJob",
+            role=glue_role,
+            executable=glue.JobExecutable.python_shell(
+                glue_version=glue.GlueVersion.V1_0,
+                python_version=glue.PythonVersion.THREE_NINE,
+                script=glue.Code.from_asset(path="./code/churn_preprocessing.py"),
+                extra_python_files=[glue.Code.from_asset(path="./code/preprocessing_output.py")],
+            ),
+            description="Prepare small data sets for SageMaker training without Spark",
+            default_arguments={
+                "library-set": "analytics",
+                "--enable-metrics": "",
+            },
+            max_capacity=1,
             max_concurrent_runs=1,
             timeout=cdk.Duration.minutes(60),
         )
 
         # STEP FUNCTION
-        start_glue_job = sfn_tasks.GlueStartJobRun(
+        # GlueStartJobRun cannot set the capacity of a run, so the Spark job is started through the
+        # same glue:startJobRun.sync integration with the worker type and count of the plan
+        start_glue_job = sfn.CustomState(
             self,
             "StartGlueJobTask",
-            glue_job_name=glue_job.job_name,
+            state_json={
+                "Type": "Task",
+                "Resource": f"arn:{cdk.Aws.PARTITION}:states:::glue:startJobRun.sync",
+                "Parameters": {
+                    "JobName": glue_job.job_name,
+                    "WorkerType.$": "$.preprocessingEngine.workerType",
+                    "NumberOfWorkers.$": "$.preprocessingEngine.numberOfWorkers",
+                    "Arguments": {
+                        '--job-bookmark-option': 'job-bookmark-enable',
+                        '--enable-spark-ui': 'true',
+                        '--spark-event-logs-path.$': "$.body.sparkEventLogsUri",
+                        # Custom arguments below
+                        '--TRAIN_URI.$': "$.body.trainUri",
+                        '--VALIDATION_URI.$': "$.body.valUri",
+                        '--TEST_URI.$': "$.body.testUri",
+                        '--INPUT_DIR.$': "$.body.inputDir",
+                        '--OUTPUT_FORMAT.$': "$.body.outputFormat",
+                        '--COMPRESSION.$': "$.body.compression"
+                    }
+                },
+                "ResultPath": "$.taskresult",
+                "Catch": [
+                    {"ErrorEquals": ["States.ALL"], "ResultPath": "$.error-info", "Next": "SendFailure"}
+                ],
+            }
+        )
+
+        start_python_job = sfn_tasks.GlueStartJobRun(
+            self,
+            "StartPythonShellJobTask",
+            glue_job_name=python_job.job_name,
             integration_pattern=sfn.IntegrationPattern.RUN_JOB,
             result_path="$.taskresult",
             arguments=sfn.TaskInput.from_object(
                 {
-                    '--job-bookmark-option': 'job-bookmark-enable',
-                    '--additional-python-modules': 'pyarrow==2,awswrangler==2.9.0,fsspec==0.7.4',
-                    # Custom arguments below
                     '--TRAIN_URI': sfn.JsonPath.string_at("$.body.trainUri"),
                     '--VALIDATION_URI': sfn.JsonPath.string_at("$.body.valUri"),
                     '--TEST_URI': sfn.JsonPath.string_at("$.body.testUri"),
-                    '--INPUT_DIR': sfn.JsonPath.string_at("$.body.inputDir")
+                    '--INPUT_DIR': sfn.JsonPath.string_at("$.body.inputDir"),
+                    '--OUTPUT_FORMAT': sfn.JsonPath.string_at("$.body.outputFormat"),
+                    '--COMPRESSION': sfn.JsonPath.string_at("$.body.compression")
+                }
+            ),
+        )
+
+        # Pick the preprocessing engine from the size of the input objects
+        with open("lambda/select_preprocessing_engine.py", encoding="utf8") as fp:
+            lambda_select_engine_code = fp.read()
+
+        select_engine_lambda = lambda_.Function(
+            self,
+            "select_preprocessing_engine_function",
+            code=lambda_.InlineCode(lambda_select_engine_code),
+            handler="index.lambda_handler",
+            timeout=cdk.Duration.seconds(300),
+            runtime=lambda_.Runtime.PYTHON_3_8
+        )
+
+        # Add perms
+        select_engine_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:ListBucket',],
+            resources = ['arn:aws:s3:::*',]
+            ))
+        select_engine_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:GetObject', 's3:DeleteObject'],
+            resources = ['arn:aws:s3:::*/*',]
+            ))
+
+        # Record the fingerprint of the inputs once the processed data is written
+        record_cache_lambda = lambda_.Function(
+            self,
+            "record_preprocessing_cache_function",
+            code=lambda_.InlineCode(lambda_select_engine_code),
+            handler="index.record_handler",
+            timeout=cdk.Duration.seconds(60),
+            runtime=lambda_.Runtime.PYTHON_3_8
+        )
+        record_cache_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:PutObject',],
+            resources = ['arn:aws:s3:::*/*',]
+            ))
+
+        select_engine_task = sfn.Task(
+            self, "Select preprocessing engine",
+            task=sfn_tasks.InvokeFunction(
+                select_engine_lambda,
+                payload={
+                    "inputDir": sfn.JsonPath.string_at("$.body.inputDir"),
+                    # the callback passes the cache record location next to the processed data
+                    "cacheUri": sfn.JsonPath.string_at("$.body.cacheUri"),
+                    # the recorded runs calibrate the throughput of the capacity planner
+                    "historyUri": sfn.JsonPath.string_at("$.body.historyUri"),
+                    "parameters": {
+                        "scriptVersion": script_version("code/glue_preprocessing.py", "code/churn_preprocessing.py",
+                                                        "code/preprocessing_output.py"),
+                        "outputFormat": sfn.JsonPath.string_at("$.body.outputFormat"),
+                        "compression": sfn.JsonPath.string_at("$.body.compression"),
+                        "trainUri": sfn.JsonPath.string_at("$.body.trainUri"),
+                        "valUri": sfn.JsonPath.string_at("$.body.valUri"),
+                        "testUri": sfn.JsonPath.string_at("$.body.testUri")
+                    }
+                }
+            ),
+            result_path="$.preprocessingEngine"
+        )
+
+        record_cache_task = sfn.Task(
+            self, "Record preprocessing run",
+            task=sfn_tasks.InvokeFunction(
+                record_cache_lambda,
+                payload={
+                    "cacheUri": sfn.JsonPath.string_at("$.body.cacheUri"),
+                    "fingerprint": sfn.JsonPath.string_at("$.preprocessingEngine.fingerprint"),
+                    "outputs": {
+                        "trainUri": sfn.JsonPath.string_at("$.body.trainUri"),
+                        "valUri": sfn.JsonPath.string_at("$.body.valUri"),
+                        "testUri": sfn.JsonPath.string_at("$.body.testUri")
+                    },
+                    "historyUri": sfn.JsonPath.string_at("$.body.historyUri"),
+                    "run": {
+                        "engine": sfn.JsonPath.string_at("$.preprocessingEngine.engine"),
+                        "inputBytes": sfn.JsonPath.number_at("$.preprocessingEngine.inputBytes"),
+                        "workerType": sfn.JsonPath.string_at("$.preprocessingEngine.workerType"),
+                        "numberOfWorkers": sfn.JsonPath.number_at("$.preprocessingEngine.numberOfWorkers"),
+                        "estimatedSeconds": sfn.JsonPath.number_at("$.preprocessingEngine.estimatedSeconds"),
+                        "executionSeconds": sfn.JsonPath.number_at("$.taskresult.ExecutionTime")
+                    }
                 }
             ),
+            result_path=sfn.JsonPath.DISCARD
+        )
+
+        # the outputs of the last run were produced from the same inputs, no job needs to run
+        use_cached_output = sfn.Pass(
+            self, "Use cached preprocessing output",
+            result=sfn.Result.from_object({"JobRunState": "SUCCEEDED", "ExecutionTime": 0}),
+            result_path="$.taskresult"
         )
 
         send_success = sfn_tasks.CallAwsService(
@@ -126,14 +297,33 @@ class CfnStack(cdk.Stack):
                 },
         )
 
-        definition = start_glue_job.add_catch(
+        start_python_job.add_catch(
+            send_failure,
+            result_path="$.error-info",
+        )
+
+        definition = select_engine_task.add_catch(
             send_failure,
             result_path="$.error-info",
+        ).next(
+            sfn.Choice(self, "Small input?")
+            .when(
+                sfn.Condition.string_equals("$.preprocessingEngine.engine", "cached"),
+                use_cached_output,
+            )
+            .when(
+                sfn.Condition.string_equals("$.preprocessingEngine.engine", "python"),
+                start_python_job,
+            )
+            .otherwise(
+                start_glue_job,
+            )
+            .afterwards()
         ).next(
             sfn.Choice(self, "Job successful?")
             .when(
                 sfn.Condition.string_equals("$.taskresult.JobRunState", "SUCCEEDED"),
-                send_success,
+                record_cache_task.next(send_success),
             )
             .otherwise(
                 send_failure,
@@ -144,6 +334,14 @@ class CfnStack(cdk.Stack):
             self, "Preprocessing",
             definition=definition,
         )
+        state_machine.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions = ['glue:StartJobRun', 'glue:GetJobRun', 'glue:GetJobRuns', 'glue:BatchStopJobRun'],
+                resources = [
+                    f'arn:aws:glue:{my_region}:{my_acc_id}:job/{glue_job.job_name}',
+                ]
+            )
+        )
 
         ## Define a Lambda Functions
         with open("lambda/execute_function.py", encoding="utf8") as fp:
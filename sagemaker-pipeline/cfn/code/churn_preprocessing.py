@@ -0,0 +1,293 @@
+"""
+Lightweight pandas engine for the churn preprocessing job.
+
+It runs the same transformation and split as glue_preprocessing.py without Spark, so inputs
+that fit in memory can be processed in a Glue Python shell job, a Lambda function or on a
+laptop. For the same input rows it writes the same bytes as the driver split mode of the
+Spark job (SPLIT_MODE=driver).
+
+    python churn_preprocessing.py --INPUT_DIR ../../data --PROCESSED_DIR /tmp/processed
+
+Paths may be local or s3:// URIs. The output locations follow the argument conventions of
+the Spark job: --PROCESSED_DIR, --TRAIN_DIR/--VAL_DIR/--TEST_DIR or
+--TRAIN_URI/--VALIDATION_URI/--TEST_URI. With --WINDOW_DAYS the splits go to a snapshot_date
+partition of each split directory, see WINDOW_DAYS in glue_preprocessing.py. The splits,
+manifests and profile are written by preprocessing_output.py, which the job gets with
+--extra-py-files.
+"""
+import argparse
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from preprocessing_output import (
+    pandas_profile, partition_path, profile_path, write_profile, write_shards, write_split, write_window_manifest,
+)
+
+# Output columns in order, with the raw columns they are parsed from
+OUTPUT_COLUMNS = [
+    'Churn', 'Account_Length', 'customerID', 'Int_l_Plan', 'VMail_Plan', 'VMail_Message', 'Day_Mins',
+    'Day_Calls', 'Eve_Mins', 'Eve_Calls', 'Night_Mins', 'Night_Calls', 'Intl_Mins', 'Intl_Calls',
+    'Intl_Charge', 'CustServ_Calls', 'pastSenti_nut', 'pastSenti_pos', 'pastSenti_neg', 'mth_remain',
+]
+LONG_COLUMNS = [
+    'Account_Length', 'customerID', 'VMail_Message', 'Day_Calls', 'Eve_Calls', 'Night_Calls', 'Intl_Calls',
+    'CustServ_Calls', 'pastSenti_nut', 'pastSenti_pos', 'pastSenti_neg', 'mth_remain',
+]
+FLOAT_COLUMNS = ['Day_Mins', 'Eve_Mins', 'Night_Mins', 'Intl_Mins', 'Intl_Charge']
+YES_NO_COLUMNS = ['Int_l_Plan', 'VMail_Plan']
+
+# see SEGMENT_COLUMNS in glue_preprocessing.py, the raw columns the segment keys are taken from
+SEGMENT_COLUMNS = ['segment_State', 'segment_Area_Code', 'segment_Int_l_Plan', 'segment_Account_Length']
+RAW_SEGMENT_COLUMNS = ['State', 'Area_Code']
+ACCOUNT_LENGTH_BUCKET = 50
+ACCOUNT_LENGTH_BUCKETS = 5
+
+# strings a Spark cast to boolean turns into false
+FALSE_STRINGS = ['f', 'false', 'n', 'no', '0']
+
+# SplitMix64 constants, see customer_draw in glue_preprocessing.py
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+MIX_1 = 0xBF58476D1CE4E5B9
+MIX_2 = 0x94D049BB133111EB
+
+CSV_EXTENSIONS = ('.csv',)
+
+
+def _s3():
+    import boto3
+    return boto3.client('s3')
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_inputs(input_dir):
+    """Input CSV files under a local path or an S3 prefix, sorted by name."""
+    if input_dir.startswith('s3://'):
+        bucket, prefix = _split_s3_uri(input_dir)
+        keys = []
+        for page in _s3().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            keys.extend(
+                item['Key'] for item in page.get('Contents', [])
+                if item['Size'] > 0 and item['Key'].lower().endswith(CSV_EXTENSIONS)
+            )
+        return [f"s3://{bucket}/{key}" for key in sorted(keys)]
+    if os.path.isfile(input_dir):
+        return [input_dir]
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(input_dir)
+        for name in names
+        if name.lower().endswith(CSV_EXTENSIONS)
+    )
+
+
+def read_raw(paths):
+    """Read only the columns the job uses, as strings, with empty fields as missing values like Spark."""
+    frames = []
+    for path in paths:
+        if path.startswith('s3://'):
+            bucket, key = _split_s3_uri(path)
+            source = _s3().get_object(Bucket=bucket, Key=key)['Body']
+        else:
+            source = path
+        frames.append(pd.read_csv(source, usecols=OUTPUT_COLUMNS + RAW_SEGMENT_COLUMNS, dtype=str,
+                                  keep_default_na=False, na_values=['']))
+    return pd.concat(frames, ignore_index=True)
+
+
+def to_long(values):
+    """
+    Cast like Spark to a long, truncating any fraction. Columns with missing values stay
+    float64, which is what Spark's toPandas gives for nullable longs.
+    """
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.dtype.kind == 'f':
+        numbers = np.trunc(numbers)
+        if not numbers.isna().any():
+            numbers = numbers.astype(np.int64)
+    return numbers
+
+
+def encode_features(raw):
+    """pandas twin of encode_features in glue_preprocessing.py, with the dtypes toPandas gives."""
+    columns = {}
+    for name in OUTPUT_COLUMNS:
+        if name == 'Churn':
+            columns[name] = np.where(raw[name].str.lower().isin(FALSE_STRINGS), 0, 1).astype(np.int32)
+        elif name in YES_NO_COLUMNS:
+            columns[name] = np.where(raw[name] == 'no', 0, 1).astype(np.int32)
+        elif name in LONG_COLUMNS:
+            columns[name] = to_long(raw[name])
+        elif name in FLOAT_COLUMNS:
+            columns[name] = pd.to_numeric(raw[name], errors='coerce').astype(np.float32)
+        else:
+            columns[name] = raw[name]
+    columns['segment_State'] = raw['State']
+    columns['segment_Area_Code'] = raw['Area_Code']
+    columns['segment_Int_l_Plan'] = raw['Int_l_Plan']
+    bucket = np.minimum(np.floor(columns['Account_Length'] / ACCOUNT_LENGTH_BUCKET), ACCOUNT_LENGTH_BUCKETS - 1)
+    columns['segment_Account_Length'] = to_long(bucket * ACCOUNT_LENGTH_BUCKET)
+    return pd.DataFrame(columns, index=raw.index)
+
+
+def customer_draw_np(customer_ids, seed):
+    """Uniform [0, 1) number per customerID, identical to customer_draw_np in glue_preprocessing.py."""
+    missing = pd.isna(customer_ids)
+    z = np.where(missing, 0, customer_ids).astype(np.int64).view(np.uint64)
+    z = z + np.uint64(((seed + 1) * GOLDEN_GAMMA) % 2 ** 64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(MIX_1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(MIX_2)
+    z = z ^ (z >> np.uint64(31))
+    return np.where(missing, np.nan, (z >> np.uint64(11)).astype(np.float64) / 2.0 ** 53)
+
+
+def split_frame(df, split_strategy='customer_hash', split_seed=42, split_ratios=(0.8, 0.19, 0.01)):
+    """Split like driver_split in glue_preprocessing.py, returns (train_df, val_df, test_df)."""
+    _, val_ratio, test_ratio = split_ratios
+    test_cut = test_ratio
+    val_cut = test_ratio + val_ratio
+    if split_strategy == 'customer_hash':
+        u = customer_draw_np(df['customerID'].to_numpy(), split_seed)
+        return df[~(u < val_cut)], df[(u >= test_cut) & (u < val_cut)], df[u < test_cut]
+    if split_strategy != 'random':
+        raise ValueError(f"Unknown split strategy {split_strategy}, expected 'customer_hash' or 'random'")
+    val = df.sample(frac=val_cut, axis=0, random_state=split_seed)
+    test_df = val.sample(frac=test_ratio / val_cut if val_cut else 0, axis=0, random_state=split_seed)
+    return df.drop(index=val.index), val.drop(index=test_df.index), test_df
+
+
+def output_paths(processed_dir=None, train_dir=None, val_dir=None, test_dir=None,
+                 train_uri=None, val_uri=None, test_uri=None, output_format='csv', compression='none'):
+    """Resolve the train/validation/test file paths the way the Spark job does for each argument style."""
+    paths = _output_paths(processed_dir, train_dir, val_dir, test_dir, train_uri, val_uri, test_uri, output_format)
+    if compression == 'gzip' and output_format == 'csv':
+        return tuple(f"{path}.gz" for path in paths)
+    return paths
+
+
+def _output_paths(processed_dir, train_dir, val_dir, test_dir, train_uri, val_uri, test_uri, output_format):
+    if processed_dir:
+        base = processed_dir.rstrip('/')
+        return (f"{base}/train/train.{output_format}", f"{base}/validation/validation.{output_format}",
+                f"{base}/test/test.{output_format}")
+    if train_dir and val_dir and test_dir:
+        return (f"{train_dir}/train.{output_format}", f"{val_dir}/validation.{output_format}",
+                f"{test_dir}/test.{output_format}")
+    if train_uri and val_uri and test_uri:
+        return train_uri, val_uri, test_uri
+    raise ValueError("Pass PROCESSED_DIR, TRAIN_DIR/VAL_DIR/TEST_DIR or TRAIN_URI/VALIDATION_URI/TEST_URI")
+
+
+def run(input_dir, train_path, val_path, test_path, output_format='csv',
+        split_strategy='customer_hash', split_seed=42, split_ratios=(0.8, 0.19, 0.01), compression='none',
+        shards=1, window_days=0, snapshot_date=None):
+    """
+    Preprocess every input CSV and write the three splits, returns the row count of each split.
+    With more than one shard, train and validation are directories of part files, see SHARDS in
+    glue_preprocessing.py. With window_days, the splits go to the snapshot_date partition (today
+    by default) and the manifests list the partitions of the window, see WINDOW_DAYS.
+    """
+    if output_format not in ('csv', 'parquet'):
+        raise ValueError(f"Unknown output format {output_format}, expected 'csv' or 'parquet'")
+    if compression not in ('none', 'gzip', 'zstd'):
+        raise ValueError(f"Unknown compression {compression}, expected 'none', 'gzip' or 'zstd'")
+    if compression == 'zstd' and output_format != 'parquet':
+        raise ValueError("zstd compression requires the parquet output format, training channels only decompress gzip")
+    if shards < 1:
+        raise ValueError(f"The number of shards must be at least 1, got {shards}")
+    if window_days < 0:
+        raise ValueError(f"The window must be at least 0 days, got {window_days}")
+    snapshot_date = snapshot_date or date.today()
+    paths = list_inputs(input_dir)
+    if not paths:
+        raise ValueError(f"No input CSV files found under {input_dir}")
+
+    data_final = encode_features(read_raw(paths))
+    train_df, val_df, test_df = split_frame(data_final, split_strategy, split_seed, split_ratios)
+    train_df = train_df.drop(columns=SEGMENT_COLUMNS)
+    val_df = val_df.drop(columns=SEGMENT_COLUMNS)
+    write_profile(profile_path(train_path), pandas_profile({'train': train_df, 'validation': val_df, 'test': test_df}))
+
+    # the train file keeps its header, validation and test have none
+    outputs = (('train', train_df, train_path, True), ('validation', val_df, val_path, False))
+    for name, df, split_path, header in outputs:
+        path = partition_path(split_path, snapshot_date) if window_days else split_path
+        if shards > 1:
+            write_shards(df, path, name, output_format, header, compression, shards, manifest=not window_days)
+        else:
+            write_split(df, path, output_format, header=header, compression=compression)
+    write_split(test_df, partition_path(test_path, snapshot_date) if window_days else test_path, output_format,
+                header=False, compression=compression)
+    if window_days:
+        for name, split_path in (('train', train_path), ('validation', val_path), ('test', test_path)):
+            write_window_manifest(split_path, name, snapshot_date, window_days)
+    return {'train': len(train_df), 'validation': len(val_df), 'test': len(test_df)}
+
+
+def parse_ratios(value):
+    ratios = tuple(float(r) for r in value.split(','))
+    if len(ratios) != 3 or min(ratios) < 0 or abs(sum(ratios) - 1) > 1e-6:
+        raise ValueError(f"Split ratios must be three non-negative shares adding up to 1, got {value}")
+    return ratios
+
+
+def parse_snapshot_date(value):
+    """A date from "YYYY-MM-DD" or a timestamp starting with it."""
+    return date.fromisoformat(value[:10])
+
+
+def lambda_handler(event, context):
+    """Lambda entry point, the event holds the job arguments without the leading dashes."""
+    train_path, val_path, test_path = output_paths(
+        event.get('PROCESSED_DIR'), event.get('TRAIN_DIR'), event.get('VAL_DIR'), event.get('TEST_DIR'),
+        event.get('TRAIN_URI'), event.get('VALIDATION_URI'), event.get('TEST_URI'),
+        event.get('OUTPUT_FORMAT', 'csv'), event.get('COMPRESSION', 'none'),
+    )
+    counts = run(
+        event['INPUT_DIR'], train_path, val_path, test_path,
+        output_format=event.get('OUTPUT_FORMAT', 'csv'),
+        split_strategy=event.get('SPLIT_STRATEGY', 'customer_hash'),
+        split_seed=int(event.get('SPLIT_SEED', 42)),
+        split_ratios=parse_ratios(event.get('SPLIT_RATIOS', '0.8,0.19,0.01')),
+        compression=event.get('COMPRESSION', 'none'),
+        shards=int(event.get('SHARDS', 1)),
+        window_days=int(event.get('WINDOW_DAYS', 0)),
+        snapshot_date=parse_snapshot_date(event['SNAPSHOT_DATE']) if event.get('SNAPSHOT_DATE') else None,
+    )
+    return {'statusCode': 200, 'rows': counts, 'train': train_path, 'validation': val_path, 'test': test_path}
+
+
+def main(argv=None):
+    # Glue Python shell jobs pass their own arguments as well, parse_known_args ignores them
+    parser = argparse.ArgumentParser(description="Preprocess the churn data with pandas")
+    parser.add_argument('--INPUT_DIR', required=True)
+    for name in ('PROCESSED_DIR', 'TRAIN_DIR', 'VAL_DIR', 'TEST_DIR', 'TRAIN_URI', 'VALIDATION_URI', 'TEST_URI'):
+        parser.add_argument(f'--{name}')
+    parser.add_argument('--OUTPUT_FORMAT', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--SPLIT_STRATEGY', default='customer_hash', choices=['customer_hash', 'random'])
+    parser.add_argument('--SPLIT_SEED', type=int, default=42)
+    parser.add_argument('--SPLIT_RATIOS', type=parse_ratios, default=(0.8, 0.19, 0.01))
+    parser.add_argument('--COMPRESSION', default='none', choices=['none', 'gzip', 'zstd'])
+    parser.add_argument('--SHARDS', type=int, default=1)
+    parser.add_argument('--WINDOW_DAYS', type=int, default=0)
+    parser.add_argument('--SNAPSHOT_DATE', type=parse_snapshot_date)
+    args, _ = parser.parse_known_args(argv)
+
+    train_path, val_path, test_path = output_paths(
+        args.PROCESSED_DIR, args.TRAIN_DIR, args.VAL_DIR, args.TEST_DIR,
+        args.TRAIN_URI, args.VALIDATION_URI, args.TEST_URI, args.OUTPUT_FORMAT, args.COMPRESSION,
+    )
+    counts = run(args.INPUT_DIR, train_path, val_path, test_path, args.OUTPUT_FORMAT,
+                 args.SPLIT_STRATEGY, args.SPLIT_SEED, args.SPLIT_RATIOS, args.COMPRESSION, args.SHARDS,
+                 args.WINDOW_DAYS, args.SNAPSHOT_DATE)
+    print(f"Wrote {counts} rows to {train_path}, {val_path} and {test_path}")
+
+
+if __name__ == '__main__':
+    main()
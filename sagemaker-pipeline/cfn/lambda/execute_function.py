@@ -55,6 +55,14 @@ def lambda_handler(event, context):
             valUri = arguments["valUri"]
             testUri = arguments["testUri"]
             input_dir = arguments['inputDir']
+            output_format = arguments.get('outputFormat', 'csv')
+            compression = arguments.get('compression', 'none')
+            # fingerprint of the inputs the processed data was produced from, next to the splits
+            cache_uri = arguments.get('cacheUri', trainUri.rsplit('/', 2)[0] + '/cache/preprocessing.json')
+            # runs recorded to calibrate the capacity planner of the preprocessing job
+            history_uri = arguments.get('historyUri', trainUri.rsplit('/', 2)[0] + '/cache/runs/')
+            # Spark event logs of the preprocessing job, for benchmarks/spark_event_log.py
+            event_logs_uri = arguments.get('sparkEventLogsUri', trainUri.rsplit('/', 2)[0] + '/spark-event-logs/')
             
             logger.info('Trigger execution of state machine [{}]'.format(sm_arn))
 
@@ -66,6 +74,11 @@ def lambda_handler(event, context):
                     "valUri": valUri,
                     "testUri": testUri,
                     'inputDir': input_dir,
+                    'outputFormat': output_format,
+                    'compression': compression,
+                    'cacheUri': cache_uri,
+                    'historyUri': history_uri,
+                    'sparkEventLogsUri': event_logs_uri,
                     "token": token
                 }
             }
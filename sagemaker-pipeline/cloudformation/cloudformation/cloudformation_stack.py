@@ -42,13 +42,11 @@ class CloudformationStack(Stack):
             ))
 
         ## Start Glue Job
-        with open("lambda/execute_glue_job.py", encoding="utf8") as fp:
-            lambda_exec_glue_code = fp.read()
-        
+        # deployed with select_preprocessing_engine.py, the capacity planner shared with the other samples
         lambdaFn2 = lambda_.Function(
             self,
             "execute_glue_job_function",
-            code=lambda_.InlineCode(lambda_exec_glue_code),
+            code=lambda_.Code.from_asset("lambda"),
             handler="execute_glue_job.lambda_handler",
             timeout=core.Duration.seconds(300),
             runtime=lambda_.Runtime.PYTHON_3_8
@@ -59,20 +57,29 @@ class CloudformationStack(Stack):
             actions = ['glue:StartJobRun',],
             resources = [f'arn:aws:glue:{my_region}:{my_acc_id}:job:*',]
             ))
+
+        # the input prefix is listed to size the Glue job
+        lambdaFn2.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:ListBucket',],
+            resources = ['arn:aws:s3:::*',]
+            ))
+
+        # the recorded runs under cache/runs/ of the processed data calibrate the capacity planner
+        lambdaFn2.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:GetObject',],
+            resources = ['arn:aws:s3:::*/cache/runs/*',]
+            ))
         
         lambdaFn2.add_to_role_policy(aws_iam.PolicyStatement(
             actions = ['sagemaker:SendPipelineExecutionStepFailure',],
             resources = [f'arn:aws:sagemaker:{my_region}:{my_acc_id}:pipeline-execution:*',]
             ))
 
-        # Create a function for checking the status of Glue job
-        with open("lambda/check_glue_job.py", encoding="utf8") as fp:
-            lambda_check_glue_code = fp.read()
-        
+        # Create a function for checking the status of Glue job, it records the runs that succeed
         lambdaFn3 = lambda_.Function(
             self,
             "check_glue_job_function",
-            code=lambda_.InlineCode(lambda_check_glue_code),
+            code=lambda_.Code.from_asset("lambda"),
             handler="check_glue_job.lambda_handler",
             timeout=core.Duration.seconds(300),
             runtime=lambda_.Runtime.PYTHON_3_8
@@ -94,6 +101,11 @@ class CloudformationStack(Stack):
             resources = [f'arn:aws:sagemaker:{my_region}:{my_acc_id}:pipeline-execution:*',]
             ))
 
+        lambdaFn3.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:PutObject',],
+            resources = ['arn:aws:s3:::*/cache/runs/*',]
+            ))
+
         # Create a step functions for preprocessing with Glue
         start_glue_job = sfn.Task(
             self, "execute_glue",
@@ -10,6 +10,9 @@ import datetime as dt
 
 import logging
 
+# the capacity planner of the other samples, deployed next to this file
+import select_preprocessing_engine
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
@@ -29,6 +32,7 @@ def check_job_status(job_details):
     json_data = json.loads(json.dumps(job_response, default=datetimeconverter))
     # IMPORTANT update the status of the job based on the job_response (e.g RUNNING, SUCCEEDED, FAILED)
     job_details['jobStatus'] = json_data.get('JobRun').get('JobRunState')
+    job_details['executionSeconds'] = json_data.get('JobRun').get('ExecutionTime')
 
     response = {
         'jobDetails': job_details
@@ -56,6 +60,16 @@ def lambda_handler(event, context):
         response = check_job_status(job_details)  # custom user code called
         
         if response['jobDetails']['jobStatus'] == "SUCCEEDED":
+            # the plan and actual runtime of the run, for the calibration of the capacity planner
+            if job_details.get('historyUri'):
+                select_preprocessing_engine.record_run(job_details['historyUri'], {
+                    'engine': 'spark',
+                    'inputBytes': job_details['inputBytes'],
+                    'workerType': job_details['workerType'],
+                    'numberOfWorkers': job_details['numberOfWorkers'],
+                    'estimatedSeconds': job_details['estimatedSeconds'],
+                    'executionSeconds': job_details['executionSeconds'],
+                })
             sagemaker.send_pipeline_execution_step_success(
                 CallbackToken=job_details['token'],
                 OutputParameters=[
@@ -56,6 +56,8 @@ def lambda_handler(event, context):
             target_job = arguments["targetJob"]
             processed_dir = arguments["processedDir"]
             input_dir = arguments['inputDir']
+            output_format = arguments.get('outputFormat', 'csv')
+            compression = arguments.get('compression', 'none')
             sm_arn = arguments["stateMachineArn"]
             
             logger.info('Trigger execution of state machine [{}]'.format(sm_arn))
@@ -67,6 +69,8 @@ def lambda_handler(event, context):
                     "targetJob": target_job,
                     "processedDir": processed_dir,
                     'inputDir': input_dir,
+                    'outputFormat': output_format,
+                    'compression': compression,
                     "token": token
                 }
             }
@@ -9,6 +9,9 @@ import datetime as dt
 
 import logging
 
+# the capacity planner of the other samples, deployed next to this file
+import select_preprocessing_engine
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
@@ -40,20 +43,35 @@ def lambda_handler(event, context):
         job_name = event['body']['targetJob']
         processed_dir = event['body']['processedDir']
         input_dir = event['body']['inputDir']
+        output_format = event['body'].get('outputFormat', 'csv')
+        compression = event['body'].get('compression', 'none')
+        # gzip CSV splits are written as *.csv.gz
+        extension = f"{output_format}.gz" if compression == 'gzip' and output_format == 'csv' else output_format
         token = event['body']['token']
 
+        # the recorded runs calibrate the throughput of the capacity planner, see check_glue_job.py
+        history_uri = processed_dir + "cache/runs/"
+        input_bytes, _ = select_preprocessing_engine.input_size(input_dir)
+        model = select_preprocessing_engine.calibrate(select_preprocessing_engine.load_runs(history_uri))
+        # this pipeline only has the Spark job
+        plan = select_preprocessing_engine.plan_capacity(input_bytes, model, max_python_bytes=-1)
+        worker_type, number_of_workers = plan['workerType'], plan['numberOfWorkers']
+        logger.info('{} input bytes: starting {} {} workers'.format(input_bytes, number_of_workers, worker_type))
+
         # Submitting a new Glue Job
         job_response = client.start_job_run(
             JobName=job_name,
             Arguments={
                 # Specify any arguments needed based on bucket and keys (e.g. input/output S3 locations)
                 '--job-bookmark-option': 'job-bookmark-enable',
-                '--additional-python-modules': 'pyarrow==2,awswrangler==2.9.0,fsspec==0.7.4',
                 # Custom arguments below
                 '--PROCESSED_DIR': processed_dir,
                 '--INPUT_DIR': input_dir,
+                '--OUTPUT_FORMAT': output_format,
+                '--COMPRESSION': compression,
             },
-            MaxCapacity=2.0
+            WorkerType=worker_type,
+            NumberOfWorkers=number_of_workers
         )
 
         logger.info('Response is [{}]'.format(job_response))
@@ -65,9 +83,14 @@ def lambda_handler(event, context):
             "jobName": job_name,
             "jobRunId": json_data.get('JobRunId'),
             "jobStatus": 'STARTED',
-            "trainUri": processed_dir+"train/train.csv",
-            "validationUri": processed_dir+"validation/validation.csv",
-            "testUri": processed_dir+"test/test.csv",
+            "workerType": worker_type,
+            "numberOfWorkers": number_of_workers,
+            "inputBytes": input_bytes,
+            "estimatedSeconds": plan['estimatedSeconds'],
+            "historyUri": history_uri,
+            "trainUri": processed_dir+f"train/train.{extension}",
+            "validationUri": processed_dir+f"validation/validation.{extension}",
+            "testUri": processed_dir+f"test/test.{extension}",
             "token": token
         }
 
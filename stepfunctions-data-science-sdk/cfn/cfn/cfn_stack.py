@@ -14,11 +14,22 @@ from constructs import Construct
 
 import sagemaker
 
+import hashlib
+
 import boto3 
 my_region = boto3.session.Session().region_name
 my_acc_id = boto3.client('sts').get_caller_identity().get('Account')
 resource_s3 = boto3.resource("s3")
 
+
+def script_version(*paths):
+    """Hash of the preprocessing scripts, part of the preprocessing cache fingerprint."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
 class CfnStack(cdk.Stack):
 
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -40,6 +51,98 @@ class CfnStack(cdk.Stack):
             min_length=3,
         )
 
+        output_format = cdk.CfnParameter(
+            self,
+            "OutputFormat",
+            type="String",
+            description="Format of the processed train/validation/test splits",
+            allowed_values=["csv", "parquet"],
+            default="csv",
+        )
+
+        incremental = cdk.CfnParameter(
+            self,
+            "IncrementalPreprocessing",
+            type="String",
+            description="Only preprocess input files added since the last run and append them to the processed splits",
+            allowed_values=["true", "false"],
+            default="false",
+        )
+
+        # XGBoost training content type for each output format of the preprocessing job
+        content_types = cdk.CfnMapping(
+            self,
+            "ContentTypes",
+            mapping={
+                "csv": {"ContentType": "text/csv"},
+                "parquet": {"ContentType": "application/x-parquet"},
+            }
+        )
+        content_type = content_types.find_in_map(output_format.value_as_string, "ContentType")
+
+        # Compression of the processed splits, set with `cdk deploy -c compression=gzip`. It is a
+        # context value rather than a parameter because the channel CompressionType is fixed at synth time.
+        # Gzip CSV splits are read with CompressionType Gzip, zstd is only a Parquet codec.
+        compression = self.node.try_get_context("compression") or "none"
+        if compression not in ("none", "gzip", "zstd"):
+            raise ValueError(f"Unknown compression {compression}, expected none, gzip or zstd")
+        if compression != "none":
+            compression_rule = cdk.CfnRule(self, "CompressionMatchesOutputFormat")
+            compression_rule.add_assertion(
+                cdk.Fn.condition_equals(output_format.value_as_string, "csv" if compression == "gzip" else "parquet"),
+                f"compression={compression} requires OutputFormat={'csv' if compression == 'gzip' else 'parquet'}",
+            )
+        channel_compression = sfn_tasks.CompressionType.GZIP if compression == "gzip" else sfn_tasks.CompressionType.NONE
+
+        # Number of part files of the train and validation splits, set with `cdk deploy -c shards=8`.
+        # Above 1 the training channels read the manifest files the preprocessing job writes next to
+        # the splits, and with `-c train_instance_count=N` every training instance only downloads its
+        # share of the train part files. Both are context values because the channel data type and
+        # distribution are fixed at synth time.
+        shards = int(self.node.try_get_context("shards") or 1)
+        train_instance_count = int(self.node.try_get_context("train_instance_count") or 1)
+        if shards < 1 or train_instance_count < 1:
+            raise ValueError("shards and train_instance_count must be at least 1")
+        # Days of snapshots the model is trained and evaluated on, set with `cdk deploy -c window_days=30`.
+        # Above 0 every run writes its splits to a snapshot_date partition and the channels read the
+        # manifests of the partitions in the window; 0 keeps the single location per split.
+        window_days = int(self.node.try_get_context("window_days") or 0)
+        if window_days < 0:
+            raise ValueError("window_days must be at least 0")
+        # Merge the small files of the processed splits after every preprocessing run, set with
+        # `cdk deploy -c compaction=true`. The compaction job swaps the merged files in through the
+        # manifests, so the training and evaluation channels read the manifests.
+        compaction = (self.node.try_get_context("compaction") or "false") == "true"
+        # Streaming evaluation, set with `cdk deploy -c evaluation_chunk_rows=1000000`: the processing
+        # job scores the test split in chunks of this many rows into a metric state of constant size.
+        # With `-c evaluation_instance_count=N` the job shards the test files between N instances
+        # (ShardedByS3Key) that always stream, and a Lambda function merges their states.
+        evaluation_chunk_rows = int(self.node.try_get_context("evaluation_chunk_rows") or 0)
+        evaluation_instance_count = int(self.node.try_get_context("evaluation_instance_count") or 1)
+        if evaluation_chunk_rows < 0 or evaluation_instance_count < 1:
+            raise ValueError("evaluation_chunk_rows must be at least 0 and evaluation_instance_count at least 1")
+        # evaluation.json holds a downsampled ROC curve, `cdk deploy -c full_roc_curve=true` also
+        # writes the full curve to roc_curve.npz next to it
+        full_roc_curve = (self.node.try_get_context("full_roc_curve") or "false") == "true"
+        # The accuracy gate compares the accuracy of the test set with the threshold, `cdk deploy -c
+        # gate_on_lower_bound=true` compares the lower bound of its bootstrap confidence interval instead
+        gate_on_lower_bound = (self.node.try_get_context("gate_on_lower_bound") or "false") == "true"
+        # settings of evaluation.py in the processing job and the Lambda functions, `cdk deploy -c
+        # bootstrap_resamples=0` skips the bootstrap confidence intervals of summary.json
+        bootstrap_resamples = self.node.try_get_context("bootstrap_resamples")
+        evaluation_environment = {
+            "FULL_ROC_CURVE": str(full_roc_curve).lower(),
+            "BOOTSTRAP_RESAMPLES": str(1000 if bootstrap_resamples is None else int(bootstrap_resamples)),
+        }
+        if shards > 1 or window_days or compaction:
+            channel_data_type = sfn_tasks.S3DataType.MANIFEST_FILE
+            train_location, val_location = "$.glueTaskResult.train_manifest", "$.glueTaskResult.val_manifest"
+        else:
+            channel_data_type = sfn_tasks.S3DataType.S3_PREFIX
+            train_location, val_location = "$.glueTaskResult.train_dir", "$.glueTaskResult.val_dir"
+        train_distribution = sfn_tasks.S3DataDistributionType.SHARDED_BY_S3_KEY if shards > 1 and train_instance_count > 1 \
+            else sfn_tasks.S3DataDistributionType.FULLY_REPLICATED
+
         artifact_bucket = s3.Bucket.from_bucket_name(
             self,
             "ArtifactBucket",
@@ -65,6 +168,14 @@ class CfnStack(cdk.Stack):
             )
         )
 
+        # the preprocessing scripts publish the time, rows and bytes of their stages
+        glue_role.add_to_policy(
+            aws_iam.PolicyStatement(
+                actions = ['cloudwatch:PutMetricData'],
+                resources = ['*',]
+            )
+        )
+
         # Create a glue job for preprocessing
         glue_job = glue.Job(
             self,
@@ -75,47 +186,278 @@ class CfnStack(cdk.Stack):
                 glue_version=glue.GlueVersion.V2_0,
                 python_version=glue.PythonVersion.THREE,
                 script=glue.Code.from_asset(path="./code/glue_preprocessing.py"),
+                # the split writers, manifests and profile shared with the python shell job
+                extra_python_files=[glue.Code.from_asset(path="./code/preprocessing_output.py")],
             ),
             description="Prepare data for SageMaker training",
             default_arguments={
                 "--job-bookmark-option": "job-bookmark-enable",
                 "--enable-metrics": "",
-                "--additional-python-modules": "pyarrow==2,awswrangler==2.9.0,fsspec==0.7.4"
+                # Spark event logs of every run, for benchmarks/spark_event_log.py
+                "--enable-spark-ui": "true",
+                "--spark-event-logs-path": f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/spark-event-logs/",
+                # split and write train/validation/test from the executors instead of the driver
+                "--SPLIT_MODE": "spark"
+            },
+            # the defaults for runs started without a plan, every run of the state machine
+            # gets the worker type and count picked by the capacity planner
+            worker_count=2,
+            worker_type=glue.WorkerType.G_1X,
+            max_concurrent_runs=2,
+            timeout=cdk.Duration.minutes(60),
+        )
+
+        # Create a python shell job running the same preprocessing with pandas, for inputs that fit in memory
+        python_job = glue.Job(
+            self,
+            "stepdfunctions-datascience-PythonShellJob",
+            job_name="stepdfunctions-datascience-PythonShellJob",
+            role=glue_role,
+            executable=glue.JobExecutable.python_shell(
+                glue_version=glue.GlueVersion.V1_0,
+                python_version=glue.PythonVersion.THREE_NINE,
+                script=glue.Code.from_asset(path="./code/churn_preprocessing.py"),
+                extra_python_files=[glue.Code.from_asset(path="./code/preprocessing_output.py")],
+            ),
+            description="Prepare small data sets for SageMaker training without Spark",
+            default_arguments={
+                "library-set": "analytics",
+                "--enable-metrics": "",
             },
-            worker_count=10,
-            worker_type=glue.WorkerType.STANDARD,
+            max_capacity=1,
             max_concurrent_runs=2,
             timeout=cdk.Duration.minutes(60),
         )
 
+        # Create a python shell job merging the small files the preprocessing runs pile up
+        compaction_job = glue.Job(
+            self,
+            "stepdfunctions-datascience-CompactionJob",
+            job_name="stepdfunctions-datascience-CompactionJob",
+            role=glue_role,
+            executable=glue.JobExecutable.python_shell(
+                glue_version=glue.GlueVersion.V1_0,
+                python_version=glue.PythonVersion.THREE_NINE,
+                script=glue.Code.from_asset(path="./code/compact_processed.py"),
+                extra_python_files=[glue.Code.from_asset(path="./code/churn_preprocessing.py"),
+                                    glue.Code.from_asset(path="./code/preprocessing_output.py")],
+            ),
+            description="Merge the small files of the processed data",
+            default_arguments={
+                "library-set": "analytics",
+                "--enable-metrics": "",
+            },
+            max_capacity=1,
+            # runs must not overlap, each one rewrites the manifests
+            max_concurrent_runs=1,
+            timeout=cdk.Duration.minutes(60),
+        )
+
         input_dir = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/input"
         train_dir = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/train"
         val_dir = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/val"
         test_dir = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/test"
+        # written by the preprocessing job when shards > 1 or window_days > 0, and by the compaction job
+        train_manifest = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/manifests/train.manifest"
+        val_manifest = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/manifests/validation.manifest"
+        test_manifest = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/manifests/test.manifest"
+        # fingerprint of the inputs and settings the processed data above was produced from
+        preprocessing_cache_key = f"{prefix.value_as_string}/processed/cache/preprocessing.json"
+        # plan and actual runtime of every preprocessing run, to calibrate the capacity planner
+        preprocessing_history_uri = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/processed/cache/runs/"
+        preprocessing_outputs = {
+            "train_dir": train_dir,
+            "val_dir": val_dir,
+            "test_dir": test_dir,
+            "train_manifest": train_manifest,
+            "val_manifest": val_manifest
+        }
+        # the settings the processed data depends on, part of the preprocessing cache fingerprint
+        preprocessing_parameters = {
+            "scriptVersion": script_version("code/glue_preprocessing.py", "code/churn_preprocessing.py",
+                                            "code/preprocessing_output.py"),
+            "outputFormat": output_format.value_as_string,
+            "compression": compression,
+            "shards": shards,
+            "windowDays": window_days,
+            "outputs": preprocessing_outputs
+        }
+        if window_days:
+            # a window run on a new day writes a new snapshot_date partition, see --SNAPSHOT_DATE
+            preprocessing_parameters["snapshotDate"] = sfn.JsonPath.string_at("$$.Execution.StartTime")
 
         # STEP FUNCTION
-        start_glue_job = sfn_tasks.GlueStartJobRun(
+        # GlueStartJobRun cannot set the capacity of a run, so the Spark job is started through the
+        # same glue:startJobRun.sync integration with the worker type and count of the plan
+        start_glue_job = sfn.CustomState(
             self,
             "StartGlueJobTask",
-            glue_job_name=glue_job.job_name,
+            state_json={
+                "Type": "Task",
+                "Resource": f"arn:{cdk.Aws.PARTITION}:states:::glue:startJobRun.sync",
+                "Parameters": {
+                    "JobName": glue_job.job_name,
+                    "WorkerType.$": "$.preprocessingEngine.workerType",
+                    "NumberOfWorkers.$": "$.preprocessingEngine.numberOfWorkers",
+                    "Arguments": {
+                        '--job-bookmark-option': 'job-bookmark-enable',
+                        # Custom arguments below
+                        '--INPUT_DIR': input_dir,
+                        '--TRAIN_DIR': train_dir,
+                        '--VAL_DIR': val_dir,
+                        '--TEST_DIR': test_dir,
+                        '--OUTPUT_FORMAT': output_format.value_as_string,
+                        '--COMPRESSION': compression,
+                        '--SHARDS': str(shards),
+                        '--WINDOW_DAYS': str(window_days),
+                        # the snapshot of the run is the day the execution started
+                        '--SNAPSHOT_DATE.$': "$$.Execution.StartTime",
+                        '--INCREMENTAL': incremental.value_as_string,
+                    }
+                },
+                "ResultSelector": dict(preprocessing_outputs, **{"executionSeconds.$": "$.ExecutionTime"}),
+                "ResultPath": "$.glueTaskResult",
+            }
+        )
+
+        start_python_job = sfn_tasks.GlueStartJobRun(
+            self,
+            "StartPythonShellJobTask",
+            glue_job_name=python_job.job_name,
             integration_pattern=sfn.IntegrationPattern.RUN_JOB,
             result_path="$.glueTaskResult",
             arguments=sfn.TaskInput.from_object(
                 {
-                    '--job-bookmark-option': 'job-bookmark-enable',
-                    '--additional-python-modules': 'pyarrow==2,awswrangler==2.9.0,fsspec==0.7.4',
-                    # Custom arguments below
                     '--INPUT_DIR': input_dir,
                     '--TRAIN_DIR': train_dir,
                     '--VAL_DIR': val_dir,
                     '--TEST_DIR': test_dir,
+                    '--OUTPUT_FORMAT': output_format.value_as_string,
+                    '--COMPRESSION': compression,
+                    '--SHARDS': str(shards),
+                    '--WINDOW_DAYS': str(window_days),
+                    '--SNAPSHOT_DATE': sfn.JsonPath.string_at("$$.Execution.StartTime"),
                 }
             ),
-            result_selector={
-                "train_dir": train_dir,
-                "val_dir": val_dir,
-                "test_dir": test_dir
-            }
+            result_selector=dict(preprocessing_outputs, executionSeconds=sfn.JsonPath.number_at("$.ExecutionTime"))
+        )
+
+        compact_task = sfn_tasks.GlueStartJobRun(
+            self,
+            "CompactProcessedDataTask",
+            glue_job_name=compaction_job.job_name,
+            integration_pattern=sfn.IntegrationPattern.RUN_JOB,
+            result_path=sfn.JsonPath.DISCARD,
+            arguments=sfn.TaskInput.from_object(
+                {
+                    '--TRAIN_DIR': train_dir,
+                    '--VAL_DIR': val_dir,
+                    '--TEST_DIR': test_dir,
+                    '--OUTPUT_FORMAT': output_format.value_as_string,
+                    '--COMPRESSION': compression,
+                    '--SHARDS': str(shards),
+                    '--WINDOW_DAYS': str(window_days),
+                }
+            )
+        )
+
+        # Pick the preprocessing engine from the size of the input objects
+        with open("code/select_preprocessing_engine.py", encoding="utf8") as fp:
+            lambda_select_engine_code = fp.read()
+
+        select_engine_lambda = lambda_.Function(
+            self,
+            "select_preprocessing_engine_function",
+            code=lambda_.InlineCode(lambda_select_engine_code),
+            handler="index.lambda_handler",
+            timeout=cdk.Duration.seconds(300),
+            runtime=lambda_.Runtime.PYTHON_3_8
+        )
+
+        # Add perms
+        select_engine_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:ListBucket'],
+            resources = [f'arn:aws:s3:::{bucket_name.value_as_string}',]
+        ))
+        select_engine_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:GetObject'],
+            resources = [f'arn:aws:s3:::{bucket_name.value_as_string}/{prefix.value_as_string}/*',]
+        ))
+        select_engine_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:DeleteObject'],
+            resources = [f'arn:aws:s3:::{bucket_name.value_as_string}/{preprocessing_cache_key}',]
+        ))
+
+        # Record the fingerprint of the inputs once the processed data is written
+        record_cache_lambda = lambda_.Function(
+            self,
+            "record_preprocessing_cache_function",
+            code=lambda_.InlineCode(lambda_select_engine_code),
+            handler="index.record_handler",
+            timeout=cdk.Duration.seconds(60),
+            runtime=lambda_.Runtime.PYTHON_3_8
+        )
+        record_cache_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:PutObject'],
+            resources = [f'arn:aws:s3:::{bucket_name.value_as_string}/{prefix.value_as_string}/processed/cache/*',]
+        ))
+
+        select_engine_task = sfn.Task(
+            self, "Select preprocessing engine",
+            task=sfn_tasks.InvokeFunction(
+                select_engine_lambda,
+                payload={
+                    "inputDir": input_dir,
+                    "incremental": incremental.value_as_string,
+                    # a run with the same inputs and parameters reuses the processed data of the last run
+                    "cacheUri": f"s3://{bucket_name.value_as_string}/{preprocessing_cache_key}",
+                    # the recorded runs calibrate the throughput of the capacity planner
+                    "historyUri": preprocessing_history_uri,
+                    "parameters": preprocessing_parameters
+                }
+            ),
+            result_path="$.preprocessingEngine"
+        )
+
+        record_cache_task = sfn.Task(
+            self, "Record preprocessing run",
+            task=sfn_tasks.InvokeFunction(
+                record_cache_lambda,
+                payload={
+                    "cacheUri": f"s3://{bucket_name.value_as_string}/{preprocessing_cache_key}",
+                    "fingerprint": sfn.JsonPath.string_at("$.preprocessingEngine.fingerprint"),
+                    "outputs": sfn.JsonPath.string_at("$.glueTaskResult"),
+                    "historyUri": preprocessing_history_uri,
+                    "run": {
+                        "engine": sfn.JsonPath.string_at("$.preprocessingEngine.engine"),
+                        "inputBytes": sfn.JsonPath.number_at("$.preprocessingEngine.inputBytes"),
+                        "workerType": sfn.JsonPath.string_at("$.preprocessingEngine.workerType"),
+                        "numberOfWorkers": sfn.JsonPath.number_at("$.preprocessingEngine.numberOfWorkers"),
+                        "estimatedSeconds": sfn.JsonPath.number_at("$.preprocessingEngine.estimatedSeconds"),
+                        "executionSeconds": sfn.JsonPath.number_at("$.glueTaskResult.executionSeconds")
+                    }
+                }
+            ),
+            result_path=sfn.JsonPath.DISCARD
+        )
+
+        if compaction:
+            record_cache_task.next(compact_task)
+
+        use_cached_output = sfn.Pass(
+            self, "Use cached preprocessing output",
+            input_path="$.preprocessingEngine.outputs",
+            result_path="$.glueTaskResult"
+        )
+
+        preprocessing = sfn.Choice(
+            self, "Small input?"
+        ).when(
+            sfn.Condition.string_equals("$.preprocessingEngine.engine", "cached"), use_cached_output
+        ).when(
+            sfn.Condition.string_equals("$.preprocessingEngine.engine", "python"), start_python_job.next(record_cache_task)
+        ).otherwise(
+            start_glue_job.next(record_cache_task)
         )
 
         image_uri = sagemaker.image_uris.retrieve(
@@ -140,21 +482,24 @@ class CfnStack(cdk.Stack):
                     channel_name="train",
                     data_source=sfn_tasks.DataSource(
                         s3_data_source=sfn_tasks.S3DataSource(
-                            s3_data_type=sfn_tasks.S3DataType.S3_PREFIX,
-                            s3_location=sfn_tasks.S3Location.from_json_expression("$.glueTaskResult.train_dir")
+                            s3_data_type=channel_data_type,
+                            s3_location=sfn_tasks.S3Location.from_json_expression(train_location),
+                            s3_data_distribution_type=train_distribution
                         )
                     ),
-                    content_type="text/csv"
+                    content_type=content_type,
+                    compression_type=channel_compression
                 ),
                 sfn_tasks.Channel(
                     channel_name="validation",
                     data_source=sfn_tasks.DataSource(
                         s3_data_source=sfn_tasks.S3DataSource(
-                            s3_data_type=sfn_tasks.S3DataType.S3_PREFIX,
-                            s3_location=sfn_tasks.S3Location.from_json_expression("$.glueTaskResult.val_dir")
+                            s3_data_type=channel_data_type,
+                            s3_location=sfn_tasks.S3Location.from_json_expression(val_location)
                         )
                     ),
-                    content_type="text/csv"
+                    content_type=content_type,
+                    compression_type=channel_compression
                 ),
             ],
             output_data_config=sfn_tasks.OutputDataConfig(
@@ -164,7 +509,7 @@ class CfnStack(cdk.Stack):
                 )
             ),
             resource_config=sfn_tasks.ResourceConfig(
-                instance_count=1,
+                instance_count=train_instance_count,
                 instance_type=ec2.InstanceType(sfn.JsonPath.string_at("$.TrainInstanceType")),
                 volume_size=cdk.Size.gibibytes(50)
             ),  # optional: default is 1 instance of EC2 `M4.XLarge` with `10GB` volume
@@ -203,13 +548,6 @@ class CfnStack(cdk.Stack):
             )
         )
 
-        eval_image_uri = sagemaker.image_uris.retrieve(
-            framework="sklearn",
-            region=my_region,
-            version="0.20.0",
-            py_version="py3",
-        )
-
         output_evaluation_s3_uri = f"s3://{bucket_name.value_as_string}/{prefix.value_as_string}/evaluation/"
         run_evaluation = sfn_tasks.CallAwsService(
             self,
@@ -224,10 +562,11 @@ class CfnStack(cdk.Stack):
                     {
                         "InputName": "test-data",
                         "S3Input": {
-                            "S3Uri": f"{test_dir}/",
+                            "S3Uri": test_manifest if window_days or compaction else f"{test_dir}/",
                             "LocalPath":"/opt/ml/processing/test",
-                            "S3DataType": "S3Prefix",
-                            "S3InputMode": "File"
+                            "S3DataType": "ManifestFile" if window_days or compaction else "S3Prefix",
+                            "S3InputMode": "File",
+                            "S3DataDistributionType": "ShardedByS3Key" if evaluation_instance_count > 1 else "FullyReplicated"
                         }
                     },
                     {
@@ -238,6 +577,15 @@ class CfnStack(cdk.Stack):
                             "S3DataType": "S3Prefix",
                             "S3InputMode": "File"
                         }
+                    },
+                    {
+                        "InputName": "metrics",
+                        "S3Input": {
+                            "S3Uri": f"s3://{bucket_name.value_as_string}/{code_key}/evaluation_metrics.py",
+                            "LocalPath":"/opt/ml/processing/input/metrics",
+                            "S3DataType": "S3Prefix",
+                            "S3InputMode": "File"
+                        }
                     }
                 ],
                 "ProcessingOutputConfig": {
@@ -255,7 +603,7 @@ class CfnStack(cdk.Stack):
                 "ProcessingJobName": sfn.JsonPath.string_at("$.RunJobName"),
                 "ProcessingResources": {
                     "ClusterConfig": {
-                        "InstanceCount": 1,
+                        "InstanceCount": evaluation_instance_count,
                         "InstanceType": "ml.m5.xlarge",
                         "VolumeSizeInGB": 20
                     }
@@ -264,16 +612,56 @@ class CfnStack(cdk.Stack):
                     "MaxRuntimeInSeconds": 1200
                 },
                 "AppSpecification": {
-                    "ImageUri": eval_image_uri,
+                    # the training image already has xgboost, scikit-learn and pyarrow, the evaluation
+                    # script starts without installing anything
+                    "ImageUri": image_uri,
                     "ContainerEntrypoint": ["python3", "/opt/ml/processing/input/code/evaluation.py"]
                 },
                 "RoleArn": sm_role.role_arn,
                 "Environment": {
-                    "model_url": sfn_tasks.S3Location.from_json_expression("$.trainTaskResult.ModelArtifacts.S3ModelArtifacts")
+                    "model_url": sfn_tasks.S3Location.from_json_expression("$.trainTaskResult.ModelArtifacts.S3ModelArtifacts"),
+                    "EVALUATION_CHUNK_ROWS": str(evaluation_chunk_rows),
+                    **evaluation_environment
                 }
             }
         )
 
+        # Small test sets are evaluated by the same script in a Lambda function, which starts in
+        # seconds where a processing job takes minutes to provision. The function leaves test sets
+        # and models above MAX_LAMBDA_EVALUATION_BYTES, and any run it fails on, to the processing job.
+        evaluation_lambda = lambda_.DockerImageFunction(
+            self,
+            "evaluation_function",
+            code=lambda_.DockerImageCode.from_image_asset("./code", file="evaluation_lambda.Dockerfile"),
+            memory_size=3008,
+            timeout=cdk.Duration.minutes(5),
+            environment=evaluation_environment,
+        )
+        evaluation_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+            actions = ['s3:ListBucket', 's3:*Object'],
+            resources = [
+                f'arn:aws:s3:::{bucket_name.value_as_string}',
+                f'arn:aws:s3:::{bucket_name.value_as_string}/*',
+            ]
+        ))
+
+        evaluate_in_lambda_task = sfn.Task(
+            self, "Evaluate small test set",
+            task=sfn_tasks.InvokeFunction(
+                evaluation_lambda,
+                payload={
+                    "S3ModelArtifacts": sfn.JsonPath.string_at("$.trainTaskResult.ModelArtifacts.S3ModelArtifacts"),
+                    "TestData": test_manifest if window_days or compaction else f"{test_dir}/",
+                    "EvaluationResult": output_evaluation_s3_uri
+                }
+            ),
+            result_path="$.lambdaEvaluation"
+        )
+
+        is_evaluated_in_lambda = sfn.Choice(
+            self, "Evaluated in Lambda?"
+        )
+
         wait_state = sfn.Wait(
             self, "Wait 15 seconds",
             time=sfn.WaitTime.duration(cdk.Duration.seconds(15)),
@@ -341,12 +729,46 @@ class CfnStack(cdk.Stack):
                 query_eval_lambda,
                 payload={
                     "EvaluationResult": output_evaluation_s3_uri,
+                    "GateMetric": "accuracy_lower" if gate_on_lower_bound else "accuracy",
                     "RunJobName": sfn.JsonPath.string_at("$.RunJobName"),
                     "trainTaskResult": sfn.JsonPath.string_at("$.trainTaskResult")
                 }
             )
         )
 
+        # A sharded evaluation job leaves one metric state per instance, merged into evaluation.json
+        # by merge_handler of the evaluation image before the result is queried
+        evaluation_result = query_eval_task
+        if evaluation_instance_count > 1:
+            merge_evaluation_lambda = lambda_.DockerImageFunction(
+                self,
+                "merge_evaluation_function",
+                code=lambda_.DockerImageCode.from_image_asset(
+                    "./code", file="evaluation_lambda.Dockerfile", cmd=["evaluation.merge_handler"]
+                ),
+                memory_size=1024,
+                timeout=cdk.Duration.minutes(1),
+                environment=evaluation_environment,
+            )
+            merge_evaluation_lambda.add_to_role_policy(aws_iam.PolicyStatement(
+                actions = ['s3:ListBucket', 's3:*Object'],
+                resources = [
+                    f'arn:aws:s3:::{bucket_name.value_as_string}',
+                    f'arn:aws:s3:::{bucket_name.value_as_string}/*',
+                ]
+            ))
+            evaluation_result = sfn.Task(
+                self, "Merge evaluation states",
+                task=sfn_tasks.InvokeFunction(
+                    merge_evaluation_lambda,
+                    payload={
+                        "EvaluationResult": output_evaluation_s3_uri,
+                        "InstanceCount": evaluation_instance_count
+                    }
+                ),
+                result_path="$.mergeEvaluation"
+            ).next(query_eval_task)
+
         check_evaluation = sfn.Choice(
             self, "Greater than metric?"
         )
@@ -464,11 +886,7 @@ class CfnStack(cdk.Stack):
         	endpoint_config_name=sfn.JsonPath.string_at("$.TrainingJobName")
         )
 
-        definition = start_glue_job.next(
-            train_task
-        ).next(
-            run_evaluation
-        ).next(
+        processing_evaluation = run_evaluation.next(
             wait_state
         ).next(
             get_status
@@ -476,7 +894,7 @@ class CfnStack(cdk.Stack):
             is_evaluation_complete.when(
                     sfn.Condition.string_equals("$.ProcessingJobStatus", "Failed"), job_failed
                 ).when(
-                    sfn.Condition.string_equals("$.ProcessingJobStatus", "Completed"), query_eval_task
+                    sfn.Condition.string_equals("$.ProcessingJobStatus", "Completed"), evaluation_result
                     .next(
                         check_evaluation.when(
                              sfn.Condition.number_greater_than_equals("$.trainingMetrics", 0.9), (register_model_task
@@ -493,11 +911,34 @@ class CfnStack(cdk.Stack):
                     wait_state
                 )
         )
+        evaluate_in_lambda_task.add_catch(processing_evaluation, result_path="$.lambdaEvaluation")
+
+        definition = select_engine_task.next(
+            preprocessing
+        ).afterwards().next(
+            train_task
+        ).next(
+            evaluate_in_lambda_task
+        ).next(
+            is_evaluated_in_lambda.when(
+                sfn.Condition.boolean_equals("$.lambdaEvaluation.evaluated", True), query_eval_task
+            ).otherwise(
+                processing_evaluation
+            )
+        )
         
         state_machine = sfn.StateMachine(
             self, "STFPipeline",
             definition=definition,
         )
+        state_machine.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions = ['glue:StartJobRun', 'glue:GetJobRun', 'glue:GetJobRuns', 'glue:BatchStopJobRun'],
+                resources = [
+                    f'arn:aws:glue:{my_region}:{my_acc_id}:job/{glue_job.job_name}',
+                ]
+            )
+        )
         state_machine.add_to_role_policy(
             aws_iam.PolicyStatement(
                 actions = ['sagemaker:CreateTrainingJob'],
@@ -0,0 +1,360 @@
+"""
+Compaction job for the processed churn splits.
+
+Incremental runs append new part files to the splits on every run, and snapshot partitions
+add a directory per day, so the processed data piles up small objects that slow down the
+listing and the per-object requests of the training and evaluation channels. This job merges
+the small data files of each directory of a split (a part file directory, or the one of a
+snapshot_date partition) into files of about TARGET_BYTES, and points the SageMaker manifests
+in <processed dir>/manifests/ at the merged files:
+
+    python compact_processed.py --PROCESSED_DIR /tmp/processed
+    python compact_processed.py --TRAIN_DIR s3://bucket/prefix/processed/train --VAL_DIR ... --TEST_DIR ...
+
+It runs locally or in a Glue Python shell job with churn_preprocessing.py and
+preprocessing_output.py as extra Python files, and takes the output arguments of the
+preprocessing jobs. Without --WINDOW_DAYS the manifest of a split lists every file of the
+split; with it, the manifests the preprocessing job wrote for the window are rewritten with
+the merged files in place of the files they replace.
+
+Readers must read the manifests, not list the split directories. A manifest is replaced by a
+single PUT, so a reader gets either the old or the new file list, and replaced files are only
+deleted RETAIN_HOURS after they were replaced, so a reader holding an old manifest can finish.
+What was merged is recorded in a journal under <processed dir>/compaction/ before the manifests
+change. Run the job after every preprocessing run and never at the same time as another
+compaction or preprocessing run: a preprocessing run lists the files of the window again, the
+replaced ones included, until the next compaction rewrites its manifests.
+"""
+import argparse
+import gzip
+import io
+import json
+import math
+import os
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from churn_preprocessing import output_paths
+from preprocessing_output import manifest_path, open_output
+
+# size of the merged files; files below half of it are merged
+TARGET_BYTES = 128 * 1024 * 1024
+# replaced files are kept this long for readers that listed them before the compaction
+RETAIN_HOURS = 24
+COPY_CHUNK_BYTES = 8 * 1024 * 1024
+SPLIT_NAMES = ('train', 'validation', 'test')
+
+
+def _s3():
+    import boto3
+    return boto3.client('s3')
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_files(root):
+    """
+    {path: (size, version)} of the non-empty data files at or under a local path or S3 prefix,
+    skipping _SUCCESS style markers. The version (ETag or modification time) changes when a
+    file is rewritten under the same name.
+    """
+    files = {}
+    if root.startswith('s3://'):
+        bucket, key = _split_s3_uri(root)
+        for page in _s3().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+            for item in page.get('Contents', []):
+                if item['Size'] > 0 and (item['Key'] == key or item['Key'].startswith(key + '/')):
+                    files[f"s3://{bucket}/{item['Key']}"] = (item['Size'], item['ETag'])
+    elif os.path.isfile(root):
+        files[root] = (os.path.getsize(root), str(os.stat(root).st_mtime_ns))
+    else:
+        for directory, _, names in os.walk(root):
+            for name in names:
+                stat = os.stat(os.path.join(directory, name))
+                if stat.st_size > 0:
+                    files[f"{directory}/{name}"] = (stat.st_size, str(stat.st_mtime_ns))
+    return {
+        path: value for path, value in files.items()
+        if not any(part.startswith(('_', '.')) for part in path[len(root):].split('/'))
+    }
+
+
+def file_version(path):
+    """Version of one file as list_files gives it, None when it does not exist."""
+    if path.startswith('s3://'):
+        from botocore.exceptions import ClientError
+        bucket, key = _split_s3_uri(path)
+        try:
+            return _s3().head_object(Bucket=bucket, Key=key)['ETag']
+        except ClientError:
+            return None
+    return str(os.stat(path).st_mtime_ns) if os.path.exists(path) else None
+
+
+def open_input(path):
+    if path.startswith('s3://'):
+        bucket, key = _split_s3_uri(path)
+        return _s3().get_object(Bucket=bucket, Key=key)['Body']
+    return open(path, 'rb')
+
+
+def delete_file(path):
+    if path.startswith('s3://'):
+        bucket, key = _split_s3_uri(path)
+        _s3().delete_object(Bucket=bucket, Key=key)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def read_json(path):
+    with closing(open_input(path)) as source:
+        return json.loads(source.read())
+
+
+def write_json(path, value):
+    with open_output(path) as sink:
+        sink.write(json.dumps(value, sort_keys=True).encode('utf-8'))
+
+
+def plan_merges(files, target_bytes=TARGET_BYTES, min_files=1):
+    """
+    Groups of the (path, size) files of one directory to merge into one file each. Files below
+    half of target_bytes are spread over as many groups as it takes to reach about target_bytes
+    each, largest first onto the lightest group, and the directory keeps at least min_files
+    files so that sharded splits stay sharded.
+    """
+    small = sorted((f for f in files if f[1] < target_bytes / 2), key=lambda f: (-f[1], f[0]))
+    groups = max(math.ceil(sum(size for _, size in small) / target_bytes), min_files - (len(files) - len(small)), 1)
+    if groups >= len(small):
+        return []
+    bins = [[] for _ in range(groups)]
+    loads = [0] * groups
+    for path, size in small:
+        lightest = loads.index(min(loads))
+        bins[lightest].append(path)
+        loads[lightest] += size
+    return [sorted(paths) for paths in bins if len(paths) > 1]
+
+
+def merged_path(directory, run_id, index, source):
+    """Merged file named after the run, with the extension of the files it merges (csv, csv.gz, snappy.parquet)."""
+    extension = os.path.basename(source).split('.', 1)[1]
+    return f"{directory}/part-compacted-{run_id}-{index:05d}.{extension}"
+
+
+def merge_csv(sources, target, header):
+    """Concatenate CSV files, keeping only the header line of the first one when they have one."""
+    with open_output(target) as sink:
+        out = gzip.GzipFile(filename='', mode='wb', fileobj=sink, mtime=0) if target.endswith('.gz') else sink
+        for number, source in enumerate(sources):
+            with closing(open_input(source)) as raw:
+                stream = gzip.GzipFile(fileobj=raw) if source.endswith('.gz') else raw
+                skip_header = header and number > 0
+                while True:
+                    chunk = stream.read(COPY_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    if skip_header:
+                        newline = chunk.find(b'\n')
+                        if newline < 0:
+                            continue
+                        chunk = chunk[newline + 1:]
+                        skip_header = False
+                    out.write(chunk)
+        if out is not sink:
+            out.close()
+
+
+def merge_parquet(sources, target):
+    """Copy the row groups of Parquet files into one file, with the codec of the first one."""
+    import pyarrow.parquet as pq
+    writer = None
+    with open_output(target) as sink:
+        for source in sources:
+            with closing(open_input(source)) as raw:
+                parquet = pq.ParquetFile(io.BytesIO(raw.read()))
+            for group in range(parquet.num_row_groups):
+                table = parquet.read_row_group(group)
+                if writer is None:
+                    codec = parquet.metadata.row_group(0).column(0).compression.lower()
+                    codec = 'none' if codec == 'uncompressed' else codec
+                    writer = pq.ParquetWriter(sink, table.schema, compression=codec)
+                writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+
+def merge_files(sources, target, header):
+    if target.endswith('.parquet'):
+        merge_parquet(sources, target)
+    else:
+        merge_csv(sources, target, header)
+
+
+def journal_dir(split_path):
+    """<processed dir>/compaction, next to the manifests."""
+    return f"{split_path.rsplit('/', 2)[0]}/compaction"
+
+
+def load_journals(directory):
+    """(path, record) of the journals of earlier runs, oldest first."""
+    return [(path, read_json(path)) for path in sorted(list_files(directory)) if path.endswith('.json')]
+
+
+def merged_sources(journals):
+    """{merged path: {replaced path: its version}} of the completed runs."""
+    merged = {}
+    for _, record in journals:
+        merged.update(record['merged'])
+    return merged
+
+
+def rewritten(files, path, version):
+    """Whether a replaced file exists again with other contents, the preprocessing job reusing its name."""
+    return files.get(path, (None, version))[1] != version
+
+
+def replacements(files, merged):
+    """
+    {replaced path: merged path} of the replaced files, and the merged files that are stale
+    because one of their files was rewritten since: the stale ones are not read, and the files
+    they replaced are read again.
+    """
+    stale = {
+        target for target, sources in merged.items()
+        if any(rewritten(files, source, version) for source, version in sources.items())
+    }
+    replaced = {
+        source: target for target, sources in merged.items() if target not in stale
+        for source, version in sources.items() if not rewritten(files, source, version)
+    }
+    return replaced, stale
+
+
+def live_files(files, merged):
+    """The files that hold the rows of the split now."""
+    replaced, stale = replacements(files, merged)
+    return {path: value for path, value in files.items() if path not in replaced and path not in stale}
+
+
+def write_split_manifest(split_path, name, window_days, merged):
+    """
+    Point the manifest of one split at its live files. Without a window it lists every file of
+    the split; with one, the entries of the manifest the preprocessing job wrote are replaced.
+    """
+    split_dir = split_path.rsplit('/', 1)[0]
+    if window_days:
+        path = manifest_path(split_path, name)
+        if not list_files(path):
+            print(f"No manifest at {path}, run the preprocessing job with WINDOW_DAYS first")
+            return
+        prefix, *entries = read_json(path)
+        replaced, stale = replacements(list_files(split_dir), merged)
+        paths = []
+        for entry in entries:
+            current = prefix['prefix'] + entry
+            while current in replaced:
+                current = replaced[current]
+            if current not in stale and current not in paths:
+                paths.append(current)
+    else:
+        paths = sorted(live_files(list_files(split_path), merged))
+    entries = [{'prefix': split_dir + '/'}] + [path[len(split_dir) + 1:] for path in paths]
+    write_json(manifest_path(split_path, name), entries)
+
+
+def compact(split_paths, window_days=0, target_bytes=TARGET_BYTES, shards=1, retain_hours=RETAIN_HOURS, now=None):
+    """
+    Merge the small files of the train, validation and test splits and point their manifests at
+    the merged files, then delete the files replaced more than retain_hours ago. Returns the
+    number of files merged, written and deleted.
+    """
+    now = now or datetime.utcnow()
+    run_id = now.strftime('%Y%m%dT%H%M%S%f')
+    journals_dir = journal_dir(split_paths[0])
+    journals = []
+    for path, record in load_journals(journals_dir):
+        if record['complete']:
+            journals.append((path, record))
+        else:
+            # a run that stopped before its manifests changed: nothing reads its merged files
+            for target in record['merged']:
+                delete_file(target)
+            delete_file(path)
+
+    merged = {}
+    headers = {}
+    for name, split_path in zip(SPLIT_NAMES, split_paths):
+        # the train split has a header in every file, validation and test have none
+        header = name == 'train'
+        files = live_files(list_files(split_path.rsplit('/', 1)[0] if window_days else split_path),
+                           merged_sources(journals))
+        directories = {}
+        for path, (size, _) in files.items():
+            directories.setdefault(path.rsplit('/', 1)[0], []).append((path, size))
+        for directory, directory_files in sorted(directories.items()):
+            for group in plan_merges(directory_files, target_bytes, shards if name != 'test' else 1):
+                target = merged_path(directory, run_id, len(merged), group[0])
+                merged[target] = {path: files[path][1] for path in group}
+                headers[target] = header
+
+    if merged:
+        journal = f"{journals_dir}/{run_id}.json"
+        write_json(journal, {'complete': False, 'merged': merged})
+        for target, sources in merged.items():
+            merge_files(list(sources), target, headers[target])
+        record = {'complete': True, 'merged': merged}
+        write_json(journal, record)
+        journals.append((journal, record))
+    for name, split_path in zip(SPLIT_NAMES, split_paths):
+        write_split_manifest(split_path, name, window_days, merged_sources(journals))
+
+    deleted = 0
+    for path, record in journals:
+        written = datetime.strptime(os.path.basename(path)[:-len('.json')], '%Y%m%dT%H%M%S%f')
+        if now - written < timedelta(hours=retain_hours):
+            continue
+        for target, sources in record['merged'].items():
+            versions = {source: file_version(source) for source in sources}
+            if any(version not in (None, sources[source]) for source, version in versions.items()):
+                # the merged file is stale, the files rewritten under the replaced names are new data
+                delete_file(target)
+                continue
+            for source, version in versions.items():
+                if version is not None:
+                    delete_file(source)
+                    deleted += 1
+        delete_file(path)
+    return {
+        'merged': sum(len(sources) for sources in merged.values()),
+        'written': len(merged),
+        'deleted': deleted,
+    }
+
+
+def main(argv=None):
+    # Glue Python shell jobs pass their own arguments as well, parse_known_args ignores them
+    parser = argparse.ArgumentParser(description="Merge the small files of the processed churn splits")
+    for name in ('PROCESSED_DIR', 'TRAIN_DIR', 'VAL_DIR', 'TEST_DIR', 'TRAIN_URI', 'VALIDATION_URI', 'TEST_URI'):
+        parser.add_argument(f'--{name}')
+    parser.add_argument('--OUTPUT_FORMAT', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--COMPRESSION', default='none', choices=['none', 'gzip', 'zstd'])
+    parser.add_argument('--WINDOW_DAYS', type=int, default=0)
+    parser.add_argument('--SHARDS', type=int, default=1)
+    parser.add_argument('--TARGET_BYTES', type=int, default=TARGET_BYTES)
+    parser.add_argument('--RETAIN_HOURS', type=float, default=RETAIN_HOURS)
+    args, _ = parser.parse_known_args(argv)
+
+    split_paths = output_paths(
+        args.PROCESSED_DIR, args.TRAIN_DIR, args.VAL_DIR, args.TEST_DIR,
+        args.TRAIN_URI, args.VALIDATION_URI, args.TEST_URI, args.OUTPUT_FORMAT, args.COMPRESSION,
+    )
+    counts = compact(split_paths, args.WINDOW_DAYS, args.TARGET_BYTES, args.SHARDS, args.RETAIN_HOURS)
+    print(f"Merged {counts['merged']} files into {counts['written']}, deleted {counts['deleted']} replaced files")
+
+
+if __name__ == '__main__':
+    main()
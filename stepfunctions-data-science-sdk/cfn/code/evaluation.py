@@ -1,23 +1,26 @@
 print('evaluation....')
 import json
 import os
+import sys
 import tarfile
 import pathlib
+import shutil
+import tempfile
+import io
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-import subprocess
 import numpy as np
 
-subprocess.run("pip install xgboost", shell=True)
+# runs in the SageMaker XGBoost training image: xgboost, joblib and pyarrow (for
+# test splits written with OUTPUT_FORMAT=parquet) are installed, nothing is pulled from PyPI
 import xgboost
 
-from sklearn.externals import joblib
-from sklearn.metrics import (
-    accuracy_score,
-    precision_score,
-    recall_score,
-    confusion_matrix,
-    roc_curve,
-)
+import joblib
+
+# evaluation_metrics.py comes with a processing input of its own, the Lambda image has it next to this script
+sys.path.append("/opt/ml/processing/input/metrics")
+import evaluation_metrics
+
 import logging
 import boto3
 
@@ -27,76 +30,281 @@ logger.addHandler(logging.StreamHandler())
 
 s3_client = boto3.client('s3')
 
-if __name__ == "__main__":
-    model_artifacts_url = json.loads(os.environ['model_url'])['uri']
-    print('model_artifacts_url: ', model_artifacts_url)
-    model_artifacts_bucket = model_artifacts_url.split('/')[3]
-    model_artifacts_key = model_artifacts_url.split('/')[4:]
-    model_artifacts_key = '/'.join(model_artifacts_key)
+# test splits and models up to this many bytes in total are evaluated in the Lambda function
+# (lambda_handler), larger ones in a SageMaker processing job
+MAX_LAMBDA_EVALUATION_BYTES = int(os.environ.get('MAX_LAMBDA_EVALUATION_BYTES', 64 * 1024 * 1024))
+# Above 0 the processing job streams the test split in chunks of this many rows into a metric
+# state of constant size, see evaluation_metrics.metric_state, instead of reading it at once.
+# A job of several instances always streams, every instance its share of the test files.
+EVALUATION_CHUNK_ROWS = int(os.environ.get('EVALUATION_CHUNK_ROWS', 0))
+DEFAULT_CHUNK_ROWS = 1_000_000
+# worker processes of a streaming evaluation, each scores its share of the test files
+EVALUATION_PROCESSES = int(os.environ.get('EVALUATION_PROCESSES', 1))
+# also write the full ROC curve, one point per distinct score, to roc_curve.npz next to the
+# downsampled one of evaluation.json
+FULL_ROC_CURVE = os.environ.get('FULL_ROC_CURVE', 'false') == 'true'
+# resamples of the bootstrap confidence intervals of summary.json, 0 skips the bootstrap
+BOOTSTRAP_RESAMPLES = int(os.environ.get('BOOTSTRAP_RESAMPLES', evaluation_metrics.BOOTSTRAP_RESAMPLES))
+# the segment keys the preprocessing job appends to the test split after the features, see
+# SEGMENT_COLUMNS in glue_preprocessing.py: segments.json slices the metrics by them
+SEGMENT_KEYS = ['State', 'Area_Code', 'Int_l_Plan', 'Account_Length']
+
+
+def test_files(test_dir):
+    """
+    The files of the test split, either a single file or the part files written by the Spark
+    split of the preprocessing job, as CSV, gzip CSV or Parquet (empty part files are skipped).
+    """
+    files = sorted(p for p in pathlib.Path(test_dir).rglob("*") if p.is_file() and p.stat().st_size > 0)
+    parquet_files = [f for f in files if f.suffix == ".parquet"]
+    return parquet_files or [f for f in files if f.name.endswith((".csv", ".csv.gz"))]
+
+
+def load_test_data(test_dir):
+    """Read the test split with the label in column 0."""
+    files = test_files(test_dir)
+    if files and files[0].suffix == ".parquet":
+        df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+        # match the positional columns of a header-less CSV
+        df.columns = range(df.shape[1])
+        return df
+    return pd.concat([pd.read_csv(f, header=None) for f in files], ignore_index=True)
+
+
+def has_segments(df):
+    """Whether a test split frame ends with the SEGMENT_KEYS columns, the first of which is text."""
+    return df.shape[1] > len(SEGMENT_KEYS) + 1 and \
+        not pd.api.types.is_numeric_dtype(df.dtypes.iloc[-len(SEGMENT_KEYS)])
+
+
+def split_segments(df):
+    """(label and features as float32, segment key values as strings or None) of a test split frame."""
+    if not has_segments(df):
+        return df.to_numpy(dtype=np.float32), None
+    features = df.shape[1] - len(SEGMENT_KEYS)
+    return df.iloc[:, :features].to_numpy(dtype=np.float32), df.iloc[:, features:].astype(str).to_numpy()
 
-    print(model_artifacts_bucket, model_artifacts_key)
 
-    model_dir = "/opt/ml/processing/model"
-    if not os.path.exists(model_dir):
-        os.makedirs(model_dir)
+def iter_test_chunks(files, chunk_rows):
+    """Data frames of at most chunk_rows rows of the test files, label in column 0."""
+    for f in files:
+        if f.suffix == ".parquet":
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(f).iter_batches(batch_size=chunk_rows):
+                yield batch.to_pandas()
+        else:
+            # the first row tells the float32 columns from the segment keys
+            head = pd.read_csv(f, header=None, nrows=1)
+            text = len(SEGMENT_KEYS) if has_segments(head) else 0
+            dtype = {i: str if i >= head.shape[1] - text else np.float32 for i in range(head.shape[1])}
+            yield from pd.read_csv(f, header=None, dtype=dtype, chunksize=chunk_rows)
+
+
+def evaluate_stream(model, files, chunk_rows):
+    """
+    The metric state and segment state of the model on the test files, scored chunk_rows rows
+    at a time. The segment state stays empty for test splits without segment keys.
+    """
+    state = evaluation_metrics.metric_state()
+    segments = evaluation_metrics.segment_state(SEGMENT_KEYS)
+    for chunk in iter_test_chunks(files, chunk_rows):
+        values, keys = split_segments(chunk)
+        scores = model.predict(xgboost.DMatrix(values[:, 1:]))
+        evaluation_metrics.update_state(state, values[:, 0], scores)
+        if keys is not None:
+            evaluation_metrics.update_segment_state(segments, values[:, 0], scores, keys)
+    return state, segments
+
+
+def _evaluate_share(model_file, files, chunk_rows, processes):
+    model = joblib.load(model_file)
+    # the cores are shared between the processes
+    model.set_param({"nthread": max(1, (os.cpu_count() or 1) // processes)})
+    return evaluate_stream(model, files, chunk_rows)
+
+
+def evaluate_in_processes(model_file, files, chunk_rows, processes=EVALUATION_PROCESSES):
+    """evaluate_stream with the test files dealt out to processes, their states merged."""
+    processes = max(1, min(processes, len(files)))
+    if processes == 1:
+        return _evaluate_share(model_file, files, chunk_rows, 1)
+    shares = [files[i::processes] for i in range(processes)]
+    with ProcessPoolExecutor(processes) as pool:
+        states = list(pool.map(_evaluate_share, [model_file] * processes, shares, [chunk_rows] * processes,
+                               [processes] * processes))
+    return (evaluation_metrics.merge_states(state for state, _ in states),
+            evaluation_metrics.merge_segment_states(segments for _, segments in states))
+
+
+def processing_hosts():
+    """(current host, all hosts) of the processing job, from its resource config."""
+    try:
+        with open("/opt/ml/config/resourceconfig.json") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return "algo-1", ["algo-1"]
+    return config["current_host"], config["hosts"]
+
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_test_objects(test_uri):
+    """
+    (bucket, key, relative path, size) of the test split files under an s3:// prefix or listed
+    by a manifest file, with the paths a processing job input downloads them to.
+    """
+    bucket, key = split_s3_uri(test_uri)
+    if key.endswith('.manifest'):
+        prefix, *entries = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        bucket, key = split_s3_uri(prefix['prefix'])
+        return [
+            (bucket, key + entry, entry, s3_client.head_object(Bucket=bucket, Key=key + entry)['ContentLength'])
+            for entry in entries
+        ]
+    objects = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+        for item in page.get('Contents', []):
+            if not item['Key'].endswith('/'):
+                objects.append((bucket, item['Key'], item['Key'][len(key):].lstrip('/'), item['Size']))
+    return objects
 
+
+def merge_handler(event, context):
+    """
+    Merge the metric and segment states the instances of a sharded evaluation job wrote under
+    states/ of EvaluationResult into its evaluation.json, summary.json and segments.json, then
+    delete them.
+    """
+    print(event)
+    bucket, prefix = split_s3_uri(f"{event['EvaluationResult']}states/")
+    hosts = [f"algo-{i}" for i in range(1, int(event['InstanceCount']) + 1)]
+
+    def load(key, load_state):
+        return load_state(io.BytesIO(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()))
+
+    states = [load(f"{prefix}{host}.npz", evaluation_metrics.load_state) for host in hosts]
+    segments = [load(f"{prefix}{host}-segments.npz", evaluation_metrics.load_segment_state) for host in hosts]
+    outputs = evaluation_metrics.state_outputs(evaluation_metrics.merge_states(states), resamples=BOOTSTRAP_RESAMPLES)
+
+    put_outputs(outputs, event['EvaluationResult'], evaluation_metrics.merge_segment_states(segments))
+    keys = [f"{prefix}{host}{suffix}" for host in hosts for suffix in (".npz", "-segments.npz")]
+    s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys]})
+    return {'merged': len(states)}
+
+
+def put_outputs(outputs, evaluation_result, segments=None):
+    """Upload the files of the evaluation outputs and segment state under the EvaluationResult prefix."""
+    output_bucket, output_prefix = split_s3_uri(evaluation_result)
+    for name, body in evaluation_metrics.output_files(outputs, FULL_ROC_CURVE, segments).items():
+        s3_client.put_object(Bucket=output_bucket, Key=f"{output_prefix}{name}", Body=body)
+
+
+def load_model(model_artifacts_url, model_dir):
+    """Download and extract the model.tar.gz of the training job and load its booster."""
+    model_artifacts_bucket, model_artifacts_key = split_s3_uri(model_artifacts_url)
+    print(model_artifacts_bucket, model_artifacts_key)
+    pathlib.Path(model_dir).mkdir(parents=True, exist_ok=True)
     model_path = os.path.join(model_dir, "model.tar.gz")
 
     s3_client.download_file(model_artifacts_bucket, model_artifacts_key, model_path)
     print("Extracting model from path: {}".format(model_path))
 
     with tarfile.open(model_path) as tar:
-        tar.extractall(path=".")
-    
-    model = joblib.load("xgboost-model")
-    test_data = os.path.join("/opt/ml/processing/test", "test.csv")
-    
-    test_data_pd = pd.read_csv(test_data, header=None)
-    
-    y_test = test_data_pd.iloc[:, 0].to_numpy()
-    test_data_pd.drop(test_data_pd.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(test_data_pd.values)
-    
+        tar.extractall(path=model_dir)
+    return joblib.load(os.path.join(model_dir, "xgboost-model"))
+
+
+def evaluate(model, test_data_pd):
+    """
+    (outputs, segments) of the model on the test split, label in column 0: the report, summary
+    and full ROC curve of evaluation_metrics.evaluation_outputs, and the segment state of the
+    segment keys after the features, empty for test splits without them.
+    """
+    values, keys = split_segments(test_data_pd)
+    y_test = values[:, 0]
+    X_test = xgboost.DMatrix(values[:, 1:])
+
     prediction_probabilities = model.predict(X_test)
-    predictions = np.round(prediction_probabilities)
-
-    precision = precision_score(y_test, predictions)
-    recall = recall_score(y_test, predictions)
-    accuracy = accuracy_score(y_test, predictions)
-    conf_matrix = confusion_matrix(y_test, predictions)
-    fpr, tpr, _ = roc_curve(y_test, prediction_probabilities)
-
-    logger.debug("Accuracy: {}".format(accuracy))
-    logger.debug("Precision: {}".format(precision))
-    logger.debug("Recall: {}".format(recall))
-    logger.debug("Confusion matrix: {}".format(conf_matrix))
-    
+
     """
     Need to customise the formation of evaluation.json to visualize the metrics in model registry based-on tasks
     Result should coincide in format with the result by sagemaker.workflow.quality_check_step.QualityCheckStep.
     Binarry
     """
-    
-    report_dict = {
-        "binary_classification_metrics": {
-            "accuracy": {"value": accuracy, "standard_deviation": "NaN"},
-            "precision": {"value": precision, "standard_deviation": "NaN"},
-            "recall": {"value": recall, "standard_deviation": "NaN"},
-            "confusion_matrix": {
-                "0": {"0": int(conf_matrix[0][0]), "1": int(conf_matrix[0][1])},
-                "1": {"0": int(conf_matrix[1][0]), "1": int(conf_matrix[1][1])},
-            },
-            "receiver_operating_characteristic_curve": {
-                "false_positive_rates": list(fpr),
-                "true_positive_rates": list(tpr),
-            },
-        },
-    }
-    
+    outputs = evaluation_metrics.evaluation_outputs(y_test, prediction_probabilities, resamples=BOOTSTRAP_RESAMPLES)
+    metrics = outputs[0]["binary_classification_metrics"]
+
+    logger.debug("Accuracy: {}".format(metrics["accuracy"]["value"]))
+    logger.debug("Precision: {}".format(metrics["precision"]["value"]))
+    logger.debug("Recall: {}".format(metrics["recall"]["value"]))
+    logger.debug("Confusion matrix: {}".format(metrics["confusion_matrix"]))
+
+    segments = evaluation_metrics.segment_state(SEGMENT_KEYS)
+    if keys is not None:
+        evaluation_metrics.update_segment_state(segments, y_test, prediction_probabilities, keys)
+    return outputs, segments
+
+
+def lambda_handler(event, context):
+    """
+    Evaluate the model in the Lambda function when the test split and the model are small, and
+    write the same outputs as the processing job. Larger inputs are left to the
+    processing job: the state machine runs it when evaluated is false.
+    """
+    print(event)
+    model_bucket, model_key = split_s3_uri(event['S3ModelArtifacts'])
+    model_bytes = s3_client.head_object(Bucket=model_bucket, Key=model_key)['ContentLength']
+    test_objects = list_test_objects(event['TestData'])
+    evaluation_bytes = model_bytes + sum(size for *_, size in test_objects)
+    if evaluation_bytes > MAX_LAMBDA_EVALUATION_BYTES:
+        return {'evaluated': False, 'evaluationBytes': evaluation_bytes}
+
+    work_dir = tempfile.mkdtemp(dir='/tmp')
+    try:
+        test_dir = os.path.join(work_dir, 'test')
+        for bucket, key, path, size in test_objects:
+            local_path = os.path.join(test_dir, path)
+            pathlib.Path(local_path).parent.mkdir(parents=True, exist_ok=True)
+            s3_client.download_file(bucket, key, local_path)
+        model = load_model(event['S3ModelArtifacts'], os.path.join(work_dir, 'model'))
+        outputs, segments = evaluate(model, load_test_data(test_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    put_outputs(outputs, event['EvaluationResult'], segments)
+    return {'evaluated': True, 'evaluationBytes': evaluation_bytes}
+
+
+if __name__ == "__main__":
+    model_artifacts_url = json.loads(os.environ['model_url'])['uri']
+    print('model_artifacts_url: ', model_artifacts_url)
+
+    model = load_model(model_artifacts_url, "/opt/ml/processing/model")
     output_dir = "/opt/ml/processing/evaluation"
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    evaluation_path = f"{output_dir}/evaluation.json"
+    current_host, hosts = processing_hosts()
+    if len(hosts) > 1:
+        # ShardedByS3Key gave this instance its share of the test files, merge_handler writes
+        # the outputs from the states of all instances
+        state, segments = evaluate_in_processes("/opt/ml/processing/model/xgboost-model",
+                                                test_files("/opt/ml/processing/test"),
+                                                EVALUATION_CHUNK_ROWS or DEFAULT_CHUNK_ROWS)
+        pathlib.Path(f"{output_dir}/states").mkdir(exist_ok=True)
+        evaluation_metrics.save_state(state, f"{output_dir}/states/{current_host}.npz")
+        evaluation_metrics.save_segment_state(segments, f"{output_dir}/states/{current_host}-segments.npz")
+    else:
+        if EVALUATION_CHUNK_ROWS:
+            state, segments = evaluate_in_processes("/opt/ml/processing/model/xgboost-model",
+                                                    test_files("/opt/ml/processing/test"), EVALUATION_CHUNK_ROWS)
+            outputs = evaluation_metrics.state_outputs(state, resamples=BOOTSTRAP_RESAMPLES)
+        else:
+            test_data_pd = load_test_data("/opt/ml/processing/test")
+            outputs, segments = evaluate(model, test_data_pd)
 
-    with open(evaluation_path, "w") as f:
-        f.write(json.dumps(report_dict))
\ No newline at end of file
+        for name, body in evaluation_metrics.output_files(outputs, FULL_ROC_CURVE, segments).items():
+            with open(f"{output_dir}/{name}", "wb") as f:
+                f.write(body)
\ No newline at end of file
@@ -1,153 +1,540 @@
 import sys
+import os
+import time
+from contextlib import contextmanager
 from datetime import date
+import boto3
+import numpy as np
+import pandas as pd
 from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 from pyspark.sql.functions import when
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from awsglue.job import Job
-from pyspark.sql.functions import col, expr, when, round
-from pyspark.sql.types import LongType
+from pyspark.sql.functions import col, expr, when
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, StringType, FloatType, DoubleType, LongType, BooleanType
 from awsglue.dynamicframe import DynamicFrame
+from pyspark import StorageLevel
+# shared with churn_preprocessing.py, the job gets it with --extra-py-files
+from preprocessing_output import (
+    PARQUET_CODECS, PROFILE_LABEL, PROFILE_QUANTILES, json_number, pandas_profile, partition_path, profile_path,
+    window_partitions, write_manifest, write_profile, write_shards, write_split, write_window_manifest,
+)
 
 sc = SparkContext()
 glueContext = GlueContext(sc)
 spark = glueContext.spark_session
 job = Job(glueContext)
+
+
+def get_optional_arg(name, default):
+    """getResolvedOptions only handles required arguments, so look optional ones up explicitly."""
+    if f"--{name}" in sys.argv:
+        return getResolvedOptions(sys.argv, [name])[name]
+    return default
+
+
+# "csv" or "parquet", also used as the file extension of the processed splits
+output_format = get_optional_arg('OUTPUT_FORMAT', 'csv')
+
 args = getResolvedOptions(sys.argv, ['JOB_NAME', 'TRAIN_DIR', 'VAL_DIR', 'TEST_DIR', 'INPUT_DIR'])
 
-#processed_dir = args['PROCESSED_DIR']
-train_dir = args['TRAIN_DIR']
-val_dir = args['VAL_DIR']
-test_dir = args['TEST_DIR']
 input_dir = args['INPUT_DIR']
 
+train_dir = f"{args['TRAIN_DIR']}/train.{output_format}"
+val_dir = f"{args['VAL_DIR']}/validation.{output_format}"
+test_dir = f"{args['TEST_DIR']}/test.{output_format}"
+
+# "driver" collects the data to pandas on the driver, "spark" splits and writes from the executors
+split_mode = get_optional_arg('SPLIT_MODE', 'driver')
+# "customer_hash" derives the split of a row from its customerID alone, "random" draws it on every run
+split_strategy = get_optional_arg('SPLIT_STRATEGY', 'customer_hash')
+split_seed = int(get_optional_arg('SPLIT_SEED', '42'))
+# train,validation,test shares of the rows
+train_ratio, val_ratio, test_ratio = (float(r) for r in get_optional_arg('SPLIT_RATIOS', '0.8,0.19,0.01').split(','))
+if split_mode not in ('driver', 'spark'):
+    raise ValueError(f"Unknown SPLIT_MODE {split_mode}, expected 'driver' or 'spark'")
+if split_strategy not in ('customer_hash', 'random'):
+    raise ValueError(f"Unknown SPLIT_STRATEGY {split_strategy}, expected 'customer_hash' or 'random'")
+if min(train_ratio, val_ratio, test_ratio) < 0 or abs(train_ratio + val_ratio + test_ratio - 1) > 1e-6:
+    raise ValueError(f"SPLIT_RATIOS must be three non-negative shares adding up to 1, got {train_ratio},{val_ratio},{test_ratio}")
+if output_format not in ('csv', 'parquet'):
+    raise ValueError(f"Unknown OUTPUT_FORMAT {output_format}, expected 'csv' or 'parquet'")
+
+# "none", "gzip" or "zstd". Gzip CSV splits get a .gz suffix and are read by the training channels
+# with CompressionType=Gzip. SageMaker cannot decompress zstd, so zstd is only used as the codec
+# inside Parquet files, like gzip is for Parquet.
+compression = get_optional_arg('COMPRESSION', 'none')
+if compression not in ('none', 'gzip', 'zstd'):
+    raise ValueError(f"Unknown COMPRESSION {compression}, expected 'none', 'gzip' or 'zstd'")
+if compression == 'zstd' and output_format != 'parquet':
+    raise ValueError("COMPRESSION=zstd requires OUTPUT_FORMAT=parquet, training channels only decompress gzip")
+if compression == 'gzip' and output_format == 'csv':
+    train_dir, val_dir, test_dir = (f"{path}.gz" for path in (train_dir, val_dir, test_dir))
+if output_format == 'parquet' and split_mode == 'driver':
+    # Only the driver split mode writes Parquet with pyarrow. Nothing is installed from PyPI when
+    # the job starts: pass a prebuilt pyarrow wheel on S3 with --additional-python-modules and
+    # --python-modules-installer-option --no-index, as the glue-workflow notebook does.
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ValueError("OUTPUT_FORMAT=parquet with SPLIT_MODE=driver needs the pyarrow wheel in --additional-python-modules")
+
+# Above 1, train and validation are each written as this many balanced part files in a directory
+# at their usual path, listed by a SageMaker manifest file in <processed dir>/manifests/ so that
+# training channels can read them as a ManifestFile, sharded over the instances by S3 key.
+shards = int(get_optional_arg('SHARDS', '1'))
+if shards < 1:
+    raise ValueError(f"SHARDS must be at least 1, got {shards}")
+
+# "true" only processes input files the job bookmark has not seen yet and appends their
+# splits to the processed data, which needs the part file layout of the Spark split
+incremental = get_optional_arg('INCREMENTAL', 'false').lower() == 'true'
+if incremental and (split_mode != 'spark' or split_strategy != 'customer_hash'):
+    raise ValueError("INCREMENTAL=true requires SPLIT_MODE=spark and SPLIT_STRATEGY=customer_hash")
+
+# Above 0, the splits of a run go to a snapshot_date=<SNAPSHOT_DATE> partition of each split
+# directory and older snapshots are kept. The manifests in <processed dir>/manifests/ then list
+# the partitions of the last WINDOW_DAYS days up to the snapshot, and the training and evaluation
+# channels read them instead of the split directories. 0 keeps a single location per split.
+window_days = int(get_optional_arg('WINDOW_DAYS', '0'))
+if window_days < 0:
+    raise ValueError(f"WINDOW_DAYS must be at least 0, got {window_days}")
+# "YYYY-MM-DD", or a timestamp starting with the date such as the start time of a state machine
+# execution; the day of the run by default
+snapshot_date = date.fromisoformat(get_optional_arg('SNAPSHOT_DATE', date.today().isoformat())[:10])
+
+# Prefix of raw per-call sentiment events (CSV with customerID,call_time,sentiment). When set,
+# pastSenti_nut, pastSenti_pos and pastSenti_neg are counted from the events instead of being
+# read from the churn CSV, see enrich_sentiment.
+sentiment_dir = get_optional_arg('SENTIMENT_DIR', '')
+# the counts per customer are broadcast to the join up to this estimated size, and joined with
+# a shuffle of the churn rows above it
+sentiment_broadcast_bytes = int(get_optional_arg('SENTIMENT_BROADCAST_MB', '64')) * 1024 ** 2
+
+# CloudWatch namespace the stage metrics are published to, "none" only logs them
+metrics_namespace = get_optional_arg('METRICS_NAMESPACE', 'ChurnPreprocessing')
+
 job.init(args['JOB_NAME'], args)
 
 #database = 'iris-database' #replace with your user id
-today = date.today()
 logger = glueContext.get_logger()
-logger.info("info message")
-
-
-df= glueContext.create_dynamic_frame_from_options(format_options={"quoteChar": '"', "withHeader": True, "separator": ","},connection_type = "s3", connection_options = {"paths": [input_dir]}, format = "csv")
-
-df1 = df.toDF()
-#print(df1)
-
-#drop the columns that we will not use
-cols = ("Day_Charge", "Eve_Charge", "Night_Charge", "Intl_Charg", "Area_Code","State", "sentiment")
-
-data=df1.drop(*cols) 
-data.printSchema()
-
-
-#change the column type
-from pyspark.sql.types import StringType, DateType, FloatType, LongType, BooleanType
-
-data2= data \
-  .withColumn("Account_Length" ,
-              data["Account_Length"]
-              .cast(LongType()))  \
-  .withColumn("customerID",
-              data["customerID"]
-              .cast(LongType()))    \
-  .withColumn("Int_l_Plan"  ,
-              data["Int_l_Plan"]
-              .cast(StringType())) \
-  .withColumn("VMail_Plan"  ,
-              data["VMail_Plan"]
-              .cast(StringType())) \
-  .withColumn("VMail_Message"  ,
-              data["VMail_Message"]
-              .cast(StringType())) \
-  .withColumn("Day_Mins"  ,
-              data["Day_Mins"]
-              .cast(FloatType())) \
-  .withColumn("Day_Calls"  ,
-              data["Day_Calls"]
-              .cast(LongType())) \
-  .withColumn("Eve_Mins"  ,
-              data["Eve_Mins"]
-              .cast(FloatType())) \
-  .withColumn("Eve_Calls"  ,
-              data["Eve_Calls"]
-              .cast(LongType())) \
-  .withColumn("Night_Mins"  ,
-              data["Night_Mins"]
-              .cast(FloatType())) \
-  .withColumn("Night_Calls"  ,
-              data["Night_Calls"]
-              .cast(LongType())) \
-  .withColumn("Intl_Mins"  ,
-              data["Intl_Mins"]
-              .cast(FloatType())) \
-  .withColumn("Intl_Calls"  ,
-              data["Intl_Calls"]
-              .cast(LongType())) \
-.withColumn("CustServ_Calls"  ,
-              data["CustServ_Calls"]
-              .cast(LongType())) \
-.withColumn("Churn"  ,
-              data["Churn"]
-              .cast(BooleanType())) \
-.withColumn("pastSenti_nut"  ,
-              data["pastSenti_nut"]
-              .cast(LongType())) \
-.withColumn("pastSenti_pos"  ,
-              data["pastSenti_pos"]
-              .cast(LongType())) \
-.withColumn("pastSenti_neg"  ,
-              data["pastSenti_neg"]
-              .cast(LongType())) \
-.withColumn("mth_remain"  ,
-              data["mth_remain"]
-              .cast(LongType())) \
-  
-      
-data2.printSchema()
 
-from pyspark.sql import functions as F
 
-data3 = data2.withColumn('Churn', F.when(data2.Churn == 'false', 0).otherwise(1))
-
-data4 = data3.withColumn('Int_l_Plan', F.when(data3.Int_l_Plan == 'no', 0).otherwise(1))
-
-data5 = data4.withColumn('VMail_Plan', F.when(data4.VMail_Plan == 'no', 0).otherwise(1))
-
-data5.printSchema()
-data5.select('churn').show()
-
-data_final=data5.select("churn", 
- 'Account_Length',
- 'customerID',
- 'Int_l_Plan',
- 'VMail_Plan',
- 'VMail_Message',
- 'Day_Mins',
- 'Day_Calls',
- 'Eve_Mins',
- 'Eve_Calls',
- 'Night_Mins',
- 'Night_Calls',
- 'Intl_Mins',
- 'Intl_Calls',
- 'Intl_Charge',
- 'CustServ_Calls',
- 'pastSenti_nut',
- 'pastSenti_pos',
- 'pastSenti_neg',
- 'mth_remain')
-
-
-df_pandas = data_final.toPandas()
-val = df_pandas.sample(frac=0.2, axis=0)
-train_df = df_pandas.drop(index=val.index)
-test_df = val.sample(frac=0.05, axis=0)
-val_df = val.drop(index=test_df.index)
-
-train_df.to_csv(f"{train_dir}/train.csv", index=False, line_terminator="")
-val_df.to_csv(f"{val_dir}/validation.csv", index=False, header=False, line_terminator="")
-test_df.to_csv(f"{test_dir}/test.csv", index=False, header=False, line_terminator="")
+# Wall time, rows and bytes of every logical stage of the run, in the order the stages ran.
+# Spark evaluates lazily and fuses the read with the casts, so the Spark mode times them
+# together in "read", and the driver mode in "collect".
+stage_metrics = []
+METRIC_UNITS = {'seconds': 'Seconds', 'rows': 'Count', 'bytes': 'Bytes'}
+
+
+@contextmanager
+def stage(name):
+    """Time the block as stage `name`; the block may set 'rows' and 'bytes' on the yielded record."""
+    record = {'stage': name, 'rows': None, 'bytes': None}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 3)
+        stage_metrics.append(record)
+        logger.info(f"stage {name}: {record['seconds']}s, {record['rows']} rows, {record['bytes']} bytes")
+
+
+def path_bytes(path):
+    """Total size of the files at or under a path, s3:// or local."""
+    if path.startswith('s3://'):
+        bucket, _, prefix = path[len('s3://'):].partition('/')
+        total = 0
+        for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            total += sum(item['Size'] for item in page.get('Contents', []))
+        return total
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def publish_metrics(stages):
+    """
+    Publish the stage records as the StageSeconds, StageRows and StageBytes metrics with the
+    JobName and Stage dimensions. A failure to publish is logged and does not fail the job.
+    """
+    if metrics_namespace == 'none':
+        return
+    data = []
+    for record in stages:
+        dimensions = [{'Name': 'JobName', 'Value': args['JOB_NAME']}, {'Name': 'Stage', 'Value': record['stage']}]
+        for metric, unit in METRIC_UNITS.items():
+            if record[metric] is not None:
+                data.append({
+                    'MetricName': f"Stage{metric.capitalize()}", 'Dimensions': dimensions,
+                    'Value': float(record[metric]), 'Unit': unit,
+                })
+    try:
+        cloudwatch = boto3.client('cloudwatch')
+        for start in range(0, len(data), 20):
+            cloudwatch.put_metric_data(Namespace=metrics_namespace, MetricData=data[start:start + 20])
+    except Exception as e:
+        logger.error(f"Could not publish the stage metrics to {metrics_namespace}: {e}")
+
+
+# Columns of the raw churn CSV in file order. The CSV source is positional, so columns that
+# data_final does not use are declared too, but Spark's CSV column pruning never parses them.
+# Integer-valued columns written as "12.0" are read as doubles and cast in encode_features.
+CHURN_SCHEMA = StructType([
+    StructField("State", StringType()),
+    StructField("Account_Length", LongType()),
+    StructField("Area_Code", StringType()),
+    StructField("customerID", LongType()),
+    StructField("Int_l_Plan", StringType()),
+    StructField("VMail_Plan", StringType()),
+    StructField("VMail_Message", LongType()),
+    StructField("Day_Mins", FloatType()),
+    StructField("Day_Calls", LongType()),
+    StructField("Day_Charge", StringType()),
+    StructField("Eve_Mins", FloatType()),
+    StructField("Eve_Calls", LongType()),
+    StructField("Eve_Charge", StringType()),
+    StructField("Night_Mins", FloatType()),
+    StructField("Night_Calls", LongType()),
+    StructField("Night_Charge", StringType()),
+    StructField("Intl_Mins", FloatType()),
+    StructField("Intl_Calls", LongType()),
+    StructField("Intl_Charge", FloatType()),
+    StructField("CustServ_Calls", LongType()),
+    StructField("Churn", StringType()),
+    StructField("sentiment", StringType()),
+    StructField("pastSenti_nut", LongType()),
+    StructField("pastSenti_pos", LongType()),
+    StructField("pastSenti_neg", LongType()),
+    StructField("mth_remain", DoubleType()),
+])
+
+# Segment keys of the sliced evaluation, see evaluation.py. Only the test split has them, as
+# side columns after the features: the raw State, Area_Code and Int_l_Plan, and Account_Length
+# bucketed to the lower bound of its ACCOUNT_LENGTH_BUCKET days, the last bucket open-ended.
+SEGMENT_COLUMNS = ['segment_State', 'segment_Area_Code', 'segment_Int_l_Plan', 'segment_Account_Length']
+ACCOUNT_LENGTH_BUCKET = 50
+ACCOUNT_LENGTH_BUCKETS = 5
+
+
+def encode_features(df):
+    """
+    Build data_final from the raw columns in one projection: casts, the yes/no plan flags,
+    the boolean churn label and the segment keys are all encoded in the same select.
+    """
+    def yes_no(name):
+        return F.when(F.col(name) == 'no', 0).otherwise(1).alias(name)
+
+    account_length = F.col('Account_Length').cast(LongType())
+
+    return df.select(
+        F.when(F.col('Churn').cast(BooleanType()) == False, 0).otherwise(1).alias('Churn'),
+        F.col('Account_Length').cast(LongType()),
+        F.col('customerID').cast(LongType()),
+        yes_no('Int_l_Plan'),
+        yes_no('VMail_Plan'),
+        F.col('VMail_Message').cast(LongType()),
+        F.col('Day_Mins').cast(FloatType()),
+        F.col('Day_Calls').cast(LongType()),
+        F.col('Eve_Mins').cast(FloatType()),
+        F.col('Eve_Calls').cast(LongType()),
+        F.col('Night_Mins').cast(FloatType()),
+        F.col('Night_Calls').cast(LongType()),
+        F.col('Intl_Mins').cast(FloatType()),
+        F.col('Intl_Calls').cast(LongType()),
+        F.col('Intl_Charge').cast(FloatType()),
+        F.col('CustServ_Calls').cast(LongType()),
+        F.col('pastSenti_nut').cast(LongType()),
+        F.col('pastSenti_pos').cast(LongType()),
+        F.col('pastSenti_neg').cast(LongType()),
+        F.col('mth_remain').cast(LongType()),
+        F.col('State').cast(StringType()).alias('segment_State'),
+        F.col('Area_Code').cast(StringType()).alias('segment_Area_Code'),
+        F.col('Int_l_Plan').cast(StringType()).alias('segment_Int_l_Plan'),
+        F.when(account_length.isNotNull(), F.least(
+            F.floor(account_length / ACCOUNT_LENGTH_BUCKET), F.lit(ACCOUNT_LENGTH_BUCKETS - 1)
+        ) * ACCOUNT_LENGTH_BUCKET).alias('segment_Account_Length'),
+    )
+
+
+if incremental:
+    # Job bookmarks only track reads made through the GlueContext with a transformation_ctx.
+    # The columns arrive as strings and are cast by encode_features.
+    raw = glueContext.create_dynamic_frame_from_options(
+        format_options={"quoteChar": '"', "withHeader": True, "separator": ","},
+        connection_type="s3",
+        connection_options={"paths": [input_dir]},
+        format="csv",
+        transformation_ctx="churn_input",
+    ).toDF()
+    if not raw.columns:
+        logger.info("No new input files since the last bookmarked run")
+        job.commit()
+        sys.exit(0)
+else:
+    raw = spark.read.csv(input_dir, schema=CHURN_SCHEMA, header=True, sep=",", quote='"', enforceSchema=False)
+
+data_final = encode_features(raw)
+
+
+SENTIMENT_SCHEMA = StructType([
+    StructField("customerID", LongType()),
+    StructField("call_time", StringType()),
+    StructField("sentiment", StringType()),
+])
+# feature column and the sentiment label of the calls it counts
+SENTIMENT_COLUMNS = {'pastSenti_nut': 'neutral', 'pastSenti_pos': 'positive', 'pastSenti_neg': 'negative'}
+# in-memory size of one row of the counts, an UnsafeRow of four longs plus its hash table entry
+SENTIMENT_ROW_BYTES = 64
+
+
+def aggregate_sentiment(events):
+    """
+    Calls of each customer per sentiment. The aggregation runs in two phases: every task first
+    sums the events of its partition per customerID (partial_sum in the plan), so the shuffle
+    moves at most one row per customer and partition, never the events themselves.
+    """
+    sentiment = F.lower(F.trim(F.col('sentiment')))
+    return events.where(F.col('customerID').isNotNull()).groupBy('customerID').agg(*[
+        F.sum((sentiment == label).cast(LongType())).alias(name) for name, label in SENTIMENT_COLUMNS.items()
+    ])
+
+
+def enrich_sentiment(df, counts, broadcast):
+    """
+    Replace the sentiment columns of data_final with the counts, 0 for customers without calls.
+    Broadcasting the counts joins them without shuffling the churn rows. Otherwise the sort merge
+    join shuffles the churn rows only: the counts are already hash partitioned by customerID by
+    their aggregation, which is the partitioning the join needs.
+    """
+    joined = df.drop(*SENTIMENT_COLUMNS).join(F.broadcast(counts) if broadcast else counts, 'customerID', 'left')
+    return joined.fillna(0, subset=list(SENTIMENT_COLUMNS)).select(*df.columns)
+
+
+if sentiment_dir:
+    with stage('sentiment') as record:
+        events = spark.read.csv(sentiment_dir, schema=SENTIMENT_SCHEMA, header=True, sep=",", quote='"',
+                                enforceSchema=False)
+        sentiment_counts = aggregate_sentiment(events).persist(StorageLevel.MEMORY_AND_DISK)
+        record['rows'] = sentiment_counts.count()
+        record['bytes'] = path_bytes(sentiment_dir)
+        broadcast_sentiment = record['rows'] * SENTIMENT_ROW_BYTES <= sentiment_broadcast_bytes
+        logger.info(f"{record['rows']} customers with calls, "
+                    f"{'broadcast' if broadcast_sentiment else 'shuffle'} join of the sentiment counts")
+    data_final = enrich_sentiment(data_final, sentiment_counts, broadcast_sentiment)
+
+data_final.printSchema()
+
+
+# a row goes to test below test_cut, to validation below val_cut and to train otherwise
+test_cut = test_ratio
+val_cut = test_ratio + val_ratio
+
+# SplitMix64 constants. Spark longs wrap around on overflow, so the same 64-bit arithmetic
+# gives the same bits as the unsigned NumPy version in customer_draw_np.
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+MIX_1 = 0xBF58476D1CE4E5B9
+MIX_2 = 0x94D049BB133111EB
+
+
+def as_signed_long(value):
+    value %= 2 ** 64
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+
+def customer_draw(customer_id, seed):
+    """Column expression mapping customerID to a uniform number in [0, 1), a pure function of (customerID, seed)."""
+    z = customer_id.cast(LongType()) + F.lit(as_signed_long((seed + 1) * GOLDEN_GAMMA)).cast(LongType())
+    z = z.bitwiseXOR(F.shiftRightUnsigned(z, 30)) * F.lit(as_signed_long(MIX_1)).cast(LongType())
+    z = z.bitwiseXOR(F.shiftRightUnsigned(z, 27)) * F.lit(as_signed_long(MIX_2)).cast(LongType())
+    z = z.bitwiseXOR(F.shiftRightUnsigned(z, 31))
+    return F.shiftRightUnsigned(z, 11).cast(DoubleType()) / float(2 ** 53)
+
+
+def customer_draw_np(customer_ids, seed):
+    """NumPy twin of customer_draw for the driver mode, missing customerIDs give NaN."""
+    missing = pd.isna(customer_ids)
+    z = np.where(missing, 0, customer_ids).astype(np.int64).view(np.uint64)
+    z = z + np.uint64(((seed + 1) * GOLDEN_GAMMA) % 2 ** 64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(MIX_1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(MIX_2)
+    z = z ^ (z >> np.uint64(31))
+    return np.where(missing, np.nan, (z >> np.uint64(11)).astype(np.float64) / 2.0 ** 53)
+
+
+def stratified_split(df, label_col, seed):
+    """
+    Tag every row with the split it belongs to ("train", "validation" or "test").
+
+    Each row draws a seeded uniform number and the cut-off points are approximate
+    quantiles of that number within each label, so every churn class keeps the same
+    split proportions. Only the per-label cut-offs are collected to the driver.
+    """
+    df = df.withColumn('_u', F.rand(seed)).persist(StorageLevel.MEMORY_AND_DISK)
+    cuts = df.groupBy(label_col).agg(
+        F.expr(f"percentile_approx(_u, array({test_cut}, {val_cut}))").alias('cuts')
+    ).collect()
+
+    split = None
+    for row in cuts:
+        is_label = F.col(label_col) == row[label_col]
+        label_test_cut, label_val_cut = row['cuts']
+        for name, cut in (('test', label_test_cut), ('validation', label_val_cut)):
+            condition = is_label & (F.col('_u') <= cut)
+            split = F.when(condition, name) if split is None else split.when(condition, name)
+
+    split = F.lit('train') if split is None else split.otherwise('train')
+    return df.withColumn('_split', split).drop('_u')
+
+
+def customer_split(df, seed):
+    """
+    Tag every row with its split by comparing customer_draw with the split ratios.
+
+    Unlike stratified_split the result does not depend on the other rows of the run: a customer
+    lands in the same split on every run and in both split modes, and rows appended by later
+    incremental runs are split exactly as if they had been in the first one.
+    """
+    u = customer_draw(F.col('customerID'), seed)
+    return df.withColumn('_split', F.when(u < test_cut, 'test').when(u < val_cut, 'validation').otherwise('train'))
+
+
+def driver_split(df_pandas):
+    """
+    Split the frame collected to the driver, returns (train_df, val_df, test_df).
+
+    churn_preprocessing.py runs the same code without Spark and must write the same bytes.
+    """
+    if split_strategy == 'customer_hash':
+        u = customer_draw_np(df_pandas['customerID'].to_numpy(), split_seed)
+        return df_pandas[~(u < val_cut)], df_pandas[(u >= test_cut) & (u < val_cut)], df_pandas[u < test_cut]
+    val = df_pandas.sample(frac=val_cut, axis=0, random_state=split_seed)
+    test_df = val.sample(frac=test_ratio / val_cut if val_cut else 0, axis=0, random_state=split_seed)
+    return df_pandas.drop(index=val.index), val.drop(index=test_df.index), test_df
+
+
+def spark_profile(splits):
+    """
+    Statistics of every split in a single aggregation over the rows tagged by the split functions,
+    which are persisted, so the input is not read again for the profile.
+    """
+    fields = [field for field in splits.schema.fields if field.name != '_split']
+    aggregates = [F.count(F.lit(1)).alias('rows'), F.sum(F.col(PROFILE_LABEL)).alias('positives')]
+    for i, field in enumerate(fields):
+        aggregates.append(F.count(F.col(field.name)).alias(f'count_{i}'))
+        if not isinstance(field.dataType, StringType):
+            value = F.col(field.name).cast(DoubleType())
+            aggregates += [
+                F.min(value).alias(f'min_{i}'),
+                F.max(value).alias(f'max_{i}'),
+                F.avg(value).alias(f'mean_{i}'),
+                F.var_samp(value).alias(f'variance_{i}'),
+                F.expr(f"percentile_approx(CAST(`{field.name}` AS DOUBLE), array({', '.join(map(str, PROFILE_QUANTILES))}))")
+                .alias(f'quantiles_{i}'),
+            ]
+    profile = {}
+    for row in splits.groupBy('_split').agg(*aggregates).collect():
+        columns = {}
+        for i, field in enumerate(fields):
+            if field.name in SEGMENT_COLUMNS and row['_split'] != 'test':
+                continue
+            column = {'count': row[f'count_{i}'], 'nulls': row['rows'] - row[f'count_{i}']}
+            if not isinstance(field.dataType, StringType):
+                column.update({
+                    stat: json_number(row[f'{stat}_{i}']) for stat in ('min', 'max', 'mean', 'variance')
+                })
+                column['quantiles'] = [json_number(q) for q in row[f'quantiles_{i}'] or []]
+            columns[field.name] = column
+        profile[row['_split']] = {
+            'rows': row['rows'],
+            'label_counts': {'0': row['rows'] - row['positives'], '1': row['positives']},
+            'columns': columns,
+        }
+    return profile
+
+
+def save_profile(split_profiles):
+    """Log the label balance of every split and write the profile sidecar next to the manifests."""
+    for name, split in sorted(split_profiles.items()):
+        logger.info(f"{name}: {split['rows']} rows, label counts {split['label_counts']}")
+    write_profile(profile_path(train_dir), split_profiles, incremental)
+
+
+if split_mode == 'spark':
+    # Each split becomes a directory of part files at the path the driver mode writes its
+    # single file to. Every train CSV part file keeps the header, validation and test have none.
+    # Incremental runs append new part files next to the ones written by earlier runs, in the
+    # partition of the snapshot with WINDOW_DAYS.
+    with stage('read') as record:
+        if split_strategy == 'customer_hash':
+            splits = customer_split(data_final, split_seed).persist(StorageLevel.MEMORY_AND_DISK)
+        else:
+            splits = stratified_split(data_final, 'Churn', split_seed)
+        # the count fills the cache the profile and the writes read from
+        record['rows'] = splits.count()
+        # the job bookmark of an incremental run reads only some of the files under the prefix
+        record['bytes'] = None if incremental else path_bytes(input_dir)
+    with stage('profile'):
+        split_profiles = spark_profile(splits)
+        save_profile(split_profiles)
+    for name, split_path, header in (('train', train_dir, True), ('validation', val_dir, False), ('test', test_dir, False)):
+        path = partition_path(split_path, snapshot_date) if window_days else split_path
+        with stage(f'write_{name}') as record:
+            frame = splits.filter(F.col('_split') == name).drop('_split')
+            if name != 'test':
+                frame = frame.drop(*SEGMENT_COLUMNS)
+            sharded = shards > 1 and name != 'test'
+            if sharded:
+                # round-robin repartitioning, so the part files have balanced row counts
+                frame = frame.repartition(shards)
+            writer = frame.write.mode('append' if incremental else 'overwrite')
+            if output_format == 'parquet':
+                writer.option('compression', PARQUET_CODECS[compression]).parquet(path)
+            else:
+                writer.option('compression', compression).csv(path, header=header)
+            if sharded and not window_days:
+                write_manifest(path, name)
+            record['rows'] = split_profiles.get(name, {}).get('rows', 0)
+            # appended part files of earlier runs would be counted too
+            record['bytes'] = None if incremental else path_bytes(path)
+else:
+    with stage('collect') as record:
+        df_pandas = data_final.toPandas()
+        record['rows'] = len(df_pandas)
+        # the memory the collected data takes on the driver
+        record['bytes'] = int(df_pandas.memory_usage(deep=True).sum())
+    with stage('split') as record:
+        train_df, val_df, test_df = driver_split(df_pandas)
+        train_df = train_df.drop(columns=SEGMENT_COLUMNS)
+        val_df = val_df.drop(columns=SEGMENT_COLUMNS)
+        record['rows'] = len(df_pandas)
+    del df_pandas
+    with stage('profile'):
+        save_profile(pandas_profile({'train': train_df, 'validation': val_df, 'test': test_df}))
+
+    # the train file keeps its header, validation and test have none
+    for name, df, split_path, header in (('train', train_df, train_dir, True), ('validation', val_df, val_dir, False)):
+        path = partition_path(split_path, snapshot_date) if window_days else split_path
+        with stage(f'write_{name}') as record:
+            if shards > 1:
+                record['bytes'] = write_shards(df, path, name, output_format, header, compression, shards,
+                                               manifest=not window_days)
+            else:
+                record['bytes'] = write_split(df, path, output_format, header, compression)
+            record['rows'] = len(df)
+    with stage('write_test') as record:
+        test_path = partition_path(test_dir, snapshot_date) if window_days else test_dir
+        record['bytes'] = write_split(test_df, test_path, output_format, False, compression)
+        record['rows'] = len(test_df)
+
+if window_days:
+    with stage('manifests'):
+        for name, split_path in (('train', train_dir), ('validation', val_dir), ('test', test_dir)):
+            files = write_window_manifest(split_path, name, snapshot_date, window_days)
+            logger.info(f"{name} window {window_partitions(snapshot_date, window_days)[0]} to {snapshot_date}: {files} files")
 
+publish_metrics(stage_metrics)
 job.commit()
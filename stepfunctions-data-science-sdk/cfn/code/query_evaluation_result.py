@@ -12,7 +12,9 @@ s3_client = boto3.client('s3')
 def lambda_handler(event, context):
     print(event)
     eval_res = event["EvaluationResult"]
-    eval_s3uri = f"{eval_res}evaluation.json"
+    # the scalar metrics of evaluation.json, without its ROC curve. GateMetric picks the one the
+    # gate compares, accuracy_lower for the lower bound of the confidence interval of accuracy
+    eval_s3uri = f"{eval_res}summary.json"
     
     bucket_name = eval_s3uri.replace('s3://', '').split('/')[0]
     key_name = eval_s3uri.replace(f's3://{bucket_name}/', '')
@@ -24,7 +26,7 @@ def lambda_handler(event, context):
 
     return {
         "statusCode": 200,
-        "trainingMetrics": s3clientlist["binary_classification_metrics"]["accuracy"]["value"],
+        "trainingMetrics": s3clientlist[event.get("GateMetric", "accuracy")],
         "RunJobName": event["RunJobName"],
         "trainTaskResult": event["trainTaskResult"]
     }
@@ -0,0 +1,233 @@
+import ast
+import gzip
+import json
+import os
+import subprocess
+import sys
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+CFN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(CFN_DIR, "code"))
+
+import churn_preprocessing  # noqa: E402
+import preprocessing_output  # noqa: E402
+
+SAMPLE_CSV = os.path.join(CFN_DIR, "..", "..", "data", "churn_processed.csv")
+GLUE_SCRIPT = os.path.join(CFN_DIR, "code", "glue_preprocessing.py")
+LOCAL_GLUE = os.path.join(CFN_DIR, "..", "..", "benchmarks", "local_glue.py")
+
+
+def load_glue_definitions(names, namespace):
+    """Run the named top-level definitions of the Glue script without running the job."""
+    with open(GLUE_SCRIPT) as f:
+        tree = ast.parse(f.read())
+    wanted = [
+        node for node in tree.body
+        if (isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) in names)
+        or (isinstance(node, ast.FunctionDef) and node.name in names)
+    ]
+    exec(compile(ast.Module(body=wanted, type_ignores=[]), GLUE_SCRIPT, "exec"), namespace)
+    return namespace
+
+
+def glue_driver_split(split_strategy, split_seed=42, split_ratios=(0.8, 0.19, 0.01)):
+    train_ratio, val_ratio, test_ratio = split_ratios
+    namespace = {
+        "np": np, "pd": pd, "split_strategy": split_strategy, "split_seed": split_seed,
+        "train_ratio": train_ratio, "val_ratio": val_ratio, "test_ratio": test_ratio,
+    }
+    names = {"test_cut", "val_cut", "GOLDEN_GAMMA", "MIX_1", "MIX_2", "customer_draw_np", "driver_split"}
+    return load_glue_definitions(names, namespace)["driver_split"]
+
+
+def run_sample(tmp_path, **kwargs):
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path) + "/")
+    counts = churn_preprocessing.run(SAMPLE_CSV, *paths, **kwargs)
+    return paths, counts
+
+
+def test_splits_partition_the_input(tmp_path):
+    (train_path, val_path, test_path), counts = run_sample(tmp_path)
+    rows = len(pd.read_csv(SAMPLE_CSV))
+    assert sum(counts.values()) == rows
+
+    train = pd.read_csv(train_path)
+    val = pd.read_csv(val_path, header=None)
+    test = pd.read_csv(test_path, header=None)
+    assert list(train.columns) == churn_preprocessing.OUTPUT_COLUMNS
+    assert val.shape[1] == len(churn_preprocessing.OUTPUT_COLUMNS)
+    # the test split carries the segment keys of the sliced evaluation after the features
+    assert test.shape[1] == len(churn_preprocessing.OUTPUT_COLUMNS) + len(churn_preprocessing.SEGMENT_COLUMNS)
+    assert set(test[test.columns[-1]]) <= {0, 50, 100, 150, 200}
+    ids = pd.concat([train["customerID"], val[2], test[2]])
+    assert len(ids) == rows
+    assert set(ids) == set(pd.read_csv(SAMPLE_CSV)["customerID"])
+
+
+def test_output_is_deterministic(tmp_path):
+    first, _ = run_sample(tmp_path / "first")
+    second, _ = run_sample(tmp_path / "second")
+    for a, b in zip(first, second):
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            assert fa.read() == fb.read()
+
+
+def test_customer_draw_matches_glue_script():
+    draw = load_glue_definitions({"GOLDEN_GAMMA", "MIX_1", "MIX_2", "customer_draw_np"}, {"np": np, "pd": pd})
+    ids = np.array([0, 1, 8966253, -5, 2 ** 53, np.nan])
+    for seed in (0, 42, 7919):
+        np.testing.assert_array_equal(
+            churn_preprocessing.customer_draw_np(ids, seed), draw["customer_draw_np"](ids, seed)
+        )
+
+
+@pytest.mark.parametrize("split_strategy", ["customer_hash", "random"])
+def test_split_matches_glue_driver_split(split_strategy):
+    data = churn_preprocessing.encode_features(churn_preprocessing.read_raw([SAMPLE_CSV]))
+    expected = glue_driver_split(split_strategy)(data)
+    actual = churn_preprocessing.split_frame(data, split_strategy)
+    for e, a in zip(expected, actual):
+        pd.testing.assert_frame_equal(e, a)
+
+
+@pytest.mark.parametrize("split_strategy", ["customer_hash", "random"])
+@pytest.mark.parametrize("split_mode", ["driver", "spark"])
+def test_glue_script_runs_end_to_end(tmp_path, split_mode, split_strategy):
+    pytest.importorskip("pyspark")
+    pytest.importorskip("boto3")
+    split_dirs = [str(tmp_path / split) for split in ("train", "validation", "test")]
+    # the driver mode writes single files with pandas, which does not create directories
+    for split_dir in split_dirs:
+        os.makedirs(split_dir)
+    command = [
+        sys.executable, LOCAL_GLUE, GLUE_SCRIPT, "--master", "local[2]", "--driver-memory", "1g",
+        "--bookmark-dir", str(tmp_path / "bookmarks"),
+        "--JOB_NAME", "local", "--INPUT_DIR", SAMPLE_CSV, "--TRAIN_DIR", split_dirs[0], "--VAL_DIR", split_dirs[1],
+        "--TEST_DIR", split_dirs[2], "--SPLIT_MODE", split_mode, "--SPLIT_STRATEGY", split_strategy,
+        "--METRICS_NAMESPACE", "none",
+    ]
+    subprocess.run(command, check=True)
+
+    with open(str(tmp_path / "profile" / "profile.json")) as f:
+        profile = json.load(f)
+    assert sum(split["rows"] for split in profile["splits"].values()) == len(pd.read_csv(SAMPLE_CSV))
+
+
+@pytest.mark.parametrize("split_strategy", ["customer_hash", "random"])
+def test_bytes_match_spark_driver_mode(tmp_path, split_strategy):
+    pytest.importorskip("pyspark")
+    from pyspark.sql import SparkSession, functions as F
+    from pyspark.sql.types import StructType, StructField, StringType, FloatType, DoubleType, LongType, BooleanType
+
+    spark = SparkSession.builder.master("local[2]").appName("churn-preprocessing-test").getOrCreate()
+    names = {"CHURN_SCHEMA", "SEGMENT_COLUMNS", "ACCOUNT_LENGTH_BUCKET", "ACCOUNT_LENGTH_BUCKETS", "encode_features"}
+    namespace = load_glue_definitions(names, {
+        "F": F, "StructType": StructType, "StructField": StructField, "StringType": StringType,
+        "FloatType": FloatType, "DoubleType": DoubleType, "LongType": LongType, "BooleanType": BooleanType,
+    })
+    raw = spark.read.csv(SAMPLE_CSV, schema=namespace["CHURN_SCHEMA"], header=True, sep=",", quote='"',
+                         enforceSchema=False)
+    train, val, test = glue_driver_split(split_strategy)(namespace["encode_features"](raw).toPandas())
+    expected = [
+        split.to_csv(index=False, header=header).encode("utf-8")
+        for split, header in zip((train.drop(columns=namespace["SEGMENT_COLUMNS"]),
+                                  val.drop(columns=namespace["SEGMENT_COLUMNS"]), test), (True, False, False))
+    ]
+
+    paths, _ = run_sample(tmp_path, split_strategy=split_strategy)
+    for path, body in zip(paths, expected):
+        with open(path, "rb") as f:
+            assert f.read() == body
+
+
+def test_chunked_and_gzip_output_match_a_single_write(tmp_path, monkeypatch):
+    plain, _ = run_sample(tmp_path / "plain")
+    monkeypatch.setattr(preprocessing_output, "WRITE_CHUNK_ROWS", 333)
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path / "gzip"), compression="gzip")
+    churn_preprocessing.run(SAMPLE_CSV, *paths, compression="gzip")
+    for a, b in zip(plain, paths):
+        assert os.path.basename(b) == os.path.basename(a) + ".gz"
+        with open(a, "rb") as fa, gzip.open(b, "rb") as fb:
+            assert fa.read() == fb.read()
+
+
+def test_zstd_needs_parquet(tmp_path):
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path))
+    with pytest.raises(ValueError):
+        churn_preprocessing.run(SAMPLE_CSV, *paths, compression="zstd")
+
+
+def test_parquet_features_are_numeric(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    import pyarrow.types
+
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path), output_format="parquet")
+    churn_preprocessing.run(SAMPLE_CSV, *paths, output_format="parquet")
+    for path, name in zip(paths, ("train", "validation", "test")):
+        schema = pq.read_schema(path)
+        # XGBoost's parquet reader only takes numeric columns, the segment keys are read by the evaluation
+        features = [field for field in schema if field.name not in churn_preprocessing.SEGMENT_COLUMNS]
+        assert [field.name for field in features] == churn_preprocessing.OUTPUT_COLUMNS
+        assert all(pyarrow.types.is_integer(field.type) or pyarrow.types.is_floating(field.type)
+                   for field in features), name
+        if name != "test":
+            assert len(features) == len(schema)
+
+
+def test_shards_are_balanced_and_listed_by_the_manifests(tmp_path):
+    plain, _ = run_sample(tmp_path / "plain")
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path / "sharded"))
+    churn_preprocessing.run(SAMPLE_CSV, *paths, shards=4)
+    for path, name, header in zip(paths[:2], ("train", "validation"), (0, None)):
+        with open(tmp_path / "sharded" / "manifests" / f"{name}.manifest") as f:
+            manifest = json.load(f)
+        assert manifest[0] == {"prefix": path + "/"}
+        assert manifest[1:] == [f"part-0000{i}.csv" for i in range(4)]
+        shards = [pd.read_csv(os.path.join(path, part), header=header) for part in manifest[1:]]
+        assert max(map(len, shards)) - min(map(len, shards)) <= 1
+        expected = pd.read_csv(plain[["train", "validation"].index(name)], header=header)
+        pd.testing.assert_frame_equal(pd.concat(shards, ignore_index=True), expected)
+    assert os.path.isfile(paths[2])
+
+
+def test_profile_matches_glue_driver_mode(tmp_path):
+    (train_path, _, _), counts = run_sample(tmp_path)
+    with open(preprocessing_output.profile_path(train_path)) as f:
+        profile = json.load(f)
+    assert {name: split["rows"] for name, split in profile["splits"].items()} == counts
+    for name, split in profile["splits"].items():
+        assert sum(split["label_counts"].values()) == split["rows"]
+        segments = churn_preprocessing.SEGMENT_COLUMNS if name == "test" else []
+        assert set(split["columns"]) == set(churn_preprocessing.OUTPUT_COLUMNS + segments)
+
+    data = churn_preprocessing.encode_features(churn_preprocessing.read_raw([SAMPLE_CSV]))
+    train, val, test = glue_driver_split("customer_hash")(data)
+    splits = {"train": train.drop(columns=churn_preprocessing.SEGMENT_COLUMNS),
+              "validation": val.drop(columns=churn_preprocessing.SEGMENT_COLUMNS), "test": test}
+    assert preprocessing_output.pandas_profile(splits) == profile["splits"]
+
+
+def test_window_manifests_list_only_the_partitions_in_the_window(tmp_path):
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path))
+    for day in (1, 2, 4):
+        churn_preprocessing.run(SAMPLE_CSV, *paths, shards=2 if day == 4 else 1, window_days=3,
+                                snapshot_date=date(2022, 6, day))
+    for path, name in zip(paths, ("train", "validation", "test")):
+        with open(tmp_path / "manifests" / f"{name}.manifest") as f:
+            manifest = json.load(f)
+        split_dir, file_name = os.path.dirname(path), os.path.basename(path)
+        assert manifest[0] == {"prefix": split_dir + "/"}
+        if name == "test":
+            expected = [f"snapshot_date=2022-06-0{day}/{file_name}" for day in (2, 4)]
+        else:
+            expected = [f"snapshot_date=2022-06-02/{file_name}"] + [
+                f"snapshot_date=2022-06-04/{file_name}/part-0000{i}.csv" for i in range(2)
+            ]
+        assert manifest[1:] == expected
+        assert all(os.path.isfile(os.path.join(split_dir, entry)) for entry in manifest[1:])
+    # older snapshots are kept for backfills
+    assert os.path.isfile(preprocessing_output.partition_path(paths[0], date(2022, 6, 1)))
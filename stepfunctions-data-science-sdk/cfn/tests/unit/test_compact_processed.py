@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+CFN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(CFN_DIR, "code"))
+
+import churn_preprocessing  # noqa: E402
+import compact_processed  # noqa: E402
+
+SAMPLE_CSV = os.path.join(CFN_DIR, "..", "..", "data", "churn_processed.csv")
+NOW = datetime(2022, 6, 4, 12)
+SPLIT_NAMES = ("train", "validation", "test")
+
+
+def read_manifest(processed_dir, name):
+    with open(os.path.join(processed_dir, "manifests", f"{name}.manifest")) as f:
+        prefix, *entries = json.load(f)
+    return [os.path.join(prefix["prefix"], entry) for entry in entries]
+
+
+def read_rows(paths, header):
+    frames = [pd.read_csv(path, header=0 if header else None) for path in paths]
+    return pd.concat(frames, ignore_index=True).sort_values(frames[0].columns[2]).reset_index(drop=True)
+
+
+def test_plan_merges_keeps_large_files_and_the_shard_count():
+    files = [(f"part-{i}", size) for i, size in enumerate([10, 10, 10, 10, 10, 10, 80, 10])]
+    groups = compact_processed.plan_merges(files, target_bytes=100)
+    assert sorted(path for group in groups for path in group) == [f"part-{i}" for i in (0, 1, 2, 3, 4, 5, 7)]
+    assert len(groups) == 1
+    groups = compact_processed.plan_merges(files, target_bytes=100, min_files=4)
+    assert len(groups) == 3
+    assert compact_processed.plan_merges(files[:4], target_bytes=100, min_files=4) == []
+
+
+def test_compaction_swaps_the_manifests_and_deletes_after_the_retention(tmp_path):
+    processed = str(tmp_path)
+    paths = churn_preprocessing.output_paths(processed_dir=processed)
+    churn_preprocessing.run(SAMPLE_CSV, *paths, shards=8)
+    originals = [compact_processed.list_files(path) for path in paths]
+    expected = [read_rows(sorted(files), name == "train") for files, name in zip(originals, SPLIT_NAMES)]
+
+    counts = compact_processed.compact(paths, target_bytes=1024 ** 2, shards=2, now=NOW)
+    assert counts == {"merged": 16, "written": 4, "deleted": 0}
+    for path, name, rows in zip(paths, SPLIT_NAMES, expected):
+        entries = read_manifest(processed, name)
+        assert len(entries) == (2 if name != "test" else 1)
+        pd.testing.assert_frame_equal(read_rows(entries, name == "train"), rows)
+    # readers holding the old manifests can still read the replaced files
+    assert all(os.path.isfile(path) for files in originals for path in files)
+
+    counts = compact_processed.compact(paths, target_bytes=1024 ** 2, shards=2, now=NOW + timedelta(hours=25))
+    assert counts == {"merged": 0, "written": 0, "deleted": 16}
+    for path, name, rows in zip(paths, SPLIT_NAMES, expected):
+        entries = read_manifest(processed, name)
+        assert sorted(compact_processed.list_files(path)) == sorted(entries)
+        pd.testing.assert_frame_equal(read_rows(entries, name == "train"), rows)
+    assert os.listdir(os.path.join(processed, "compaction")) == []
+
+
+def test_window_manifests_point_at_the_merged_files(tmp_path):
+    processed = str(tmp_path)
+    paths = churn_preprocessing.output_paths(processed_dir=processed)
+    for day in (2, 3):
+        churn_preprocessing.run(SAMPLE_CSV, *paths, shards=4, window_days=2, snapshot_date=date(2022, 6, day))
+    before = read_manifest(processed, "train")
+
+    compact_processed.compact(paths, window_days=2, target_bytes=1024 ** 2, now=NOW)
+    after = read_manifest(processed, "train")
+    assert [os.path.dirname(entry) for entry in after] == sorted({os.path.dirname(entry) for entry in before})
+    pd.testing.assert_frame_equal(read_rows(after, True), read_rows(before, True))
+
+    # the next preprocessing run lists the replaced files of the window again
+    churn_preprocessing.run(SAMPLE_CSV, *paths, shards=4, window_days=2, snapshot_date=date(2022, 6, 3))
+    compact_processed.compact(paths, window_days=2, target_bytes=1024 ** 2, now=NOW + timedelta(hours=1))
+    assert len(read_manifest(processed, "train")) == 2
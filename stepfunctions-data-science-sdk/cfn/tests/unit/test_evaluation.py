@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import pathlib
+import sys
+
+import pandas as pd
+import pytest
+
+CFN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(CFN_DIR, "code"))
+
+boto3 = pytest.importorskip("boto3")
+xgboost = pytest.importorskip("xgboost")
+import churn_preprocessing  # noqa: E402
+import evaluation  # noqa: E402
+
+SAMPLE_CSV = os.path.join(CFN_DIR, "..", "..", "data", "churn_processed.csv")
+
+
+@pytest.fixture
+def trained_model(tmp_path):
+    """A small model trained on the train split of the sample, and the paths of the three splits."""
+    paths = churn_preprocessing.output_paths(processed_dir=str(tmp_path / "processed"))
+    churn_preprocessing.run(SAMPLE_CSV, *paths)
+    train = pd.read_csv(paths[0])
+    model = xgboost.train({"objective": "binary:logistic", "max_depth": 3},
+                          xgboost.DMatrix(train.iloc[:, 1:].values, label=train.iloc[:, 0]), num_boost_round=5)
+    return model, paths
+
+
+def test_manifest_layout_gives_the_report_of_a_single_file(tmp_path, trained_model):
+    model, (_, _, test_path) = trained_model
+    # the files of a window or compaction manifest, downloaded under their relative paths
+    test = pd.read_csv(test_path, header=None)
+    for i, part in enumerate((test[:len(test) // 2], test[len(test) // 2:])):
+        path = tmp_path / "manifest" / f"snapshot_date=2022-06-0{i + 1}" / "test.csv"
+        path.parent.mkdir(parents=True)
+        part.to_csv(path, header=False, index=False)
+
+    (single, single_summary, _), single_segments = evaluation.evaluate(
+        model, evaluation.load_test_data(os.path.dirname(test_path)))
+    (parts, parts_summary, _), parts_segments = evaluation.evaluate(
+        model, evaluation.load_test_data(str(tmp_path / "manifest")))
+    assert json.dumps(parts) == json.dumps(single)
+    assert parts_summary == single_summary
+    assert evaluation.evaluation_metrics.segment_report(parts_segments) == \
+        evaluation.evaluation_metrics.segment_report(single_segments)
+    assert sum(sum(row.values()) for row in single["binary_classification_metrics"]["confusion_matrix"].values()) \
+        == len(test)
+
+
+def test_streamed_chunks_give_the_confusion_matrix_of_the_whole_split(trained_model):
+    model, (_, _, test_path) = trained_model
+    files = evaluation.test_files(os.path.dirname(test_path))
+    (whole, _, _), whole_segments = evaluation.evaluate(model, evaluation.load_test_data(os.path.dirname(test_path)))
+    state, segments = evaluation.evaluate_stream(model, files, chunk_rows=50)
+    streamed = evaluation.evaluation_metrics.state_report(state)
+    for name in ("accuracy", "precision", "recall", "confusion_matrix"):
+        assert streamed["binary_classification_metrics"][name] == whole["binary_classification_metrics"][name]
+    # the segment keys are read as text, whatever the type pandas gives them in memory
+    report = evaluation.evaluation_metrics.segment_report(segments)
+    assert report == evaluation.evaluation_metrics.segment_report(whole_segments)
+    assert sum(segment["rows"] for segment in report["slicings"]["State"]) == state["confusion_matrix"].sum()
+
+
+class FakeS3:
+    """The S3 calls of merge_handler, on a dict of keys of a single bucket."""
+
+    def __init__(self, objects):
+        self.objects = dict(objects)
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            del self.objects[item["Key"]]
+
+
+def test_merge_handler_merges_the_states_of_every_instance(tmp_path, monkeypatch, trained_model):
+    model, (_, _, test_path) = trained_model
+    test = pd.read_csv(test_path, header=None)
+    for i, part in enumerate((test[:len(test) // 2], test[len(test) // 2:])):
+        part.to_csv(tmp_path / f"part-{i}.csv", header=False, index=False)
+
+    # what the main block of each instance saves under states/ of EvaluationResult
+    objects = {}
+    for i in range(2):
+        state, segments = evaluation.evaluate_stream(model, [tmp_path / f"part-{i}.csv"], chunk_rows=10)
+        evaluation.evaluation_metrics.save_state(state, tmp_path / "state.npz")
+        evaluation.evaluation_metrics.save_segment_state(segments, tmp_path / "segments.npz")
+        objects[f"evaluation/states/algo-{i + 1}.npz"] = (tmp_path / "state.npz").read_bytes()
+        objects[f"evaluation/states/algo-{i + 1}-segments.npz"] = (tmp_path / "segments.npz").read_bytes()
+    s3 = FakeS3(objects)
+    monkeypatch.setattr(evaluation, "s3_client", s3)
+
+    assert evaluation.merge_handler({"EvaluationResult": "s3://bucket/evaluation/", "InstanceCount": 2}, None) \
+        == {"merged": 2}
+    assert sorted(s3.objects) == ["evaluation/evaluation.json", "evaluation/segments.json", "evaluation/summary.json"]
+    state, segments = evaluation.evaluate_stream(model, [pathlib.Path(test_path)], chunk_rows=10)
+    expected = evaluation.evaluation_metrics.output_files(
+        evaluation.evaluation_metrics.state_outputs(state, resamples=evaluation.BOOTSTRAP_RESAMPLES),
+        segments=segments)
+    for name, body in expected.items():
+        assert json.loads(s3.objects[f"evaluation/{name}"]) == json.loads(body)
@@ -0,0 +1,242 @@
+import io
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+CFN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(CFN_DIR, "code"))
+
+metrics = pytest.importorskip("sklearn.metrics")
+import evaluation_metrics  # noqa: E402
+
+
+def scores(dtype, n=5000, seed=7):
+    rng = np.random.default_rng(seed)
+    y_true = rng.integers(0, 2, n)
+    # rounded scores have many ties, as the probabilities of a small booster do
+    y_score = np.clip(0.35 * y_true + rng.normal(0.35, 0.2, n), -0.5, 1.5).round(2).astype(dtype)
+    y_score[:3] = (0.5, -0.25, 0.0)
+    return y_true, y_score
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_curves_and_scores_match_sklearn(dtype):
+    y_true, y_score = scores(dtype)
+    counts = evaluation_metrics.curve_counts(y_true, y_score)
+    predictions = np.round(y_score)
+
+    np.testing.assert_array_equal(evaluation_metrics.confusion_matrix(counts),
+                                  metrics.confusion_matrix(y_true, predictions))
+    sweep = evaluation_metrics.threshold_sweep(counts, [0.5])
+    assert sweep["precision"][0] == metrics.precision_score(y_true, predictions)
+    assert sweep["recall"][0] == metrics.recall_score(y_true, predictions)
+    assert sweep["accuracy"][0] == metrics.accuracy_score(y_true, predictions)
+
+    for drop_intermediate in (True, False):
+        expected = metrics.roc_curve(y_true, y_score, drop_intermediate=drop_intermediate)
+        actual = evaluation_metrics.roc_curve(counts, drop_intermediate=drop_intermediate)
+        for e, a in zip(expected, actual):
+            np.testing.assert_array_equal(a, e)
+    for e, a in zip(metrics.precision_recall_curve(y_true, y_score), evaluation_metrics.precision_recall_curve(counts)):
+        np.testing.assert_array_equal(a, e)
+    assert evaluation_metrics.roc_auc(counts) == pytest.approx(metrics.roc_auc_score(y_true, y_score), abs=1e-12)
+    assert evaluation_metrics.average_precision(counts) == \
+        pytest.approx(metrics.average_precision_score(y_true, y_score), abs=1e-12)
+
+
+def test_threshold_sweep_matches_sklearn_at_every_threshold():
+    y_true, y_score = scores(np.float32, n=500)
+    thresholds = np.linspace(-0.6, 1.6, 45)
+    sweep = evaluation_metrics.threshold_sweep(evaluation_metrics.curve_counts(y_true, y_score), thresholds)
+    for i, threshold in enumerate(thresholds):
+        predictions = y_score > threshold
+        (tn, fp), (fn, tp) = metrics.confusion_matrix(y_true, predictions, labels=[0, 1])
+        assert (sweep["tn"][i], sweep["fp"][i], sweep["fn"][i], sweep["tp"][i]) == (tn, fp, fn, tp)
+        assert sweep["precision"][i] == metrics.precision_score(y_true, predictions, zero_division=0)
+
+
+def test_lift_and_gain():
+    y_true = np.array([1, 1, 0, 1, 0, 0, 0, 0, 0, 0])
+    y_score = np.linspace(1, 0, 10)
+    lift = evaluation_metrics.lift_gain(evaluation_metrics.curve_counts(y_true, y_score), bins=5)
+    np.testing.assert_allclose(lift["gain"], [2 / 3, 1, 1, 1, 1])
+    np.testing.assert_allclose(lift["lift"], [10 / 3, 2.5, 5 / 3, 1.25, 1])
+    # a tie spreads its positives evenly over its rows
+    tied = evaluation_metrics.lift_gain(evaluation_metrics.curve_counts(y_true, np.zeros(10)), bins=2)
+    np.testing.assert_allclose(tied["gain"], [0.5, 1])
+
+
+def test_evaluation_report_matches_the_sklearn_report():
+    y_true, y_score = scores(np.float32)
+    predictions = np.round(y_score)
+    conf_matrix = metrics.confusion_matrix(y_true, predictions)
+    fpr, tpr, _ = metrics.roc_curve(y_true, y_score)
+    report = evaluation_metrics.evaluation_report(y_true, y_score, max_error=0)["binary_classification_metrics"]
+    assert report["accuracy"]["value"] == metrics.accuracy_score(y_true, predictions)
+    assert report["confusion_matrix"] == {
+        "0": {"0": int(conf_matrix[0][0]), "1": int(conf_matrix[0][1])},
+        "1": {"0": int(conf_matrix[1][0]), "1": int(conf_matrix[1][1])},
+    }
+    assert report["receiver_operating_characteristic_curve"] == {
+        "false_positive_rates": list(fpr), "true_positive_rates": list(tpr),
+    }
+
+
+def test_downsampled_roc_curve_is_within_the_error_of_every_point():
+    rng = np.random.default_rng(11)
+    y_true = rng.integers(0, 2, 50_000)
+    y_score = rng.beta(2 + y_true, 3 - y_true).astype(np.float32)
+    report, summary, (fpr, tpr, _) = evaluation_metrics.evaluation_outputs(y_true, y_score, max_error=0.01)
+    curve = report["binary_classification_metrics"]["receiver_operating_characteristic_curve"]
+    assert len(curve["false_positive_rates"]) == summary["roc_points"] <= 4 / 0.01 + 2 < fpr.size
+
+    keep = evaluation_metrics.downsample_roc(fpr, tpr, 0.01)
+    np.testing.assert_array_equal(fpr[keep], curve["false_positive_rates"])
+    # every point lies in the box of the kept points around it
+    after = keep[np.searchsorted(keep, np.arange(fpr.size))]
+    before = keep[np.searchsorted(keep, np.arange(fpr.size), side="right") - 1]
+    assert np.all(fpr[after] - fpr[before] < 0.01) and np.all(tpr[after] - tpr[before] < 0.01)
+    area = np.sum(np.diff(fpr[keep]) * (tpr[keep][1:] + tpr[keep][:-1])) / 2
+    assert abs(area - summary["auc"]) <= 0.01
+    assert summary["auc"] == pytest.approx(metrics.roc_auc_score(y_true, y_score), abs=1e-12)
+    assert summary["accuracy"] == report["binary_classification_metrics"]["accuracy"]["value"]
+
+
+def test_output_files():
+    y_true, y_score = scores(np.float32)
+    outputs = evaluation_metrics.evaluation_outputs(y_true, y_score)
+    files = evaluation_metrics.output_files(outputs)
+    assert sorted(files) == ["evaluation.json", "summary.json"]
+    assert json.loads(files["summary.json"]) == outputs[1]
+    with np.load(io.BytesIO(evaluation_metrics.output_files(outputs, full_roc_curve=True)["roc_curve.npz"])) as roc:
+        for name, expected in zip(("fpr", "tpr", "thresholds"), metrics.roc_curve(y_true, y_score)):
+            np.testing.assert_array_equal(roc[name], expected)
+
+
+def test_labels_must_be_binary():
+    with pytest.raises(ValueError):
+        evaluation_metrics.curve_counts([0, 1, 2], [0.1, 0.2, 0.3])
+
+
+def test_merged_chunk_states_give_the_report_of_all_scores():
+    y_true, y_score = scores(np.float32)
+    # scores on the grid of the histogram make every bin a single distinct score
+    y_score = (np.clip(y_score, 0, 1) * 256).round().astype(np.float32) / 256
+    states = [
+        evaluation_metrics.update_state(evaluation_metrics.metric_state(bins=256), y_true[start:start + 700],
+                                        y_score[start:start + 700])
+        for start in range(0, len(y_true), 700)
+    ]
+    state = evaluation_metrics.merge_states(states)
+    assert evaluation_metrics.state_report(state) == evaluation_metrics.evaluation_report(y_true, y_score)
+    assert evaluation_metrics.roc_auc(evaluation_metrics.state_counts(state)) == \
+        pytest.approx(metrics.roc_auc_score(y_true, y_score), abs=1e-12)
+
+
+def test_state_auc_error_is_bounded_by_the_pairs_within_a_bin(tmp_path):
+    rng = np.random.default_rng(3)
+    y_true = rng.integers(0, 2, 100_000)
+    y_score = rng.beta(2 + 2 * y_true, 4 - 2 * y_true).astype(np.float32)
+    state = evaluation_metrics.update_state(evaluation_metrics.metric_state(), y_true, y_score)
+    evaluation_metrics.save_state(state, tmp_path / "state.npz")
+    state = evaluation_metrics.load_state(tmp_path / "state.npz")
+
+    negatives, positives = state["histogram"]
+    bound = 0.5 * np.sum(negatives * positives) / (negatives.sum() * positives.sum())
+    assert abs(evaluation_metrics.roc_auc(evaluation_metrics.state_counts(state))
+               - metrics.roc_auc_score(y_true, y_score)) <= bound
+    np.testing.assert_array_equal(state["confusion_matrix"], metrics.confusion_matrix(y_true, y_score > 0.5))
+
+
+def test_states_of_different_grids_do_not_merge():
+    with pytest.raises(ValueError):
+        evaluation_metrics.merge_states([evaluation_metrics.metric_state(bins=256), evaluation_metrics.metric_state()])
+
+
+def test_bootstrap_matches_resampling_the_rows():
+    rng = np.random.default_rng(5)
+    y_true, y_score = scores(np.float32, n=4000)
+    counts = evaluation_metrics.curve_counts(y_true, y_score)
+    above = int(np.searchsorted(-counts[0].astype(np.float64), -0.5))
+    # few groups, so that the AUC of the resamples needs the shift
+    intervals = evaluation_metrics.bootstrap(counts, above, resamples=2000, groups=32)
+    assert evaluation_metrics.bootstrap(counts, above, resamples=2000, groups=32) == intervals
+
+    rows = rng.integers(0, y_true.size, (400, y_true.size))
+    resampled = {
+        "accuracy": [metrics.accuracy_score(y_true[r], y_score[r] > 0.5) for r in rows],
+        "recall": [metrics.recall_score(y_true[r], y_score[r] > 0.5) for r in rows],
+        "auc": [metrics.roc_auc_score(y_true[r], y_score[r]) for r in rows],
+    }
+    for name, values in resampled.items():
+        assert intervals[name]["standard_deviation"] == pytest.approx(np.std(values), rel=0.2)
+        assert intervals[name]["lower"] == pytest.approx(np.percentile(values, 2.5), abs=np.std(values) / 2)
+        assert intervals[name]["upper"] == pytest.approx(np.percentile(values, 97.5), abs=np.std(values) / 2)
+
+
+def test_summary_without_bootstrap():
+    y_true, y_score = scores(np.float32)
+    report, summary, _ = evaluation_metrics.evaluation_outputs(y_true, y_score, resamples=0)
+    assert report["binary_classification_metrics"]["accuracy"]["standard_deviation"] is None
+    assert summary["accuracy_lower"] == summary["accuracy"] == summary["accuracy_upper"]
+
+
+def reject_constant(name):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+@pytest.mark.parametrize("resamples", [0, 1, 200])
+def test_output_files_of_a_single_class_are_valid_json(resamples):
+    y_true = np.ones(50, dtype=np.int64)
+    y_score = np.linspace(0.1, 0.9, 50, dtype=np.float32)
+    files = evaluation_metrics.output_files(evaluation_metrics.evaluation_outputs(y_true, y_score, resamples=resamples))
+    report = json.loads(files["evaluation.json"], parse_constant=reject_constant)
+    summary = json.loads(files["summary.json"], parse_constant=reject_constant)
+    assert summary["auc"] is None
+    assert summary["auc_standard_deviation"] is summary["auc_lower"] is summary["auc_upper"] is None
+    assert set(report["binary_classification_metrics"]["receiver_operating_characteristic_curve"]
+               ["false_positive_rates"]) == {None}
+    assert summary["recall_lower"] is not None
+
+
+def test_segment_report_matches_the_metrics_of_each_segment(tmp_path):
+    y_true, y_score = scores(np.float32, n=20_000)
+    rng = np.random.default_rng(13)
+    segments = np.stack([rng.choice(["OH", "NJ", "TX"], y_true.size), rng.choice(["yes", "no"], y_true.size)], axis=1)
+    chunks = [
+        evaluation_metrics.update_segment_state(evaluation_metrics.segment_state(["State", "Int_l_Plan"]),
+                                                y_true[start:start + 3000], y_score[start:start + 3000],
+                                                segments[start:start + 3000])
+        for start in range(0, y_true.size, 3000)
+    ]
+    evaluation_metrics.save_segment_state(evaluation_metrics.merge_segment_states(chunks),
+                                          tmp_path / "segments.npz")
+    state = evaluation_metrics.load_segment_state(tmp_path / "segments.npz")
+    whole = evaluation_metrics.update_segment_state(evaluation_metrics.segment_state(["State", "Int_l_Plan"]),
+                                                    y_true, y_score, segments)
+    report = evaluation_metrics.segment_report(state)
+    assert report == evaluation_metrics.segment_report(whole)
+    assert list(report["slicings"]) == ["State", "Int_l_Plan", "State,Int_l_Plan"]
+    assert len(report["slicings"]["State,Int_l_Plan"]) == 6
+
+    for segment in report["slicings"]["State"] + report["slicings"]["State,Int_l_Plan"]:
+        rows = (segments[:, 0] == segment["State"]) & (segments[:, 1] == segment.get("Int_l_Plan", segments[:, 1]))
+        predictions = y_score[rows] > 0.5
+        assert segment["rows"] == rows.sum()
+        assert segment["accuracy"] == metrics.accuracy_score(y_true[rows], predictions)
+        assert segment["precision"] == metrics.precision_score(y_true[rows], predictions)
+        assert segment["recall"] == metrics.recall_score(y_true[rows], predictions)
+        assert abs(segment["auc"] - metrics.roc_auc_score(y_true[rows], y_score[rows])) <= segment["auc_max_error"]
+
+
+def test_segments_of_a_single_class_have_no_auc():
+    state = evaluation_metrics.update_segment_state(evaluation_metrics.segment_state(["Int_l_Plan"]),
+                                                    [1, 1, 0], [0.2, 0.9, 0.4], [["yes"], ["yes"], ["no"]])
+    no, yes = evaluation_metrics.segment_report(state)["slicings"]["Int_l_Plan"]
+    assert (no["Int_l_Plan"], no["auc"], no["auc_max_error"]) == ("no", None, None)
+    assert (yes["rows"], yes["positives"], yes["recall"], yes["auc"]) == (2, 2, 0.5, None)
+    with pytest.raises(ValueError):
+        evaluation_metrics.merge_segment_states([state, evaluation_metrics.segment_state(["State"])])
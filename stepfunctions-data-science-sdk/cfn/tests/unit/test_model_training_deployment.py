@@ -0,0 +1,35 @@
+import ast
+import os
+
+import pytest
+
+CFN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+JOB_SCRIPT = os.path.join(CFN_DIR, "..", "..", "glue-workflow", "code", "model_training_deployment.py")
+
+
+def load_model_run():
+    """The ModelRun class of the Glue workflow job, without the awsglue and boto3 set-up of its module."""
+    with open(JOB_SCRIPT) as f:
+        tree = ast.parse(f.read())
+    wanted = [node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == "ModelRun"]
+    namespace = {}
+    exec(compile(ast.Module(body=wanted, type_ignores=[]), JOB_SCRIPT, "exec"), namespace)
+    return namespace["ModelRun"]
+
+
+@pytest.fixture
+def model_run():
+    run = object.__new__(load_model_run())
+    run.gate_metric = "accuracy_lower"
+    run.evaluation_threshold = 0.9
+    return run
+
+
+@pytest.mark.parametrize("value, deployed", [(0.95, True), (0.9, True), (0.85, False)])
+def test_gate_compares_the_metric_with_the_threshold(model_run, value, deployed):
+    assert model_run.review_evaluation_result(value) is deployed
+
+
+def test_undefined_gate_metric_fails_the_gate(model_run, capsys):
+    assert model_run.review_evaluation_result(None) is False
+    assert "accuracy_lower metric is missing from the evaluation summary or undefined" in capsys.readouterr().out
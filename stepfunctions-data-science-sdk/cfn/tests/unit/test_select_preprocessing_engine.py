@@ -0,0 +1,74 @@
+import os
+import sys
+
+import pytest
+
+CFN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(CFN_DIR, "code"))
+
+boto3 = pytest.importorskip("boto3")
+import select_preprocessing_engine  # noqa: E402
+
+OBJECTS = [("input/b.csv", 10, '"etag-b"'), ("input/a.csv", 20, '"etag-a"')]
+PARAMETERS = {"scriptVersion": "abc", "outputFormat": "csv", "compression": "none", "shards": 1}
+
+
+def test_fingerprint_ignores_listing_order():
+    assert select_preprocessing_engine.fingerprint(OBJECTS, PARAMETERS) == \
+        select_preprocessing_engine.fingerprint(OBJECTS[::-1], dict(reversed(list(PARAMETERS.items()))))
+
+
+@pytest.mark.parametrize("objects, parameters", [
+    ([("input/b.csv", 10, '"etag-changed"'), OBJECTS[1]], PARAMETERS),
+    (OBJECTS + [("input/c.csv", 5, '"etag-c"')], PARAMETERS),
+    (OBJECTS, dict(PARAMETERS, scriptVersion="def")),
+    (OBJECTS, dict(PARAMETERS, shards=4)),
+])
+def test_fingerprint_changes_with_inputs_scripts_and_settings(objects, parameters):
+    assert select_preprocessing_engine.fingerprint(objects, parameters) != \
+        select_preprocessing_engine.fingerprint(OBJECTS, PARAMETERS)
+
+
+def test_fingerprint_of_a_window_run_changes_with_the_day_of_its_snapshot():
+    window = dict(PARAMETERS, windowDays=7)
+    first = select_preprocessing_engine.fingerprint(OBJECTS, dict(window, snapshotDate="2022-06-01T08:00:00.000Z"))
+    assert first == select_preprocessing_engine.fingerprint(OBJECTS, dict(window, snapshotDate="2022-06-01T23:59:59.999Z"))
+    assert first != select_preprocessing_engine.fingerprint(OBJECTS, dict(window, snapshotDate="2022-06-02T00:00:00.000Z"))
+
+
+def test_choose_engine():
+    assert select_preprocessing_engine.choose_engine(10, max_bytes=10) == "python"
+    assert select_preprocessing_engine.choose_engine(11, max_bytes=10) == "spark"
+
+
+def test_small_inputs_use_the_python_engine():
+    plan = select_preprocessing_engine.plan_capacity(300 * 1024, max_python_bytes=256 * 1024 * 1024)
+    assert plan["engine"] == "python" and plan["numberOfWorkers"] is None
+
+
+@pytest.mark.parametrize("gigabytes", [1, 10, 100, 300])
+def test_spark_plan_meets_the_target_within_the_worker_limits(gigabytes):
+    model = select_preprocessing_engine.CAPACITY_MODEL
+    plan = select_preprocessing_engine.plan_capacity(gigabytes * 1024 ** 3, max_python_bytes=0)
+    assert plan["engine"] == "spark"
+    assert model["MIN_WORKERS"] <= plan["numberOfWorkers"] <= model["MAX_WORKERS"]
+    if plan["numberOfWorkers"] < model["MAX_WORKERS"]:
+        assert plan["estimatedSeconds"] <= model["TARGET_SECONDS"]
+
+
+def test_plans_grow_with_the_input():
+    plans = [select_preprocessing_engine.plan_capacity(gb * 1024 ** 3, max_python_bytes=0) for gb in (1, 10, 100, 1000)]
+    dpus = [p["numberOfWorkers"] * (2 if p["workerType"] == "G.2X" else 1) for p in plans]
+    assert dpus == sorted(dpus) and dpus[0] < dpus[-1]
+
+
+def test_calibration_uses_the_median_throughput_of_spark_runs():
+    model = select_preprocessing_engine.CAPACITY_MODEL
+    startup = model["SPARK_STARTUP_SECONDS"]
+    runs = [
+        {"engine": "spark", "workerType": "G.1X", "numberOfWorkers": 2, "inputBytes": 2 * rate * 100,
+         "executionSeconds": startup + 100}
+        for rate in (1e6, 2e6, 3e6)
+    ] + [{"engine": "python", "workerType": None, "numberOfWorkers": None, "inputBytes": 1, "executionSeconds": 30}]
+    assert select_preprocessing_engine.calibrate(runs[:2]) == model
+    assert select_preprocessing_engine.calibrate(runs)["SPARK_BYTES_PER_WORKER_SECOND"] == pytest.approx(2e6)
@@ -1,28 +1,106 @@
 import json
 import os
+import sys
 import tarfile
 import pathlib
 import pandas as pd
-import subprocess
 import numpy as np
 
-subprocess.run("pip install xgboost", shell=True)
+# runs in the SageMaker XGBoost training image: xgboost, joblib and pyarrow (for
+# test splits written with OUTPUT_FORMAT=parquet) are installed, nothing is pulled from PyPI
 import xgboost
 
-from sklearn.externals import joblib
-from sklearn.metrics import (
-    accuracy_score,
-    precision_score,
-    recall_score,
-    confusion_matrix,
-    roc_curve,
-)
+import joblib
+
+# evaluation_metrics.py comes with a processing input of its own
+sys.path.append("/opt/ml/processing/input/metrics")
+import evaluation_metrics
+
 import logging
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+# Above 0 the test split is streamed in chunks of this many rows into a metric state of constant
+# size, see evaluation_metrics.metric_state, instead of being read at once
+EVALUATION_CHUNK_ROWS = int(os.environ.get('EVALUATION_CHUNK_ROWS', 0))
+# also write the full ROC curve, one point per distinct score, to roc_curve.npz next to the
+# downsampled one of evaluation.json
+FULL_ROC_CURVE = os.environ.get('FULL_ROC_CURVE', 'false') == 'true'
+# resamples of the bootstrap confidence intervals of summary.json, 0 skips the bootstrap
+BOOTSTRAP_RESAMPLES = int(os.environ.get('BOOTSTRAP_RESAMPLES', evaluation_metrics.BOOTSTRAP_RESAMPLES))
+# the segment keys the preprocessing job appends to the test split after the features, see
+# SEGMENT_COLUMNS in glue_preprocessing.py: segments.json slices the metrics by them
+SEGMENT_KEYS = ['State', 'Area_Code', 'Int_l_Plan', 'Account_Length']
+
+
+def test_files(test_dir):
+    """
+    The files of the test split, either a single file or the part files written by the Spark
+    split of the preprocessing job, as CSV, gzip CSV or Parquet (empty part files are skipped).
+    """
+    files = sorted(p for p in pathlib.Path(test_dir).rglob("*") if p.is_file() and p.stat().st_size > 0)
+    parquet_files = [f for f in files if f.suffix == ".parquet"]
+    return parquet_files or [f for f in files if f.name.endswith((".csv", ".csv.gz"))]
+
+
+def load_test_data(test_dir):
+    """Read the test split with the label in column 0."""
+    files = test_files(test_dir)
+    if files and files[0].suffix == ".parquet":
+        df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+        # match the positional columns of a header-less CSV
+        df.columns = range(df.shape[1])
+        return df
+    return pd.concat([pd.read_csv(f, header=None) for f in files], ignore_index=True)
+
+
+def has_segments(df):
+    """Whether a test split frame ends with the SEGMENT_KEYS columns, the first of which is text."""
+    return df.shape[1] > len(SEGMENT_KEYS) + 1 and \
+        not pd.api.types.is_numeric_dtype(df.dtypes.iloc[-len(SEGMENT_KEYS)])
+
+
+def split_segments(df):
+    """(label and features as float32, segment key values as strings or None) of a test split frame."""
+    if not has_segments(df):
+        return df.to_numpy(dtype=np.float32), None
+    features = df.shape[1] - len(SEGMENT_KEYS)
+    return df.iloc[:, :features].to_numpy(dtype=np.float32), df.iloc[:, features:].astype(str).to_numpy()
+
+
+def iter_test_chunks(files, chunk_rows):
+    """Data frames of at most chunk_rows rows of the test files, label in column 0."""
+    for f in files:
+        if f.suffix == ".parquet":
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(f).iter_batches(batch_size=chunk_rows):
+                yield batch.to_pandas()
+        else:
+            # the first row tells the float32 columns from the segment keys
+            head = pd.read_csv(f, header=None, nrows=1)
+            text = len(SEGMENT_KEYS) if has_segments(head) else 0
+            dtype = {i: str if i >= head.shape[1] - text else np.float32 for i in range(head.shape[1])}
+            yield from pd.read_csv(f, header=None, dtype=dtype, chunksize=chunk_rows)
+
+
+def evaluate_stream(model, files, chunk_rows):
+    """
+    The metric state and segment state of the model on the test files, scored chunk_rows rows
+    at a time. The segment state stays empty for test splits without segment keys.
+    """
+    state = evaluation_metrics.metric_state()
+    segments = evaluation_metrics.segment_state(SEGMENT_KEYS)
+    for chunk in iter_test_chunks(files, chunk_rows):
+        values, keys = split_segments(chunk)
+        scores = model.predict(xgboost.DMatrix(values[:, 1:]))
+        evaluation_metrics.update_state(state, values[:, 0], scores)
+        if keys is not None:
+            evaluation_metrics.update_segment_state(segments, values[:, 0], scores, keys)
+    return state, segments
+
+
 if __name__ == "__main__":
     model_path = os.path.join("/opt/ml/processing/model", "model.tar.gz")
     print("Extracting model from path: {}".format(model_path))
@@ -30,54 +108,37 @@ if __name__ == "__main__":
         tar.extractall(path=".")
     
     model = joblib.load("xgboost-model")
-    test_data = os.path.join("/opt/ml/processing/test", "test.csv")
-    
-    test_data_pd = pd.read_csv(test_data, header=None)
-    
-    y_test = test_data_pd.iloc[:, 0].to_numpy()
-    test_data_pd.drop(test_data_pd.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(test_data_pd.values)
-    
-    prediction_probabilities = model.predict(X_test)
-    predictions = np.round(prediction_probabilities)
-
-    precision = precision_score(y_test, predictions)
-    recall = recall_score(y_test, predictions)
-    accuracy = accuracy_score(y_test, predictions)
-    conf_matrix = confusion_matrix(y_test, predictions)
-    fpr, tpr, _ = roc_curve(y_test, prediction_probabilities)
-
-    logger.debug("Accuracy: {}".format(accuracy))
-    logger.debug("Precision: {}".format(precision))
-    logger.debug("Recall: {}".format(recall))
-    logger.debug("Confusion matrix: {}".format(conf_matrix))
-    
-    """
-    Need to customise the formation of evaluation.json to visualize the metrics in model registry based-on tasks
-    Result should coincide in format with the result by sagemaker.workflow.quality_check_step.QualityCheckStep.
-    Binarry
-    """
-    
-    report_dict = {
-        "binary_classification_metrics": {
-            "accuracy": {"value": accuracy, "standard_deviation": "NaN"},
-            "precision": {"value": precision, "standard_deviation": "NaN"},
-            "recall": {"value": recall, "standard_deviation": "NaN"},
-            "confusion_matrix": {
-                "0": {"0": int(conf_matrix[0][0]), "1": int(conf_matrix[0][1])},
-                "1": {"0": int(conf_matrix[1][0]), "1": int(conf_matrix[1][1])},
-            },
-            "receiver_operating_characteristic_curve": {
-                "false_positive_rates": list(fpr),
-                "true_positive_rates": list(tpr),
-            },
-        },
-    }
+    if EVALUATION_CHUNK_ROWS:
+        state, segments = evaluate_stream(model, test_files("/opt/ml/processing/test"), EVALUATION_CHUNK_ROWS)
+        outputs = evaluation_metrics.state_outputs(state, resamples=BOOTSTRAP_RESAMPLES)
+    else:
+        test_data_pd = load_test_data("/opt/ml/processing/test")
+
+        values, keys = split_segments(test_data_pd)
+        y_test = values[:, 0]
+        X_test = xgboost.DMatrix(values[:, 1:])
+
+        prediction_probabilities = model.predict(X_test)
+
+        """
+        Need to customise the formation of evaluation.json to visualize the metrics in model registry based-on tasks
+        Result should coincide in format with the result by sagemaker.workflow.quality_check_step.QualityCheckStep.
+        Binarry
+        """
+        outputs = evaluation_metrics.evaluation_outputs(y_test, prediction_probabilities, resamples=BOOTSTRAP_RESAMPLES)
+        segments = evaluation_metrics.segment_state(SEGMENT_KEYS)
+        if keys is not None:
+            evaluation_metrics.update_segment_state(segments, y_test, prediction_probabilities, keys)
+    metrics = outputs[0]["binary_classification_metrics"]
+
+    logger.debug("Accuracy: {}".format(metrics["accuracy"]["value"]))
+    logger.debug("Precision: {}".format(metrics["precision"]["value"]))
+    logger.debug("Recall: {}".format(metrics["recall"]["value"]))
+    logger.debug("Confusion matrix: {}".format(metrics["confusion_matrix"]))
     
     output_dir = "/opt/ml/processing/evaluation"
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    evaluation_path = f"{output_dir}/evaluation.json"
-
-    with open(evaluation_path, "w") as f:
-        f.write(json.dumps(report_dict))
\ No newline at end of file
+    for name, body in evaluation_metrics.output_files(outputs, FULL_ROC_CURVE, segments).items():
+        with open(f"{output_dir}/{name}", "wb") as f:
+            f.write(body)
\ No newline at end of file
@@ -0,0 +1,636 @@
+"""
+Binary classification metrics of the churn model from a single sort of its scores.
+
+The scores are sorted once in decreasing order. The cumulative counts of positives and
+negatives at the last position of every distinct score give the confusion matrix at every
+threshold, and the confusion matrix, ROC and precision-recall curves, AUC, lift and gain
+and any threshold sweep are all read from those counts without another pass over the data.
+The results match sklearn.metrics, see tests/unit/test_evaluation_metrics.py.
+
+Test sets that do not fit in memory are evaluated chunk by chunk into a metric state instead:
+the exact confusion matrix at the threshold and a histogram of the scores of each class on a
+fixed grid of HISTOGRAM_BINS bins. States of chunks, files, processes or processing instances
+add up with merge_states, and state_report writes the same report from the merged state, with
+the ROC curve at the resolution of the grid.
+
+The ROC curve of evaluation.json is downsampled to within ROC_MAX_ERROR of the full curve,
+which has a point per distinct score. Its scalar metrics also go to a small summary.json for
+the steps that only compare them with a threshold, and the full curve to an optional sidecar.
+
+The standard deviations and confidence intervals of accuracy, precision, recall and AUC come
+from a bootstrap of the counts of positives and negatives per distinct score rather than of
+the rows, see bootstrap.
+
+Sliced metrics of segments of the test set, such as the customers of a state, come from a
+segment state: the confusion matrix and a coarse score histogram of every combination of the
+segment keys. A chunk is added with a pd.factorize of its keys and two np.bincount calls,
+however many segments it holds. segment_report sums the combinations up to each slicing for
+segments.json.
+
+Identical copies live in the code directories of the Step Functions, SageMaker Pipelines and
+Glue workflow examples, next to the evaluators that use them.
+"""
+import io
+import json
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# positive prediction when the score is above this, as np.round of a probability
+DEFAULT_THRESHOLD = 0.5
+# bins of the score histogram of a metric state: 2 x 8 bytes each, 1 MiB per state
+HISTOGRAM_BINS = 1 << 16
+# largest distance of the ROC curve of evaluation.json from the full curve, in either rate
+ROC_MAX_ERROR = 0.005
+# resamples of the bootstrap standard deviations and confidence intervals, 0 skips the bootstrap
+BOOTSTRAP_RESAMPLES = 1000
+CONFIDENCE_LEVEL = 0.95
+# groups of adjacent scores the bootstrap resamples at most, and resamples drawn at a time
+BOOTSTRAP_GROUPS = 4096
+BOOTSTRAP_BATCH = 50
+# the metrics of the bootstrap, each gets a standard deviation and a confidence interval
+BOOTSTRAP_METRICS = ("accuracy", "precision", "recall", "auc")
+# bins of the score histogram of every combination of segment keys in a segment state
+SEGMENT_BINS = 1 << 8
+# the arrays of a segment state, as saved by save_segment_state
+SEGMENT_STATE_ARRAYS = ("keys", "threshold", "values", "confusion_matrix", "histogram")
+
+
+def _sort_float32(positives, y_score):
+    """
+    Keys of the scores in decreasing order with the label in the low bit. A float32 score maps
+    to an unsigned integer of the same order, so one np.sort of the packed keys replaces an
+    argsort and the two gathers of scores and labels by its result.
+    """
+    # -0.0 + 0.0 is 0.0: both zeros get the same key
+    bits = (y_score + np.float32(0)).view(np.uint32).astype(np.uint64)
+    bits = np.where(bits & 0x80000000, bits ^ 0xFFFFFFFF, bits | 0x80000000)
+    keys = np.sort((bits << 1) | positives)[::-1]
+    return keys >> 1, (keys & 1).astype(bool)
+
+
+def _float32_of_keys(keys):
+    bits = np.where(keys & 0x80000000, keys ^ 0x80000000, keys ^ 0xFFFFFFFF).astype(np.uint32)
+    return bits.view(np.float32)
+
+
+def _labels_and_scores(y_true, y_score):
+    y_true = np.asarray(y_true).ravel()
+    y_score = np.asarray(y_score).ravel()
+    if y_true.shape != y_score.shape:
+        raise ValueError(f"{y_true.size} labels for {y_score.size} scores")
+    positives = y_true == 1
+    if np.count_nonzero(positives) + np.count_nonzero(y_true == 0) != y_true.size:
+        raise ValueError("labels must be 0 or 1")
+    return positives, y_score
+
+
+def curve_counts(y_true, y_score):
+    """
+    (thresholds, tps, fps): the distinct scores in decreasing order and the number of true and
+    false positives when every score at or above the threshold is predicted positive.
+    """
+    positives, y_score = _labels_and_scores(y_true, y_score)
+    if y_score.dtype == np.float32:
+        keys, positives = _sort_float32(positives, y_score)
+        ends = np.r_[np.flatnonzero(keys[1:] != keys[:-1]), keys.size - 1]
+        thresholds = _float32_of_keys(keys[ends])
+    else:
+        order = np.argsort(y_score, kind="stable")[::-1]
+        scores = y_score[order]
+        positives = positives[order]
+        ends = np.r_[np.flatnonzero(scores[1:] != scores[:-1]), scores.size - 1]
+        thresholds = scores[ends]
+    tps = np.cumsum(positives, dtype=np.int64)[ends]
+    fps = ends + 1 - tps
+    return thresholds, tps, fps
+
+
+def threshold_sweep(counts, thresholds):
+    """
+    Confusion matrix counts, precision, recall and accuracy at each of thresholds, predicting
+    positive above the threshold. As in sklearn, precision is 0 when nothing is predicted
+    positive and recall is 0 when there is no positive.
+    """
+    scores, tps, fps = counts
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    # distinct scores above each threshold, scores being in decreasing order
+    above = np.searchsorted(-scores.astype(np.float64), -thresholds, side="left")
+    tp = np.r_[0, tps][above]
+    fp = np.r_[0, fps][above]
+    fn = tps[-1] - tp
+    tn = fps[-1] - fp
+    predicted = tp + fp
+    return {
+        "tp": tp,
+        "fp": fp,
+        "tn": tn,
+        "fn": fn,
+        "precision": np.divide(tp, predicted, out=np.zeros(tp.shape), where=predicted > 0),
+        "recall": np.divide(tp, tps[-1], out=np.zeros(tp.shape), where=tps[-1] > 0),
+        "accuracy": (tp + tn) / (tps[-1] + fps[-1]),
+    }
+
+
+def confusion_matrix(counts, threshold=DEFAULT_THRESHOLD):
+    """[[tn, fp], [fn, tp]] at threshold, as sklearn.metrics.confusion_matrix."""
+    sweep = threshold_sweep(counts, [threshold])
+    return np.array([[sweep["tn"][0], sweep["fp"][0]], [sweep["fn"][0], sweep["tp"][0]]])
+
+
+def roc_curve(counts, drop_intermediate=True):
+    """
+    (fpr, tpr, thresholds) as sklearn.metrics.roc_curve: the first point is (0, 0) at an
+    infinite threshold and, with drop_intermediate, points on a straight segment are dropped.
+    """
+    thresholds, tps, fps = counts
+    if drop_intermediate and tps.size > 2:
+        keep = np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        thresholds, tps, fps = thresholds[keep], tps[keep], fps[keep]
+    tps = np.r_[0, tps]
+    fps = np.r_[0, fps]
+    thresholds = np.r_[np.inf, thresholds]
+    fpr = fps / fps[-1] if fps[-1] > 0 else np.full(fps.shape, np.nan)
+    tpr = tps / tps[-1] if tps[-1] > 0 else np.full(tps.shape, np.nan)
+    return fpr, tpr, thresholds
+
+
+def roc_auc(counts):
+    """Area under the ROC curve, ties counted as half, as sklearn.metrics.roc_auc_score."""
+    _, tps, fps = counts
+    if tps[-1] == 0 or fps[-1] == 0:
+        raise ValueError("AUC is not defined when the test set holds a single class")
+    tps = np.r_[0, tps]
+    fps = np.r_[0, fps]
+    # trapezoids between consecutive thresholds, in counts and normalized once
+    return float(np.sum(np.diff(fps) * (tps[1:] + tps[:-1])) / (2 * tps[-1] * fps[-1]))
+
+
+def precision_recall_curve(counts):
+    """
+    (precision, recall, thresholds) as sklearn.metrics.precision_recall_curve: increasing
+    thresholds, ending with the point (1, 0) that has no threshold.
+    """
+    thresholds, tps, fps = counts
+    predicted = tps + fps
+    precision = np.divide(tps, predicted, out=np.zeros(tps.shape), where=predicted > 0)
+    recall = tps / tps[-1] if tps[-1] > 0 else np.ones(tps.shape)
+    return np.r_[precision[::-1], 1.0], np.r_[recall[::-1], 0.0], thresholds[::-1]
+
+
+def average_precision(counts):
+    """Average precision, as sklearn.metrics.average_precision_score."""
+    precision, recall, _ = precision_recall_curve(counts)
+    return float(-np.sum(np.diff(recall) * precision[:-1]))
+
+
+def lift_gain(counts, bins=10):
+    """
+    Cumulative gain and lift by population share: for the top 1/bins, 2/bins, ... of the
+    scores, the share of all positives they hold and that share over the population share.
+    Within a tie the positives are spread evenly, so the result does not depend on the
+    order of equal scores.
+    """
+    _, tps, fps = counts
+    population = np.r_[0, tps + fps]
+    share = np.arange(1, bins + 1) / bins
+    gain = np.interp(share * population[-1], population, np.r_[0, tps]) / max(tps[-1], 1)
+    return {"population_share": share, "gain": gain, "lift": gain / share}
+
+
+def downsample_roc(fpr, tpr, max_error=ROC_MAX_ERROR):
+    """
+    Indices of the points of the ROC curve to keep. The rates are cut into squares of side
+    max_error and only the first and last point of every run of points in the same square are
+    kept. A dropped point then lies in the box of the two kept points around it, so the polyline
+    of the kept points is within max_error of every point in both rates, and its area within
+    max_error of the AUC. A curve keeps at most about 4 / max_error points.
+    """
+    if max_error <= 0 or fpr.size <= 2:
+        return np.arange(fpr.size)
+    moved = (np.floor(fpr[1:] / max_error) != np.floor(fpr[:-1] / max_error)) | \
+        (np.floor(tpr[1:] / max_error) != np.floor(tpr[:-1] / max_error))
+    keep = np.r_[True, moved] | np.r_[moved, True]
+    return np.flatnonzero(keep)
+
+
+def _score_groups(tps, fps, above, groups):
+    """
+    Positives and negatives of at most groups runs of adjacent distinct scores of equal row
+    counts, and the number of runs predicted positive: a run ends at the above-th score.
+    """
+    positives = np.diff(tps, prepend=0)
+    negatives = np.diff(fps, prepend=0)
+    if positives.size > groups:
+        rows = tps + fps
+        starts = np.searchsorted(rows, np.linspace(0, rows[-1], groups, endpoint=False)[1:], side="right")
+        starts = np.unique(np.r_[0, starts, above])
+        starts = starts[starts < positives.size]
+        positives = np.add.reduceat(positives, starts)
+        negatives = np.add.reduceat(negatives, starts)
+        above = int(np.searchsorted(starts, above))
+    return positives, negatives, above
+
+
+def _grouped_auc(positives, negatives):
+    # negatives times the positives ranked above them, ties as half, over all pairs
+    return np.sum(negatives * (np.cumsum(positives, axis=-1) - 0.5 * positives), axis=-1) / \
+        (np.sum(positives, axis=-1) * np.sum(negatives, axis=-1))
+
+
+def _resample(positives, negatives, above, auc_shift, seed, size):
+    rng = np.random.default_rng(seed)
+    positives = rng.poisson(positives, size=(size, positives.size)).astype(np.float64)
+    negatives = rng.poisson(negatives, size=(size, negatives.size)).astype(np.float64)
+    tp = positives[:, :above].sum(axis=1)
+    fp = negatives[:, :above].sum(axis=1)
+    p = positives.sum(axis=1)
+    n = negatives.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.stack([
+            (tp + n - fp) / (p + n),
+            np.divide(tp, tp + fp, out=np.zeros(size), where=tp + fp > 0),
+            np.divide(tp, p, out=np.zeros(size), where=p > 0),
+            _grouped_auc(positives, negatives) + auc_shift,
+        ])
+
+
+def bootstrap(counts, above, resamples=BOOTSTRAP_RESAMPLES, confidence=CONFIDENCE_LEVEL,
+              groups=BOOTSTRAP_GROUPS, workers=None, seed=0):
+    """
+    Standard deviation and confidence interval of BOOTSTRAP_METRICS, predicting positive the
+    first above distinct scores of counts, by metric: {"standard_deviation", "lower", "upper"}.
+
+    Every metric only depends on how many positives and negatives have each distinct score,
+    so a resample of the rows is a resample of those counts. Each count is drawn from a Poisson
+    distribution of its own mean (Poisson bootstrap), resamples x scores at a time in batches
+    of BOOTSTRAP_BATCH resamples spread over workers threads. Above groups distinct scores,
+    runs of adjacent scores are resampled together. That only blurs the ranking within a run,
+    so accuracy, precision and recall stay exact, and the AUC of the resamples is shifted by
+    the difference that blurring makes to the AUC of the test set. Values that are not defined,
+    such as every AUC value of a test set of a single class, are None.
+    """
+    _, tps, fps = counts
+    positives, negatives, grouped_above = _score_groups(tps, fps, above, groups)
+    try:
+        auc_shift = roc_auc(counts) - _grouped_auc(positives, negatives)
+    except ValueError:
+        auc_shift = np.nan
+    sizes = [min(BOOTSTRAP_BATCH, resamples - start) for start in range(0, resamples, BOOTSTRAP_BATCH)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        samples = np.concatenate(list(pool.map(
+            lambda seed_size: _resample(positives, negatives, grouped_above, auc_shift, *seed_size),
+            zip(seeds, sizes),
+        )), axis=1)
+    tail = 50 * (1 - confidence)
+    with warnings.catch_warnings():
+        # all-NaN rows, of the AUC of a single class or of a single resample
+        warnings.simplefilter("ignore", RuntimeWarning)
+        std = np.nanstd(samples, axis=1, ddof=1)
+        lower, upper = np.nanpercentile(samples, [tail, 100 - tail], axis=1)
+    # None rather than NaN, which is not valid JSON
+    columns = (np.where(np.isnan(values), None, values).tolist() for values in (std, lower, upper))
+    return {
+        name: {"standard_deviation": metric_std, "lower": metric_lower, "upper": metric_upper}
+        for name, metric_std, metric_lower, metric_upper in zip(BOOTSTRAP_METRICS, *columns)
+    }
+
+
+def _outputs(tn, fp, fn, tp, counts, above, max_error, resamples):
+    fpr, tpr, thresholds = roc_curve(counts)
+    keep = downsample_roc(fpr, tpr, max_error)
+    total = tn + fp + fn + tp
+    try:
+        auc = roc_auc(counts)
+    except ValueError:
+        auc = None
+    values = {
+        "accuracy": (tp + tn) / total,
+        "precision": tp / (tp + fp) if tp + fp else 0.0,
+        "recall": tp / (tp + fn) if tp + fn else 0.0,
+        "auc": auc,
+    }
+    intervals = bootstrap(counts, above, resamples) if resamples else {
+        name: {"standard_deviation": None, "lower": value, "upper": value} for name, value in values.items()
+    }
+    report = {
+        "binary_classification_metrics": {
+            **{
+                name: {"value": values[name], "standard_deviation": intervals[name]["standard_deviation"]}
+                for name in ("accuracy", "precision", "recall")
+            },
+            "confusion_matrix": {
+                "0": {"0": tn, "1": fp},
+                "1": {"0": fn, "1": tp},
+            },
+            # the rates of a class the test set does not hold are None
+            "receiver_operating_characteristic_curve": {
+                "false_positive_rates": np.where(np.isnan(fpr[keep]), None, fpr[keep]).tolist(),
+                "true_positive_rates": np.where(np.isnan(tpr[keep]), None, tpr[keep]).tolist(),
+            },
+        },
+    }
+    summary = dict(values)
+    for name, interval in intervals.items():
+        summary[f"{name}_standard_deviation"] = interval["standard_deviation"]
+        summary[f"{name}_lower"] = interval["lower"]
+        summary[f"{name}_upper"] = interval["upper"]
+    summary.update({
+        "confidence_level": CONFIDENCE_LEVEL,
+        "bootstrap_resamples": resamples,
+        "rows": total,
+        "roc_points": int(keep.size),
+        "roc_max_error": max_error,
+    })
+    return report, summary, (fpr, tpr, thresholds)
+
+
+def evaluation_outputs(y_true, y_score, threshold=DEFAULT_THRESHOLD, max_error=ROC_MAX_ERROR,
+                       resamples=BOOTSTRAP_RESAMPLES):
+    """
+    (report, summary, roc) of the scores, predicting positive above threshold: the
+    evaluation.json report with the ROC curve downsampled to max_error, the summary.json of
+    its scalar metrics with their bootstrap confidence intervals of resamples resamples, and
+    the full ROC curve (fpr, tpr, thresholds).
+    """
+    counts = curve_counts(y_true, y_score)
+    # distinct scores above the threshold, as in threshold_sweep
+    above = int(np.searchsorted(-counts[0].astype(np.float64), -threshold, side="left"))
+    tp = int(np.r_[0, counts[1]][above])
+    fp = int(np.r_[0, counts[2]][above])
+    fn = int(counts[1][-1]) - tp
+    tn = int(counts[2][-1]) - fp
+    return _outputs(tn, fp, fn, tp, counts, above, max_error, resamples)
+
+
+def evaluation_report(y_true, y_score, threshold=DEFAULT_THRESHOLD, max_error=ROC_MAX_ERROR,
+                      resamples=BOOTSTRAP_RESAMPLES):
+    """The evaluation.json report of evaluation_outputs."""
+    return evaluation_outputs(y_true, y_score, threshold, max_error, resamples)[0]
+
+
+def output_files(outputs, full_roc_curve=False, segments=None):
+    """
+    The files of evaluation_outputs or state_outputs by name: evaluation.json, summary.json,
+    with full_roc_curve the full ROC curve as the arrays fpr, tpr and thresholds of
+    roc_curve.npz, and with a segment state its segment_report as segments.json.
+    """
+    report, summary, (fpr, tpr, thresholds) = outputs
+    files = {
+        "evaluation.json": json.dumps(report).encode("utf-8"),
+        "summary.json": json.dumps(summary).encode("utf-8"),
+    }
+    if segments is not None:
+        files["segments.json"] = json.dumps(segment_report(segments)).encode("utf-8")
+    if full_roc_curve:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, fpr=fpr, tpr=tpr, thresholds=thresholds)
+        files["roc_curve.npz"] = buffer.getvalue()
+    return files
+
+
+def metric_state(threshold=DEFAULT_THRESHOLD, bins=HISTOGRAM_BINS):
+    """
+    An empty metric state: the confusion matrix [[tn, fp], [fn, tp]] at threshold and the
+    histogram of the scores of the negatives (row 0) and positives (row 1). Bin i holds the
+    scores in (i / bins, (i + 1) / bins], bin 0 also holds 0 and below, the last bin 1 and above.
+    """
+    return {
+        "threshold": np.float64(threshold),
+        "confusion_matrix": np.zeros((2, 2), dtype=np.int64),
+        "histogram": np.zeros((2, bins), dtype=np.int64),
+    }
+
+
+def update_state(state, y_true, y_score):
+    """Add a chunk of labels and scores to the state, in place, and return it."""
+    positives, y_score = _labels_and_scores(y_true, y_score)
+    predicted = y_score > state["threshold"]
+    state["confusion_matrix"] += np.bincount(2 * positives + predicted, minlength=4).reshape(2, 2)
+    bins = state["histogram"].shape[1]
+    # bins is a power of two, the product is exact and a score on a bin edge k / bins lands in
+    # bin k - 1, so "above k / bins" is exactly the bins from k up
+    index = np.clip(np.ceil(y_score.astype(np.float64) * bins) - 1, 0, bins - 1).astype(np.int64)
+    state["histogram"] += np.bincount(index + bins * positives, minlength=2 * bins).reshape(2, bins)
+    return state
+
+
+def merge_states(states):
+    """The state of all the data of the states, which must share threshold and bins."""
+    states = list(states)
+    merged = metric_state(states[0]["threshold"], states[0]["histogram"].shape[1])
+    for state in states:
+        if state["threshold"] != merged["threshold"] or state["histogram"].shape != merged["histogram"].shape:
+            raise ValueError("only states of the same threshold and bins can be merged")
+        merged["confusion_matrix"] += state["confusion_matrix"]
+        merged["histogram"] += state["histogram"]
+    return merged
+
+
+def save_state(state, path):
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **state)
+
+
+def load_state(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in ("threshold", "confusion_matrix", "histogram")}
+
+
+def state_counts(state):
+    """
+    curve_counts of the state, one threshold per non-empty bin: the lower edge of the bin, so
+    that the counts at it are those of the scores above it. Ties within a bin count as half in
+    roc_auc, so its error is at most half the share of positive-negative pairs in the same bin.
+    """
+    negatives, positives = state["histogram"][:, ::-1]
+    bins = negatives.size
+    filled = np.flatnonzero(negatives + positives)
+    if filled.size == 0:
+        raise ValueError("the metric state holds no scores")
+    thresholds = (bins - 1 - filled) / bins
+    return thresholds, np.cumsum(positives)[filled], np.cumsum(negatives)[filled]
+
+
+def state_outputs(state, max_error=ROC_MAX_ERROR, resamples=BOOTSTRAP_RESAMPLES):
+    """
+    evaluation_outputs of a metric state, as of all its scores. The AUC of the summary comes
+    from the histogram, see state_counts for its error. The bootstrap needs a threshold on the
+    grid of the histogram, as DEFAULT_THRESHOLD is.
+    """
+    (tn, fp), (fn, tp) = state["confusion_matrix"].tolist()
+    counts = state_counts(state)
+    # bins whose lower edge is at or above the threshold only hold scores above it
+    above = int(np.searchsorted(-counts[0], -state["threshold"], side="right"))
+    return _outputs(tn, fp, fn, tp, counts, above, max_error, resamples)
+
+
+def state_report(state, max_error=ROC_MAX_ERROR, resamples=BOOTSTRAP_RESAMPLES):
+    """The evaluation.json report of state_outputs."""
+    return state_outputs(state, max_error, resamples)[0]
+
+
+def segment_state(keys, threshold=DEFAULT_THRESHOLD, bins=SEGMENT_BINS):
+    """
+    An empty segment state of the segment keys: for every combination of their values seen so
+    far, a row of "values" with the combination, and the confusion matrix and histogram of
+    metric_state of its scores, stacked along the first axis in the order of the rows.
+    """
+    return {
+        "keys": np.array(keys, dtype=str),
+        "threshold": np.float64(threshold),
+        "values": np.empty((0, len(keys)), dtype=str),
+        "confusion_matrix": np.zeros((0, 2, 2), dtype=np.int64),
+        "histogram": np.zeros((0, 2, bins), dtype=np.int64),
+    }
+
+
+def _combinations(values):
+    """
+    (distinct rows as strings, index of each row in them) of a 2-D array, the distinct rows in
+    the order they first appear. pd.factorize hashes every column, rather than sorting strings
+    as np.unique does, and the codes of the rows are combined one column at a time and hashed
+    again, so they stay below the number of rows.
+    """
+    codes = np.zeros(values.shape[0], dtype=np.int64)
+    for column in values.T:
+        inverse, distinct = pd.factorize(column)
+        # missing values get a code of their own
+        inverse = np.where(inverse < 0, len(distinct), inverse)
+        codes, _ = pd.factorize(codes * (len(distinct) + 1) + inverse)
+    # the codes also number the rows in the order they first appear
+    first = np.flatnonzero(np.diff(np.maximum.accumulate(np.r_[-1, codes])) > 0)
+    return values[first].astype(str), codes.astype(np.int64)
+
+
+def _add_segments(state, values, confusion_matrices, histograms):
+    """Add the counts of the combinations values to their rows of the state, new ones at the end."""
+    index = {combination: i for i, combination in enumerate(map(tuple, state["values"].tolist()))}
+    rows = np.array([index.setdefault(combination, len(index)) for combination in map(tuple, values.tolist())],
+                    dtype=np.int64)
+    added = len(index) - state["values"].shape[0]
+    if added:
+        state["values"] = np.concatenate([state["values"], values[rows >= state["values"].shape[0]]])
+        state["confusion_matrix"] = np.concatenate(
+            [state["confusion_matrix"], np.zeros((added, 2, 2), dtype=np.int64)])
+        state["histogram"] = np.concatenate(
+            [state["histogram"], np.zeros((added,) + state["histogram"].shape[1:], dtype=np.int64)])
+    state["confusion_matrix"][rows] += confusion_matrices
+    state["histogram"][rows] += histograms
+    return state
+
+
+def update_segment_state(state, y_true, y_score, segments):
+    """
+    Add a chunk of labels and scores to the segment state, in place, and return it. segments
+    holds the values of the keys of the state for every row, one column per key, as strings.
+    """
+    positives, y_score = _labels_and_scores(y_true, y_score)
+    # pd.factorize hashes Python strings, a NumPy string array would be converted column by column
+    segments = np.asarray(segments, dtype=object).reshape(positives.size, -1)
+    if segments.shape[1] != state["keys"].size:
+        raise ValueError(f"expected the values of {state['keys'].size} segment keys, got {segments.shape[1]}")
+    values, combination = _combinations(segments)
+    count = values.shape[0]
+    predicted = y_score > state["threshold"]
+    confusion_matrices = np.bincount(4 * combination + 2 * positives + predicted, minlength=4 * count)
+    bins = state["histogram"].shape[2]
+    # the bins of update_state
+    index = np.clip(np.ceil(y_score.astype(np.float64) * bins) - 1, 0, bins - 1).astype(np.int64)
+    histograms = np.bincount(2 * bins * combination + bins * positives + index, minlength=2 * bins * count)
+    return _add_segments(state, values, confusion_matrices.reshape(count, 2, 2), histograms.reshape(count, 2, bins))
+
+
+def merge_segment_states(states):
+    """The segment state of all the data of the states, which must share keys, threshold and bins."""
+    states = list(states)
+    merged = segment_state(states[0]["keys"].tolist(), states[0]["threshold"], states[0]["histogram"].shape[2])
+    for state in states:
+        if state["keys"].tolist() != merged["keys"].tolist() or state["threshold"] != merged["threshold"] \
+                or state["histogram"].shape[2] != merged["histogram"].shape[2]:
+            raise ValueError("only segment states of the same keys, threshold and bins can be merged")
+        _add_segments(merged, state["values"], state["confusion_matrix"], state["histogram"])
+    return merged
+
+
+def save_segment_state(state, path):
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **{name: state[name] for name in SEGMENT_STATE_ARRAYS})
+
+
+def load_segment_state(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in SEGMENT_STATE_ARRAYS}
+
+
+def _sum_segments(segment, counts):
+    """The sums of the counts of the rows of every segment, numbered 0 up by segment."""
+    order = np.argsort(segment, kind="stable")
+    starts = np.flatnonzero(np.diff(np.r_[-1, segment[order]]))
+    if starts.size == counts.shape[0]:
+        # a segment per row, as for the slicing by all keys
+        return counts[order]
+    return np.add.reduceat(counts[order], starts, axis=0)
+
+
+def segment_report(state, slicings=None):
+    """
+    The segments.json report of a segment state: the threshold and, for every slicing, a tuple
+    of keys of the state, a list of its segments with their key values, rows, positives,
+    accuracy, precision, recall and confusion matrix. Slicings default to every key alone and
+    all keys together. The AUC of a segment comes from its histogram: "auc_max_error" bounds
+    its error, see state_counts, and both are None when the segment has a single class.
+    """
+    keys = [str(key) for key in state["keys"]]
+    if slicings is None:
+        slicings = [(key,) for key in keys] + ([tuple(keys)] if len(keys) > 1 else [])
+    report = {"threshold": float(state["threshold"]), "histogram_bins": int(state["histogram"].shape[2]),
+              "slicings": {}}
+    for slicing in slicings:
+        columns = [keys.index(key) for key in slicing]
+        values, segment = _combinations(state["values"][:, columns])
+        # segments in the order of their key values
+        order = np.lexsort(values.T[::-1])
+        values, segment = values[order], np.argsort(order)[segment]
+        confusion_matrices = _sum_segments(segment, state["confusion_matrix"])
+        histograms = _sum_segments(segment, state["histogram"])
+
+        tn, fp, fn, tp = confusion_matrices.reshape(-1, 4).T
+        rows = tn + fp + fn + tp
+        # highest scores first, as in state_counts
+        negatives = histograms[:, 0, ::-1].astype(np.float64)
+        positives = histograms[:, 1, ::-1].astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            accuracy = (tp + tn) / rows
+            precision = np.divide(tp, tp + fp, out=np.zeros(rows.size), where=tp + fp > 0)
+            recall = np.divide(tp, tp + fn, out=np.zeros(rows.size), where=tp + fn > 0)
+            auc = _grouped_auc(positives, negatives)
+            auc_max_error = 0.5 * np.sum(positives * negatives, axis=-1) / \
+                (positives.sum(axis=-1) * negatives.sum(axis=-1))
+        single_class = np.isnan(auc)
+        columns = zip(values.tolist(), rows.tolist(), accuracy.tolist(), precision.tolist(), recall.tolist(),
+                      np.where(single_class, None, auc).tolist(), np.where(single_class, None, auc_max_error).tolist(),
+                      tn.tolist(), fp.tolist(), fn.tolist(), tp.tolist())
+        report["slicings"][",".join(slicing)] = [
+            {
+                **dict(zip(slicing, key_values)),
+                "rows": segment_rows,
+                "positives": segment_fn + segment_tp,
+                "accuracy": segment_accuracy,
+                "precision": segment_precision,
+                "recall": segment_recall,
+                "auc": segment_auc,
+                "auc_max_error": segment_auc_max_error,
+                "confusion_matrix": {
+                    "0": {"0": segment_tn, "1": segment_fp},
+                    "1": {"0": segment_fn, "1": segment_tp},
+                },
+            }
+            for (key_values, segment_rows, segment_accuracy, segment_precision, segment_recall, segment_auc,
+                 segment_auc_max_error, segment_tn, segment_fp, segment_fn, segment_tp) in columns
+        ]
+    return report
@@ -0,0 +1,312 @@
+"""
+Writers of the processed churn data, shared by the Spark job (glue_preprocessing.py), its
+pandas engine (churn_preprocessing.py) and the compaction job (compact_processed.py).
+
+The driver split mode of the Spark job and the pandas engine write their splits with the same
+chunked writer, so both engines write the same bytes for the same rows. The SageMaker manifests
+of sharded splits and of snapshot windows, and the profile sidecar, are written here too.
+
+Paths may be local or s3:// URIs; S3 objects are streamed as multipart uploads. The jobs get
+this file with --extra-py-files, next to their script.
+"""
+import gzip
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+# see COMPRESSION in glue_preprocessing.py
+PARQUET_CODECS = {'none': 'snappy', 'gzip': 'gzip', 'zstd': 'zstd'}
+
+# Quantiles kept per numeric column in the profile, a compact sketch of its distribution for
+# drift checks and threshold tuning.
+PROFILE_QUANTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+PROFILE_LABEL = 'Churn'
+
+# see WINDOW_DAYS in glue_preprocessing.py
+PARTITION_KEY = 'snapshot_date'
+
+# Splits are serialized WRITE_CHUNK_ROWS rows at a time and S3 objects streamed as multipart
+# uploads of PART_SIZE parts, UPLOAD_THREADS at a time, so memory does not grow with the split size.
+WRITE_CHUNK_ROWS = 100000
+PART_SIZE = 16 * 1024 * 1024
+UPLOAD_THREADS = 8
+
+
+def _s3():
+    import boto3
+    return boto3.client('s3')
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class MultipartUpload(io.RawIOBase):
+    """
+    Write-only file object streaming to an S3 object. Full parts are uploaded in parallel while
+    the caller keeps writing; objects smaller than one part are uploaded with a single put.
+    Leaving the with block on an exception aborts the upload instead of completing it.
+    """
+
+    def __init__(self, uri, part_size=PART_SIZE, threads=UPLOAD_THREADS):
+        super().__init__()
+        self.bucket, self.key = _split_s3_uri(uri)
+        self.part_size = part_size
+        self.threads = threads
+        self.client = _s3()
+        self.upload_id = None
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(2 * threads)
+        self.buffer = bytearray()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _submit(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        # at most 2 * threads parts are held in memory
+        self.slots.acquire()
+        self.parts.append(self.pool.submit(self._upload_part, len(self.parts) + 1, body))
+
+    def _upload_part(self, number, body):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body
+            )
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self._submit(bytes(self.buffer))
+                parts = [part.result() for part in self.parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts}
+                )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            super().close()
+
+    def abort(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and not self.closed:
+            self.abort()
+            super().close()
+        else:
+            self.close()
+        return False
+
+
+def open_output(path):
+    if path.startswith('s3://'):
+        return MultipartUpload(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return open(path, 'wb')
+
+
+def write_split(df, path, output_format, header, compression='none'):
+    """
+    Write one split in chunks of WRITE_CHUNK_ROWS rows, returns the bytes written. The CSV bytes
+    are the same as those of a single to_csv call; gzip output has a zero mtime so reruns are
+    identical.
+    """
+    with open_output(path) as sink:
+        if output_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            writer = None
+            for start in range(0, max(len(df), 1), WRITE_CHUNK_ROWS):
+                table = pa.Table.from_pandas(df.iloc[start:start + WRITE_CHUNK_ROWS], preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(sink, table.schema, compression=PARQUET_CODECS[compression])
+                writer.write_table(table)
+            writer.close()
+            return sink.tell()
+        out = gzip.GzipFile(filename='', mode='wb', fileobj=sink, mtime=0) if compression == 'gzip' else sink
+        for start in range(0, max(len(df), 1), WRITE_CHUNK_ROWS):
+            chunk = df.iloc[start:start + WRITE_CHUNK_ROWS]
+            out.write(chunk.to_csv(index=False, header=header and start == 0).encode('utf-8'))
+        if out is not sink:
+            out.close()
+        return sink.tell()
+
+
+def manifest_path(split_path, name):
+    # <processed dir>/<split>/<split file> -> <processed dir>/manifests/<split>.manifest, outside
+    # of the channel prefixes so that prefix channels never read a manifest as data
+    return f"{split_path.rsplit('/', 2)[0]}/manifests/{name}.manifest"
+
+
+def list_part_files(directory):
+    """Names of the non-empty data files in a directory, skipping _SUCCESS style markers."""
+    if directory.startswith('s3://'):
+        bucket, prefix = _split_s3_uri(directory)
+        prefix = prefix.rstrip('/') + '/'
+        names = []
+        for page in _s3().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            names.extend(item['Key'][len(prefix):] for item in page.get('Contents', []) if item['Size'] > 0)
+    else:
+        names = [name for name in os.listdir(directory) if os.path.getsize(os.path.join(directory, name)) > 0]
+    return sorted(name for name in names if '/' not in name and not name.startswith(('_', '.')))
+
+
+def write_manifest(directory, name):
+    """Write the manifest of every part file in directory, including those of earlier incremental runs."""
+    entries = [{'prefix': directory.rstrip('/') + '/'}] + list_part_files(directory)
+    with open_output(manifest_path(directory, name)) as sink:
+        sink.write(json.dumps(entries).encode('utf-8'))
+
+
+def write_shards(df, directory, name, output_format, header, compression='none', shards=1, manifest=True):
+    """
+    Write one split as `shards` part files whose row counts differ by at most one, plus their
+    manifest, returns the bytes written.
+    """
+    extension = output_format + ('.gz' if compression == 'gzip' and output_format == 'csv' else '')
+    bounds = np.linspace(0, len(df), shards + 1).astype(int)
+    written = 0
+    for shard in range(shards):
+        written += write_split(df.iloc[bounds[shard]:bounds[shard + 1]], f"{directory}/part-{shard:05d}.{extension}",
+                               output_format, header, compression)
+    if manifest:
+        write_manifest(directory, name)
+    return written
+
+
+def partition_path(split_path, snapshot_date):
+    """<split dir>/<split file> -> <split dir>/snapshot_date=<snapshot_date>/<split file>."""
+    directory, _, name = split_path.rpartition('/')
+    return f"{directory}/{PARTITION_KEY}={snapshot_date.isoformat()}/{name}"
+
+
+def window_partitions(snapshot_date, window_days):
+    """Partition values of the last window_days days up to snapshot_date, oldest first."""
+    return [(snapshot_date - timedelta(days=days)).isoformat() for days in range(window_days - 1, -1, -1)]
+
+
+def list_partition_files(split_dir, partition):
+    """
+    Non-empty data files of one partition, relative to the split directory. Only the partition's
+    own prefix is listed, the snapshots outside of the window are never touched.
+    """
+    prefix = f"{split_dir}/{PARTITION_KEY}={partition}/"
+    if prefix.startswith('s3://'):
+        bucket, key = _split_s3_uri(prefix)
+        paths = []
+        for page in _s3().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+            paths.extend(item['Key'][len(key):] for item in page.get('Contents', []) if item['Size'] > 0)
+    elif os.path.isdir(prefix):
+        paths = [
+            os.path.relpath(os.path.join(root, name), prefix).replace(os.sep, '/')
+            for root, _, names in os.walk(prefix) for name in names
+            if os.path.getsize(os.path.join(root, name)) > 0
+        ]
+    else:
+        paths = []
+    return sorted(
+        f"{PARTITION_KEY}={partition}/{path}" for path in paths
+        if not any(part.startswith(('_', '.')) for part in path.split('/'))
+    )
+
+
+def write_window_manifest(split_path, name, snapshot_date, window_days):
+    """
+    Write the manifest of every data file in the partitions of the window, see WINDOW_DAYS in
+    glue_preprocessing.py, returns the number of files it lists.
+    """
+    split_dir = split_path.rsplit('/', 1)[0]
+    entries = [{'prefix': split_dir + '/'}]
+    for partition in window_partitions(snapshot_date, window_days):
+        entries.extend(list_partition_files(split_dir, partition))
+    with open_output(manifest_path(split_path, name)) as sink:
+        sink.write(json.dumps(entries).encode('utf-8'))
+    return len(entries) - 1
+
+
+def profile_path(split_path):
+    # <processed dir>/profile/profile.json, next to the manifests and outside of the channel prefixes
+    return f"{split_path.rsplit('/', 2)[0]}/profile/profile.json"
+
+
+def json_number(value):
+    return None if value is None or value != value else float(value)
+
+
+def pandas_profile(splits):
+    """
+    Per split row count, label balance and column statistics of pandas frames, with exact
+    quantiles. spark_profile in glue_preprocessing.py computes the same statistics with Spark.
+    """
+    profile = {}
+    for name, df in splits.items():
+        columns = {}
+        for column_name in df.columns:
+            values = df[column_name]
+            column = {'count': int(values.count()), 'nulls': int(values.isna().sum())}
+            if values.dtype.kind in 'biuf':
+                values = values.astype(np.float64)
+                column.update({
+                    'min': json_number(values.min()),
+                    'max': json_number(values.max()),
+                    'mean': json_number(values.mean()),
+                    'variance': json_number(values.var()),
+                    'quantiles': [json_number(q) for q in values.dropna().quantile(PROFILE_QUANTILES, interpolation='lower')]
+                    if values.count() else [],
+                })
+            columns[column_name] = column
+        positives = int(df[PROFILE_LABEL].sum())
+        profile[name] = {'rows': len(df), 'label_counts': {'0': len(df) - positives, '1': positives}, 'columns': columns}
+    return profile
+
+
+def write_profile(path, split_profiles, incremental=False):
+    """
+    Write the profile sidecar as compact JSON. In incremental runs it describes the rows added by
+    the run, not the whole processed data.
+    """
+    profile = {
+        'label': PROFILE_LABEL,
+        'quantile_probabilities': PROFILE_QUANTILES,
+        'incremental': incremental,
+        'splits': split_profiles,
+    }
+    with open_output(path) as sink:
+        sink.write(json.dumps(profile, separators=(',', ':'), sort_keys=True).encode('utf-8'))
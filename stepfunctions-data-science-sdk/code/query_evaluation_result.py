@@ -11,7 +11,9 @@ s3_client = boto3.client('s3')
 # Retrieve transform job name from event and return transform job status.
 def lambda_handler(event, context):
     eval_res = event["EvaluationResult"]
-    eval_s3uri = f"{eval_res}evaluation.json"
+    # the scalar metrics of evaluation.json, without its ROC curve. GateMetric picks the one the
+    # gate compares, accuracy_lower for the lower bound of the confidence interval of accuracy
+    eval_s3uri = f"{eval_res}summary.json"
     
     bucket_name = eval_s3uri.replace('s3://', '').split('/')[0]
     key_name = eval_s3uri.replace(f's3://{bucket_name}/', '')
@@ -23,5 +25,5 @@ def lambda_handler(event, context):
 
     return {
         "statusCode": 200,
-        "trainingMetrics": s3clientlist["binary_classification_metrics"]["accuracy"]["value"],
+        "trainingMetrics": s3clientlist[event.get("GateMetric", "accuracy")],
         "S3ModelArtifacts": event["S3ModelArtifacts"]}
@@ -38,6 +38,12 @@ def create_glue_role(role_name, bucket):
                         "Effect": "Allow",
                         "Action": "s3:*Object",
                         "Resource": [f"arn:aws:s3:::{bucket}/*"]
+                    },
+                    {
+                        "Sid": "PublishStageMetrics",
+                        "Effect": "Allow",
+                        "Action": "cloudwatch:PutMetricData",
+                        "Resource": "*"
                     }
                 ]
             })